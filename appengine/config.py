@@ -9,3 +9,28 @@ class Config:
     gcp_ds_kind: str = 'optionchan'
     gcp_ds_key_id: str = 'prev_future_price'
     gcp_cf_url_base: str ='https://us-east1-optionchan-222710.cloudfunctions.net'
+    # Cloud Functions から取ってきたCSVをキャッシュする秒数
+    smile_data_cache_ttl_seconds: int = 30
+    atm_data_cache_ttl_seconds: int = 60
+    atm_iv_data_cache_ttl_seconds: int = 300
+    # キャッシュの期限が切れてから、裏で取り直している間に古いものを返してよい秒数
+    proxy_cache_max_stale_seconds: int = 600
+    # キャッシュするURLの数の上限
+    proxy_cache_max_size: int = 64
+    # Cloud Functions へのコネクションプールのサイズ。同時に取りに行く数(ProxyCache のスレッド数 + リクエストのスレッド数)程度にする
+    cf_http_pool_size: int = 8
+    # Cloud Functions へのリクエストのタイムアウト(秒)
+    cf_http_timeout_seconds: int = 60
+    # /live (Server-Sent Events) で上流をポーリングする間隔(秒)。上流へは ProxyCache を通すので、実際に取りに行くのは ttl ごと
+    live_poll_interval_seconds: int = 15
+    # 購読者がいなくなってからポーリングを止めるまでの秒数。再接続の間に止まらないように retry より十分長くする
+    live_idle_seconds: int = 120
+    # 更新が無いときにコメントを送る間隔(秒)。途中のプロキシに切られないように
+    live_heartbeat_seconds: int = 20
+    # 1つの接続を保つ最長の秒数。過ぎたら閉じて、ブラウザに再接続させる
+    live_stream_max_seconds: int = 55
+    # イベントを1つ送ったら接続を閉じるかどうか。
+    # App Engine スタンダード環境はレスポンスをバッファリングするので、閉じないとイベントが届かない
+    live_close_after_event: bool = True
+    # 接続が閉じてからブラウザが再接続するまでのミリ秒
+    live_retry_millis: int = 1000
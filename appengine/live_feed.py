@@ -0,0 +1,114 @@
+"""
+Cloud Functions から取ってきたCSVの更新を、接続しているブラウザへ Server-Sent Events で配るためのモジュールです。
+チャンネルごとにインスタンス内で1つのスレッドだけが上流をポーリングし、スナップショットが変わったら待っている接続を全て起こします。
+ビューアーが何人いても、上流へのリクエストはチャンネルごとに一定間隔で1回になります。
+
+CSVの1行目の最初の列は、スナップショットの時刻(スマイルカーブ)か最新の足の開始時刻(ATM)のエポック秒です。
+イベントIDは "{エポック秒}.{CSVのCRC32}" で、インスタンスをまたいでも同じ内容ならば同じIDになります。
+"""
+
+import time
+import zlib
+
+from collections import namedtuple
+from threading import Condition, Thread
+
+from my_logging import getLogger
+
+log = getLogger(__name__)
+
+# 上流から取ってきたCSVのスナップショット。lines は空行を除いたCSVの行(1行目はメタ情報)
+LiveSnapshot = namedtuple('LiveSnapshot', ['event_id', 'epoch', 'lines'])
+
+
+def make_snapshot(text):
+    lines = [line for line in text.split('\n') if line != '']
+    epoch = int(float(lines[0].split(',')[0]))
+    return LiveSnapshot(f'{epoch}.{zlib.crc32(text.encode("utf-8")):08x}', epoch, lines)
+
+
+# イベントIDを (エポック秒, CRC32) に分けます。CRC32 が無ければ None。
+# ブラウザが最初に読んだCSVの時刻だけを渡してきた場合は "{エポック秒}" になる。解釈できなければ (None, None)
+def parse_event_id(event_id):
+    if not event_id:
+        return None, None
+
+    epoch, _, crc = event_id.partition('.')
+
+    try:
+        return int(float(epoch)), crc or None
+    except ValueError:
+        return None, None
+
+
+# snapshot が、イベントID event_id の時点よりも新しいかどうか。
+# 時刻が戻るもの(止まっていたスレッドが持っていた古いスナップショットなど)は新しいとみなさない
+def is_newer(snapshot, event_id):
+    epoch, crc = parse_event_id(event_id)
+
+    if epoch is None:
+        return True
+
+    return snapshot.epoch > epoch or (snapshot.epoch == epoch and snapshot.event_id != f'{epoch}.{crc}')
+
+
+# 1つのチャンネルのスナップショットを、上流をポーリングして配るクラス。
+# loader: 上流からCSVの文字列を取ってくる関数
+# poll_interval: ポーリングの間隔(秒)
+# idle_seconds: 購読者がいなくなってからポーリングを止めるまでの秒数
+class LiveFeed:
+
+    def __init__(self, name, loader, poll_interval, idle_seconds):
+        self.name = name
+        self.loader = loader
+        self.poll_interval = poll_interval
+        self.idle_seconds = idle_seconds
+        self._snapshot = None
+        self._subscribers = 0
+        self._last_subscribed_at = 0
+        self._thread = None
+        self._condition = Condition()
+
+    # 購読を始めます。ポーリングのスレッドが止まっていれば起動します
+    def subscribe(self):
+        with self._condition:
+            self._subscribers += 1
+            self._last_subscribed_at = time.monotonic()
+
+            if self._thread is None:
+                log.debug(f'start polling: feed={self.name}')
+                self._thread = Thread(target=self._poll, name=f'live_feed_{self.name}', daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self):
+        with self._condition:
+            self._subscribers -= 1
+            self._last_subscribed_at = time.monotonic()
+
+    # event_id の時点よりも新しいスナップショットが来るまで、最長 timeout 秒待ちます。来なければ None を返します
+    def wait(self, event_id, timeout):
+        with self._condition:
+            is_updated = self._condition.wait_for(
+                lambda: self._snapshot is not None and is_newer(self._snapshot, event_id), timeout)
+
+            return self._snapshot if is_updated else None
+
+    def _poll(self):
+        while True:
+            with self._condition:
+                if self._subscribers == 0 and time.monotonic() - self._last_subscribed_at > self.idle_seconds:
+                    log.debug(f'stop polling: feed={self.name}')
+                    self._thread = None
+                    return
+
+            try:
+                snapshot = make_snapshot(self.loader())
+            except Exception as e:
+                log.error(f'failed to poll: feed={self.name}, error={e}')
+            else:
+                with self._condition:
+                    if self._snapshot is None or snapshot.event_id != self._snapshot.event_id:
+                        self._snapshot = snapshot
+                        self._condition.notify_all()
+
+            time.sleep(self.poll_interval)
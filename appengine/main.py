@@ -1,12 +1,22 @@
+import gzip
+import time
+import zlib
+
+from collections import namedtuple
+from urllib.parse import urlencode
+
 # 3rd party library
 import requests
 
-from flask import Flask, render_template, make_response, request
+from flask import Flask, Response, render_template, make_response, request
+from requests.adapters import HTTPAdapter
 
 # my modules
 from config import Config
 
+from live_feed import LiveFeed, parse_event_id
 from my_logging import getLogger
+from proxy_cache import ProxyCache
 
 config = Config()
 log = getLogger(__name__)
@@ -16,6 +26,57 @@ app = Flask(__name__)
 with open('auth.txt', 'r') as f:
     cf_token = f.readline().rstrip('\r\n')
 
+# Cloud Functions から取ってきたCSVのキャッシュ
+proxy_cache = ProxyCache(config.proxy_cache_max_size, config.proxy_cache_max_stale_seconds)
+
+# Cloud Functions へのコネクションはリクエストをまたいで使い回す。
+# gzip で返してもらい、展開せずにそのままクライアントへ流す
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=config.cf_http_pool_size))
+http_session.headers.update({
+    'Accept-Encoding': 'gzip',
+    'Authorization': f'Bearer {cf_token}',
+})
+
+# ボディを読み書きする単位(バイト)
+CHUNK_SIZE = 64 * 1024
+
+# Cloud Functions から取ってきたコンテンツ。
+# body は Content-Encoding で圧縮されたままのバイト列。content_encoding は圧縮されていなければ None。
+# 受け取りながら返すもの(stream_content_from_cloud_functions)では body は TeeBody
+UpstreamContent = namedtuple('UpstreamContent', ['body', 'content_encoding'])
+
+# 時間足の時間枠(秒)。Cloud Functions の atm_data, atm_iv_data が受け付けるもの
+TIME_FRAMES = ['300', '900', '3600', '86400']
+
+# atm_iv_data の d (日数)の上限。ページ(atm_iv.js)の上限と同じ
+MAX_NUM_DAYS = 100
+
+# atm_iv_data の n (何限月目か。0始まり)の上限。download_jpx が取り込むのは3限月まで
+MAX_NTH_CONTRACT_MONTH = 2
+
+
+# Cloud Functions の関数 name のURLを返す。params はクエリパラメータ(エンコードしてつける)
+def cloud_functions_url(name, **params):
+    url = f'{config.gcp_cf_url_base}/{name}'
+    return f'{url}?{urlencode(params)}' if params else url
+
+
+# /live で配るチャンネル。ページが最初に読むCSVと同じURLをポーリングするので、キャッシュも共有する
+LIVE_URLS = {
+    'smile': (cloud_functions_url('smile_data'), config.smile_data_cache_ttl_seconds),
+    'atm': (cloud_functions_url('atm_data', tf='300'), config.atm_data_cache_ttl_seconds),
+}
+
+
+# チャンネルのCSVを文字列で取ってくる関数を返す
+def make_live_loader(url, ttl):
+    return lambda: decode_content(load_content_from_cloud_functions(url, ttl))
+
+
+live_feeds = {name: LiveFeed(name, make_live_loader(url, ttl), config.live_poll_interval_seconds, config.live_idle_seconds)
+              for name, (url, ttl) in LIVE_URLS.items()}
+
 
 @app.route('/')
 def hello():
@@ -30,12 +91,10 @@ def smile():
 # スマイルカーブ用のデータをCSVで返す
 @app.route('/smile_data')
 def smile_data():
-    url = f'{config.gcp_cf_url_base}/smile_data'
-    option_list_csv = load_content_from_cloud_functions(url)
+    url = cloud_functions_url('smile_data')
+    option_list_csv = load_content_from_cloud_functions(url, config.smile_data_cache_ttl_seconds, stream=True)
 
-    res = make_response(option_list_csv, 200)
-    res.headers['Content-type'] = 'text/csv; charset=utf-8'
-    return res
+    return make_csv_response(option_list_csv)
 
 
 @app.route('/atm')
@@ -46,12 +105,15 @@ def amt():
 # ATM IV推移用のデータをCSVで返す
 @app.route('/atm_data')
 def atm_data():
-    url = f'{config.gcp_cf_url_base}/atm_data'
-    option_list_csv = load_content_from_cloud_functions(url)
+    time_frame = request.args.get('tf', default='300')
 
-    res = make_response(option_list_csv, 200)
-    res.headers['Content-type'] = 'text/csv; charset=utf-8'
-    return res
+    if time_frame not in TIME_FRAMES:
+        return make_response('Bad Request', 400)
+
+    url = cloud_functions_url('atm_data', tf=time_frame)
+    option_list_csv = load_content_from_cloud_functions(url, config.atm_data_cache_ttl_seconds, stream=True)
+
+    return make_csv_response(option_list_csv)
 
 
 @app.route('/atm_iv')
@@ -62,33 +124,248 @@ def atm_iv():
 # ATM IV推移用のデータをCSVで返す
 @app.route('/atm_iv_data')
 def atm_iv_data():
-    num_days = request.args.get('d', default='7')
-    n_th_contract_month = request.args.get('n', default='0')
-    url = f'{config.gcp_cf_url_base}/atm_iv_data?d={num_days}&n={n_th_contract_month}'
-    option_list_csv = load_content_from_cloud_functions(url)
+    num_days = int_arg('d', '7', 1, MAX_NUM_DAYS)
+    n_th_contract_month = int_arg('n', '0', 0, MAX_NTH_CONTRACT_MONTH)
+    time_frame = request.args.get('tf', default='3600')
 
-    res = make_response(option_list_csv, 200)
-    res.headers['Content-type'] = 'text/csv; charset=utf-8'
+    if num_days is None or n_th_contract_month is None or time_frame not in TIME_FRAMES:
+        return make_response('Bad Request', 400)
+
+    url = cloud_functions_url('atm_iv_data', d=num_days, n=n_th_contract_month, tf=time_frame)
+    option_list_csv = load_content_from_cloud_functions(url, config.atm_iv_data_cache_ttl_seconds, stream=True)
+
+    return make_csv_response(option_list_csv)
+
+
+# 整数のクエリパラメータを返す。整数でないか min_value 〜 max_value の範囲外ならば None
+def int_arg(name, default, min_value, max_value):
+    value = request.args.get(name, default=default)
+
+    if not value.isdecimal() or not min_value <= int(value) <= max_value:
+        return None
+
+    return int(value)
+
+
+# 新しいスナップショットを Server-Sent Events で送る。
+# ch: チャンネル(smile, atm)
+# since: ページが最初に読んだCSVの1行目の時刻。再接続のときはブラウザが送ってくる Last-Event-ID を優先する
+@app.route('/live')
+def live():
+    channel = request.args.get('ch')
+    feed = live_feeds.get(channel)
+
+    if feed is None:
+        return make_response(f'unknown channel: {channel}', 404)
+
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+
+    res = Response(stream_live_events(channel, feed, since), 200, mimetype='text/event-stream')
+    res.headers['Cache-Control'] = 'no-cache'
     return res
 
 
-# Cloud Functions からコンテンツをロードする
-def load_content_from_cloud_functions(url):
+# feed の更新を Server-Sent Events の形式で返すジェネレータ。
+# live_stream_max_seconds 秒経つか、live_close_after_event ならばイベントを1つ送ったら終わる
+def stream_live_events(channel, feed, since):
+    feed.subscribe()
+
+    try:
+        yield f'retry: {config.live_retry_millis}\n\n'
+
+        deadline = time.monotonic() + config.live_stream_max_seconds
+
+        while True:
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                return
+
+            snapshot = feed.wait(since, min(remaining, config.live_heartbeat_seconds))
+
+            if snapshot is None:
+                yield ': heartbeat\n\n'
+                continue
+
+            data = ''.join(f'data: {line}\n' for line in live_event_lines(channel, snapshot, since))
+            yield f'id: {snapshot.event_id}\nevent: {channel}\n{data}\n'
+
+            since = snapshot.event_id
+
+            if config.live_close_after_event:
+                return
+    finally:
+        feed.unsubscribe()
+
+
+# イベントで送るCSVの行を返す。1行目はメタ情報。
+# スマイルカーブはスナップショット全体を送る。
+# ATMは since の足(更新中だったもの)以降の足だけを送る。since が無ければ最新の足だけ
+def live_event_lines(channel, snapshot, since):
+    if channel != 'atm':
+        return snapshot.lines
+
+    since_epoch, _ = parse_event_id(since)
+    rows = snapshot.lines[1:]
+
+    if since_epoch is None:
+        rows = rows[-1:]
+    else:
+        rows = [row for row in rows if float(row.split(',')[0]) >= since_epoch]
+
+    return [snapshot.lines[0]] + rows
+
+
+# Cloud Functions からコンテンツをロードする。
+# ttl 秒間はキャッシュしたものを返す。期限切れのものは裏で取り直している間も返す。
+# stream: True ならば、キャッシュに無いときは全部取り終わるのを待たずに、受け取りながら返す(stream_content_from_cloud_functions)
+def load_content_from_cloud_functions(url, ttl, stream=False):
+    streamer = (lambda on_loaded, on_failed: stream_content_from_cloud_functions(url, on_loaded, on_failed)) if stream else None
+    return proxy_cache.get(url, ttl, lambda: fetch_content_from_cloud_functions(url), streamer)
+
+
+# Cloud Functions にリクエストして、ボディを読む前のレスポンスを返す
+def open_cloud_functions(url):
 
     # TODO 認証する
 
     headers = {
         'Pragma': 'no-cache',
         'Cache-Control': 'no-cache',
-        'Authorization': f'Bearer {cf_token}'
     }
 
-    response = requests.get(url, headers=headers)
+    response = http_session.get(url, headers=headers, stream=True, timeout=config.cf_http_timeout_seconds)
 
     if response.status_code != 200:
+        response.close()
         raise Exception(f'status code from HTTP Cloud Functions is invalid: {response.status_code}')
 
-    return response.content
+    return response
+
+
+# レスポンスの Content-Encoding を返す。圧縮されていなければ None
+def content_encoding_of(response):
+    content_encoding = response.headers.get('Content-Encoding', 'identity')
+    return None if content_encoding == 'identity' else content_encoding
+
+
+# キャッシュを使わずに Cloud Functions からコンテンツをロードする。
+# ボディは展開せずに、受け取ったままのバイト列で返す。
+def fetch_content_from_cloud_functions(url):
+    with open_cloud_functions(url) as response:
+        body = b''.join(response.raw.stream(CHUNK_SIZE, decode_content=False))
+        return UpstreamContent(body, content_encoding_of(response))
+
+
+# キャッシュを使わずに Cloud Functions からコンテンツをロードして、ボディを受け取りながら返す。
+# body は TeeBody で、クライアントへ流しながら集めたものを読み終わったら on_loaded に渡す
+def stream_content_from_cloud_functions(url, on_loaded, on_failed):
+    response = open_cloud_functions(url)
+    content_encoding = content_encoding_of(response)
+
+    return UpstreamContent(TeeBody(response, content_encoding, on_loaded, on_failed), content_encoding)
+
+
+# Cloud Functions のレスポンスのボディを、受け取ったチャンクごとに返すイテレータ。
+# 最後まで読んだら集めたコンテンツを on_loaded に渡し、途中で失敗するか最後まで読まれずに閉じられたら on_failed を呼ぶ。
+# どちらかを必ず呼ばないと、同じURLを待っている他のリクエストが待ち続けるので、レスポンスを閉じるときに close を呼ぶこと
+class TeeBody:
+
+    def __init__(self, response, content_encoding, on_loaded, on_failed):
+        self._response = response
+        self._content_encoding = content_encoding
+        self._on_loaded = on_loaded
+        self._on_failed = on_failed
+        self._stream = response.raw.stream(CHUNK_SIZE, decode_content=False)
+        self._chunks = []
+        self._is_finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._stream)
+        except StopIteration:
+            self._finish(None)
+            raise
+        except Exception as e:
+            self._finish(e)
+            raise
+
+        self._chunks.append(chunk)
+        return chunk
+
+    def close(self):
+        self._finish(Exception('response is closed before the body is read to the end'))
+
+    def _finish(self, error):
+        if self._is_finished:
+            return
+
+        self._is_finished = True
+        self._response.close()
+
+        if error is None:
+            self._on_loaded(UpstreamContent(b''.join(self._chunks), self._content_encoding))
+        else:
+            self._on_failed(error)
+
+
+# Cloud Functions から取ってきたコンテンツをCSVのレスポンスにする。
+# クライアントが gzip を受け付けるならば圧縮されたまま返し、そうでなければ展開しながら返す。
+def make_csv_response(content):
+    if content.content_encoding is None:
+        res = Response(content.body, 200)
+    elif content.content_encoding == 'gzip' and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        res = Response(content.body, 200)
+        res.headers['Content-Encoding'] = 'gzip'
+    elif content.content_encoding == 'gzip':
+        res = Response(decompress_gzip(content.body), 200)
+    else:
+        if isinstance(content.body, TeeBody):
+            content.body.close()
+        raise Exception(f'unsupported content encoding from HTTP Cloud Functions: {content.content_encoding}')
+
+    if isinstance(content.body, TeeBody):
+        # 最後まで送らずに閉じられたとき(クライアントの切断など)も、同じURLを待っている他のリクエストを起こす
+        res.call_on_close(content.body.close)
+
+    res.headers['Content-type'] = 'text/csv; charset=utf-8'
+    res.headers['Vary'] = 'Accept-Encoding'
+    return res
+
+
+# Cloud Functions から取ってきたコンテンツを展開して文字列にする
+def decode_content(content):
+    if content.content_encoding is None:
+        return content.body.decode('utf-8')
+    elif content.content_encoding == 'gzip':
+        return gzip.decompress(content.body).decode('utf-8')
+    else:
+        raise Exception(f'unsupported content encoding from HTTP Cloud Functions: {content.content_encoding}')
+
+
+# gzip のボディを CHUNK_SIZE ずつ展開しながら返すジェネレータ。body はバイト列か TeeBody
+def decompress_gzip(body):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    for chunk in iter_chunks(body):
+        yield decompressor.decompress(chunk)
+
+    yield decompressor.flush()
+
+
+# ボディを CHUNK_SIZE ずつ返す。TeeBody は受け取ったチャンクをそのまま返す
+def iter_chunks(body):
+    if isinstance(body, TeeBody):
+        yield from body
+        return
+
+    view = memoryview(body)
+
+    for i in range(0, len(view), CHUNK_SIZE):
+        yield view[i:i + CHUNK_SIZE]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+"""
+Cloud Functions から取ってきたコンテンツをインスタンス内でキャッシュするためのモジュールです。
+有効期限が切れたエントリは裏で取り直している間も古いものを返し(stale-while-revalidate)、
+同じキーへの同時のリクエストは1回の取得にまとめます。
+キャッシュに無いものは、取りに行ったリクエストへ流しながら集めてキャッシュに入れることもできます(streamer)。
+"""
+
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from my_logging import getLogger
+
+log = getLogger(__name__)
+
+
+class _Entry:
+
+    def __init__(self, content, fetched_at):
+        self.content = content
+        self.fetched_at = fetched_at
+
+
+# キー(URL)ごとにコンテンツを保持するキャッシュ。
+# max_size: 保持するエントリ数の上限。超えたら最も長く使われていないものから捨てる
+# max_stale: 有効期限が切れてから、古いものを返してよい秒数。これを過ぎたら取り直すまで待つ
+# max_workers: 裏で取り直すスレッドの数
+class ProxyCache:
+
+    def __init__(self, max_size, max_stale, max_workers=4):
+        self.max_size = max_size
+        self.max_stale = max_stale
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    # キーに対応するコンテンツを返します。
+    # ttl: 有効期限(秒)
+    # loader: コンテンツを取ってくる関数。キャッシュに無いか期限切れの場合に呼ばれる
+    # streamer: 指定すると、キャッシュに無く自分が取りに行く場合は、取り終わるのを待たずに streamer(on_loaded, on_failed) の戻り値を返す。
+    #   streamer はコンテンツを流しながら集めて、集め終わったら on_loaded(コンテンツ) を、途中で失敗したら on_failed(例外) を呼ぶこと。
+    #   streamer 自身が例外を出したときは on_failed を呼ばずにそのまま出すこと。
+    #   同じキーで待っている他のリクエストには on_loaded に渡したコンテンツが返る
+    def get(self, key, ttl, loader, streamer=None):
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+                if now < entry.fetched_at + ttl:
+                    return entry.content
+
+            # 取得中のものがあれば相乗りする
+            future = self._in_flight.get(key)
+            is_owner = future is None
+
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+
+            if entry is not None and now < entry.fetched_at + ttl + self.max_stale:
+                # 古いものを返して、裏で取り直す
+                if is_owner:
+                    log.debug(f'stale. revalidating: key={key}')
+                    self._executor.submit(self._load, key, loader, future)
+                return entry.content
+
+        if is_owner and streamer is not None:
+            log.debug(f'miss. streaming: key={key}')
+            return self._stream(key, streamer, future)
+
+        if is_owner:
+            log.debug(f'miss. loading: key={key}')
+            self._load(key, loader, future)
+
+        return future.result()
+
+    def _load(self, key, loader, future):
+        try:
+            content = loader()
+        except Exception as e:
+            self._fail(key, e, future)
+            return
+
+        self._put(key, content, future)
+
+    def _stream(self, key, streamer, future):
+        try:
+            return streamer(lambda content: self._put(key, content, future), lambda e: self._fail(key, e, future))
+        except Exception as e:
+            self._fail(key, e, future)
+            raise
+
+    def _fail(self, key, e, future):
+        log.error(f'failed to load: key={key}, error={e}')
+
+        with self._lock:
+            del self._in_flight[key]
+
+        future.set_exception(e)
+
+    def _put(self, key, content, future):
+        with self._lock:
+            self._entries[key] = _Entry(content, time.monotonic())
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            del self._in_flight[key]
+
+        future.set_result(content)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
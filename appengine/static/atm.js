@@ -10,11 +10,17 @@ function csv2Array(str) {
   return csvData;
 }
 
+function chartTitle(meta) {
+  var updatedAt = new Date(meta[0] * 1000);
+
+  return "ATMオプションパラメータ推移 (" + (updatedAt.getMonth() + 1) + '/' + updatedAt.getDate()  +' '
+      + updatedAt.getHours() + ':' + ("0"+updatedAt.getMinutes()).slice(-2) + " 更新)";
+}
+
 function drawChart(data) {
   var tmpLabels = [], tmpData1 = [], tmpData2 = [], tmpData3 = [], tmpData4 = [];
 
   var meta = data.shift()
-  var updatedAt = new Date(meta[0] * 1000);
 
   for (var row in data) {
     tmpLabels.push(data[row][0])
@@ -49,8 +55,7 @@ function drawChart(data) {
         responsive: true,
         title:{
             display:true,
-            text: "ATMオプションパラメータ推移 (" + (updatedAt.getMonth() + 1) + '/' + updatedAt.getDate()  +' '
-                          + updatedAt.getHours() + ':' + ("0"+updatedAt.getMinutes()).slice(-2) + " 更新)",
+            text: chartTitle(meta),
         },
         scales: {
             xAxes: [{
@@ -107,6 +112,35 @@ function drawChart(data) {
         }
     }
   });
+
+  return myChart;
+}
+
+// 新しい足(と更新中だった足)を Server-Sent Events で受け取って追加する
+function startLiveUpdate(chart, since) {
+  if (!window.EventSource) {
+    return;
+  }
+
+  var source = new EventSource('/live?ch=atm&since=' + since);
+  source.addEventListener('atm', function(e) {
+    var data = csv2Array(e.data);
+    var meta = data.shift();
+    var labels = chart.data.labels;
+
+    data.forEach(function(row) {
+      var i = labels.lastIndexOf(row[0]);
+      if (i < 0) {
+        labels.push(row[0]);
+        i = labels.length - 1;
+      }
+      for (var column = 1; column <= 3; column++) {
+        chart.data.datasets[column - 1].data[i] = row[column];
+      }
+    });
+    chart.options.title.text = chartTitle(meta);
+    chart.update();
+  });
 }
 
 function main() {
@@ -115,7 +149,9 @@ function main() {
   req.open("GET", filePath, true);
   req.onload = function() {
     var data = csv2Array(req.responseText);
-    drawChart(data);
+    var since = data[0][0];
+    var chart = drawChart(data);
+    startLiveUpdate(chart, since);
   }
   req.send(null);
 }
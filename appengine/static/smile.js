@@ -11,6 +11,17 @@ function csv2Array(str) {
   return csvData;
 }
 
+// データセットの並び順に対応するCSVの列
+var DATASET_COLUMNS = [3, 1, 7, 5, 4, 2, 8, 6];
+
+function chartTitle(meta) {
+  var updatedAt = new Date(meta[0] * 1000);
+  var atm = meta[1]
+
+  return "スマイルカーブ(" + (updatedAt.getMonth() + 1) + '/' + updatedAt.getDate()  +' '
+      + updatedAt.getHours() + ':' + ("0"+updatedAt.getMinutes()).slice(-2) + ") ATM = " + atm;
+}
+
 function drawChart(data) {
   // dataの列を系列としてリストに切り出す
   var tmpLabels = [], tmpData1 = [], tmpData2 = [], tmpData3 = [];
@@ -18,9 +29,6 @@ function drawChart(data) {
 
   var meta = data.shift()
 
-  var updatedAt = new Date(meta[0] * 1000);
-  var atm = meta[1]
-
   for (var row in data) {
     tmpLabels.push(data[row][0]); // target_price
     tmpData1.push(data[row][1]); // o1_call.iv
@@ -73,8 +81,7 @@ function drawChart(data) {
         responsive: true,
         title:{
             display:true,
-            text: "スマイルカーブ(" + (updatedAt.getMonth() + 1) + '/' + updatedAt.getDate()  +' '
-                          + updatedAt.getHours() + ':' + ("0"+updatedAt.getMinutes()).slice(-2) + ") ATM = " + atm,
+            text: chartTitle(meta),
         },
         scales: {
             xAxes: [{
@@ -103,6 +110,28 @@ function drawChart(data) {
         }
     }
   });
+
+  return myChart;
+}
+
+// 新しいスナップショットを Server-Sent Events で受け取って描き直す
+function startLiveUpdate(chart, since) {
+  if (!window.EventSource) {
+    return;
+  }
+
+  var source = new EventSource('/live?ch=smile&since=' + since);
+  source.addEventListener('smile', function(e) {
+    var data = csv2Array(e.data);
+    var meta = data.shift();
+
+    chart.data.labels = data.map(row => row[0]);
+    DATASET_COLUMNS.forEach(function(column, i) {
+      chart.data.datasets[i].data = data.map(row => row[column]);
+    });
+    chart.options.title.text = chartTitle(meta);
+    chart.update();
+  });
 }
 
 function main() {
@@ -111,7 +140,9 @@ function main() {
   req.open("GET", filePath, true);
   req.onload = function() {
     var data = csv2Array(req.responseText);
-    drawChart(data);
+    var since = data[0][0];
+    var chart = drawChart(data);
+    startLiveUpdate(chart, since);
   }
   req.send(null);
 }
@@ -0,0 +1,207 @@
+"""
+GCSにアップロードされた価格情報ファイルを、まとめて BigQuery にロードするモジュールです。
+ファイルごとにロードジョブを作る代わりに、テーブルごとに複数ファイルを1つのロードジョブでロードします。
+
+ロード済みの位置はテーブルごとに Cloud Datastore に記録し、それより後のファイルを先頭から順に
+「bq_load_batch_size 個」か「bq_load_batch_window_seconds 秒の時間枠の終わり」のどちらかで区切ってバッチにします。
+バッチの区切りはファイル名だけで決まり、ジョブIDはバッチに含まれるファイル名から作るので、
+同じバッチを何度ロードしようとしても BigQuery が重複したジョブを弾きます。
+"""
+
+import hashlib
+import re
+import time
+
+from datetime import datetime, timedelta
+
+from google.api_core.exceptions import Conflict
+from google.cloud import datastore
+from pytz import timezone
+
+import clients, price_file
+
+from config import Config
+from my_logging import getLogger
+
+log = getLogger(__name__)
+config = Config()
+
+TZ_JST = timezone('Asia/Tokyo')
+TZ_UTC = timezone('UTC')
+
+# まとめてロードするテーブル
+TABLE_NAMES = ['spot_price', 'future_price', 'option_price', 'atm_price']
+
+# 価格情報を格納するGCS上のファイル名のパターン。時刻は created_at (JST)
+REGEX_PRICE_FILE_NAME = re.compile(r'((?:spot|future|option|atm)_price)_(\d{14})\d*(?:\.json\.gz|\.parquet)')
+
+TIME_FORMAT = '%Y%m%d%H%M%S'
+
+
+# ファイル名に含まれる時刻を返します
+def file_time(name):
+    m = REGEX_PRICE_FILE_NAME.match(name)
+    return TZ_JST.localize(datetime.strptime(m.group(2), TIME_FORMAT))
+
+
+# ファイルが属する時間枠の終わりの時刻を返します
+def window_end(name, window_seconds):
+    epoch = int(file_time(name).timestamp())
+    return datetime.fromtimestamp((epoch // window_seconds + 1) * window_seconds, TZ_UTC)
+
+
+# ロード済みのファイルより後のファイル名のリストを先頭からバッチに区切ります。
+# フォーマットが違うファイルは同じバッチにしません。
+# 最後のバッチは、まだファイルが増える可能性があっても区切ったまま返します。
+def split_into_batches(names, batch_size, window_seconds):
+    batches = []
+
+    for name in names:
+        if len(batches) > 0:
+            last_batch = batches[-1]
+            if len(last_batch) < batch_size \
+                    and window_end(last_batch[0], window_seconds) == window_end(name, window_seconds) \
+                    and price_file.source_format_of(last_batch[0]) == price_file.source_format_of(name):
+                last_batch.append(name)
+                continue
+
+        batches.append([name])
+
+    return batches
+
+
+# バッチがロードしてよい状態かどうか。
+# 個数が揃っているか、時間枠が終わってから grace_seconds 秒経っていれば True
+def is_batch_ready(batch, now, batch_size, window_seconds, grace_seconds):
+    if len(batch) >= batch_size:
+        return True
+
+    return window_end(batch[0], window_seconds) + timedelta(seconds=grace_seconds) <= now
+
+
+# バッチに含まれるファイル名から、ジョブIDを作ります
+def batch_job_id(table_name, batch):
+    digest = hashlib.sha1('\n'.join(batch).encode('utf-8')).hexdigest()
+    first_time = file_time(batch[0]).strftime(TIME_FORMAT)
+    return f'load_{table_name}_{first_time}_{len(batch)}_{digest[:16]}'
+
+
+def _watermark_key(client, table_name):
+    return client.key(config.gcp_ds_kind, f'{config.gcp_ds_bq_load_watermark_key_prefix}{table_name}')
+
+
+# ロード済みの最後のファイル名を返します。まだ記録が無ければ None を返します。
+def find_watermark(table_name):
+    client = clients.datastore_client()
+    watermark = client.get(_watermark_key(client, table_name))
+
+    if watermark is None:
+        return None
+
+    return watermark['last_loaded_name']
+
+
+# ロード済みの最後のファイルの時刻(created_at)を返します。まだ記録が無ければ None を返します。
+# BigQuery で読めるデータのバージョンとして、smile_data, atm_data のキャッシュのキーに使う
+def find_loaded_created_at(table_name):
+    watermark = find_watermark(table_name)
+
+    if watermark is None:
+        return None
+
+    return file_time(watermark)
+
+
+# ロード済みの最後のファイル名を記録します。記録済みのものより前に戻すことはしません。
+def update_watermark(table_name, last_loaded_name):
+    client = clients.datastore_client()
+
+    with client.transaction():
+        key = _watermark_key(client, table_name)
+        watermark = client.get(key)
+
+        if watermark is None:
+            watermark = datastore.Entity(key)
+        elif watermark['last_loaded_name'] >= last_loaded_name:
+            return
+
+        watermark['last_loaded_name'] = last_loaded_name
+        client.put(watermark)
+
+
+# ロード済みのファイルより後のファイル名のリストを、名前順(=時刻順)で返します
+def list_pending_names(table_name, now):
+    watermark = find_watermark(table_name)
+
+    if watermark is None:
+        # 初回は直近のものだけを対象にする
+        start = now - timedelta(seconds=config.bq_load_initial_lookback_seconds)
+        start_offset = f'{table_name}_{start.astimezone(TZ_JST).strftime(TIME_FORMAT)}'
+    else:
+        start_offset = watermark
+
+    client = clients.storage_client()
+    blobs = client.list_blobs(config.gcp_cs_bucket_name, prefix=f'{table_name}_', start_offset=start_offset)
+
+    names = sorted(b.name for b in blobs if REGEX_PRICE_FILE_NAME.match(b.name))
+    return [name for name in names if watermark is None or name > watermark]
+
+
+# 1バッチ分のファイルを1つのロードジョブでロードして、完了を待ちます。
+# BigQuery のライブラリはロードするバッチがあるときだけ読み込む。ほとんどの呼び出しはバッチが揃っていないため
+def load_batch(table_name, batch):
+    from google.cloud import bigquery
+    import bq_query
+
+    client = clients.bigquery_client()
+    uris = [f'gs://{config.gcp_cs_bucket_name}/{name}' for name in batch]
+    table_fqn = f'{config.gcp_project_id}.{config.gcp_bq_dataset_name}.{table_name}'
+    job_id = batch_job_id(table_name, batch)
+
+    job_config = bigquery.LoadJobConfig()
+    job_config.autodetect = False
+    job_config.create_disposition = 'CREATE_NEVER'
+    job_config.source_format = price_file.source_format_of(batch[0])
+
+    started = time.monotonic()
+
+    try:
+        load_job = client.load_table_from_uri(uris, table_fqn, job_id=job_id, job_config=job_config)
+        log.debug(f'Load job: {job_id} [{table_fqn}] files={len(uris)}')
+    except Conflict:
+        # 同じバッチのジョブは作成済み
+        load_job = client.get_job(job_id)
+        log.debug(f'Load job already exists: {job_id} [{table_fqn}]')
+
+    bq_query.wait_job(load_job, f'flush_{table_name}', started)
+
+
+# ロードしてよい状態のバッチを全てロードします。
+# 戻り値: ロードしたファイルの数
+def flush_table(table_name, now=None):
+    now = now or datetime.now(TZ_UTC)
+    batch_size = config.bq_load_batch_size
+    window_seconds = config.bq_load_batch_window_seconds
+
+    names = list_pending_names(table_name, now)
+    batches = split_into_batches(names, batch_size, window_seconds)
+
+    num_loaded = 0
+
+    for batch in batches:
+        if not is_batch_ready(batch, now, batch_size, window_seconds, config.bq_load_batch_grace_seconds):
+            # 以降のバッチはもっと新しいので、これより後もまだ揃っていない
+            break
+
+        load_batch(table_name, batch)
+        update_watermark(table_name, batch[-1])
+        num_loaded += len(batch)
+
+    return num_loaded
+
+
+# 全テーブルについて flush_table します
+def flush_all_tables(now=None):
+    for table_name in TABLE_NAMES:
+        num_loaded = flush_table(table_name, now)
+        log.debug(f'flushed: table={table_name}, files={num_loaded}')
@@ -1,11 +1,92 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass
 class Config:
     gcp_project_id: str = 'optionchan-222710'
     gcp_cs_bucket_name: str = 'optionchan'
+    # スマイルカーブ用のCSVを置くバケット。gcp_cs_bucket_name に置くと load_jpx_into_bq が無駄に呼ばれるので別にする
+    gcp_cs_smile_bucket_name: str = 'optionchan-smile'
     gcp_bq_dataset_name: str = 'optionchan'
     gcp_ds_kind: str = 'optionchan'
     gcp_ds_key_id: str = 'prev_future_price'
+    # BigQuery へのロード済みの位置を記録する Cloud Datastore のキーの接頭辞。後ろにテーブル名が付く
+    gcp_ds_bq_load_watermark_key_prefix: str = 'bq_load_watermark_'
+    # 前回保存したオプション価格のフィンガープリントを記録する Cloud Datastore のキー
+    gcp_ds_delta_state_key_id: str = 'option_price_delta_state'
+    # 取引中の限月の最終取引日の一覧を記録する Cloud Datastore のキー
+    gcp_ds_contract_calendar_key_id: str = 'contract_calendar'
     gcp_cf_url_base: str ='https://us-east1-optionchan-222710.cloudfunctions.net'
+    # JPXのHTMLパーサーエンジン。'lxml' or 'pyquery'
+    jpx_html_parser: str = 'lxml'
+    # 直近限月のページの現物価格・先物価格のテーブルのハッシュが前回と同じならば、パースせずに終わるかどうか
+    jpx_price_info_precheck: bool = True
+    # download_jpx がダウンロードしたHTMLを Cloud Storage に保存するかどうか(html_archive)
+    html_archive_enabled: bool = True
+    # 保存先のバケット。gcp_cs_bucket_name は3日で削除されるので、別のバケットにする
+    html_archive_bucket_name: str = 'optionchan-html'
+    # 保存先の接頭辞
+    html_archive_prefix: str = 'html/v1'
+    # zstd の辞書の置き場所の接頭辞
+    html_archive_dict_prefix: str = 'html/dict'
+    # 圧縮に使う zstd の辞書のID。0 ならば辞書を使わない。辞書は tools/html_archive_tool.py train-dict で作る
+    html_archive_dict_id: int = 0
+    # zstd の圧縮レベル
+    html_archive_compression_level: int = 10
+    # JPXのIV, グリークスが欠損している箇所を Black-76 の理論値で埋めるかどうか。
+    # 理論値は JPX の値と同じ列に入り、どちらの値かは記録されないので、記録する列ができるまでは有効にしない
+    fill_missing_iv_and_greeks: bool = False
+    # IV, グリークスの計算に使う無リスク金利
+    risk_free_rate: float = 0.0
+    # 表示用のCSVのキャッシュのエントリ数の上限
+    query_cache_max_size: int = 32
+    # 表示用のCSVのキャッシュの有効期限(秒)。取り込みが止まっていても、これより古いものは返さない
+    query_cache_ttl_seconds: int = 300
+    # BigQuery へ1つのロードジョブでまとめてロードするファイルの数。1 ならばファイルごとにすぐロードする。
+    # 2 以上にすると、行がロードされるのは最大で bq_load_batch_window_seconds + bq_load_batch_grace_seconds
+    # + flush_jpx_into_bq の間隔 だけ遅れる。timeframe の ohlc_rollup_lookback_seconds をそれより長くしないと、
+    # 遅れてロードされた行が時間足に入らない。smile_data, atm_data の鮮度も同じだけ落ちる
+    bq_load_batch_size: int = 1
+    # bq_load_batch_size が 1 のとき、load_jpx_into_bq がロードジョブの完了を待つ最長の秒数。関数のタイムアウト(60秒)より短くする
+    bq_load_wait_timeout_seconds: int = 30
+    # まとめてロードする時間枠(秒)。個数が揃わなくても、時間枠が終わればロードする
+    bq_load_batch_window_seconds: int = 900
+    # 時間枠が終わってから、遅れてアップロードされるファイルを待つ秒数
+    bq_load_batch_grace_seconds: int = 60
+    # ロード済みの位置の記録が無いときに、さかのぼってロードする秒数
+    bq_load_initial_lookback_seconds: int = 86400
+    # GCSに置く価格情報ファイルのフォーマット。'ndjson' (gzip したNDJSON) or 'parquet'
+    price_file_format: str = 'ndjson'
+    # オプション価格を前回のスナップショットから変わった行(とATMの行)だけ保存するかどうか
+    delta_ingestion: bool = False
+    # 全行を保存するキーフレームの時間枠(秒)。時間枠ごとの最初のスナップショットがキーフレームになる。
+    # 読み出し側はこの時間枠の分だけ option_price をさかのぼって読むので、delta_ingestion が False でも使う
+    option_price_keyframe_interval_seconds: int = 3600
+    # BigQuery のクエリを実行する前に dry run で処理するバイト数を見積もり、上限を超えるものは実行しないかどうか
+    bq_query_budget_enabled: bool = True
+    # エンドポイントごとの処理するバイト数の上限
+    bq_query_max_bytes: dict = field(default_factory=lambda: {
+        'smile_data': 200 * 1024 * 1024,
+        'atm_data': 50 * 1024 * 1024,
+    })
+    # 取引セッション外の download_jpx の呼び出しを、JPXのページを取りに行く前に終わらせるかどうか(market_calendar)
+    market_schedule_enabled: bool = True
+    # 日中セッションの (始まり, 終わり)。JST の 'HH:MM'
+    market_day_session: tuple = ('08:45', '15:45')
+    # 夜間セッションの (始まり, 終わり)。終わりは翌日の時刻
+    market_night_session: tuple = ('17:00', '06:00')
+    # セッションの始まりの何分前から取り込むか。板寄せ前の気配を取り込むため
+    market_session_margin_before_minutes: int = 15
+    # セッションの終わりの何分後まで取り込むか。JPXのページに遅れて反映される引けの値を取り込むため
+    market_session_margin_after_minutes: int = 30
+    # 土日と年末年始(12/31-1/3)以外の休業日。'YYYY-MM-DD' (JST)。
+    # 祝日取引がある日もあるので祝日は含めていない。取引が無いと分かっている日だけ足すこと
+    market_closed_dates: list = field(default_factory=list)
+    # セッション中に何分おきに取り込むか
+    ingest_interval_minutes: int = 1
+    # セッションの始まり・終わりの前後何分を、1分に複数回取り込むか
+    ingest_boost_minutes: int = 10
+    # SQ日の日中セッションの始まりから何分後まで、1分に複数回取り込むか
+    ingest_sq_boost_minutes: int = 60
+    # セッションの始まり・終わりの前後に、1分に何回取り込むか
+    ingest_boost_polls_per_minute: int = 2
@@ -0,0 +1,84 @@
+"""
+取引中の限月の最終取引日の一覧(限月カレンダー)を Cloud Datastore に保持するモジュールです。
+download_jpx が新しい最終取引日を見つけたときだけ更新し、
+読み出し側は n 番目の限月の最終取引日を option_price をスキャンせずに引けます。
+"""
+
+import numpy as np
+
+from google.cloud import datastore
+
+import clients
+
+from config import Config
+from my_logging import getLogger
+from option_chain import JST_OFFSET
+
+log = getLogger(__name__)
+config = Config()
+
+# 最後に保存した(または読み込んだ)最終取引日の一覧。インスタンスがウォームな間は Datastore を読まずに済ませる
+_last_trading_days = None
+
+
+# OptionChain に含まれる最終取引日を 'YYYY-MM-DD' (JST) の文字列のリストで返します
+def last_trading_days_of(option_chain):
+    days = np.unique((option_chain.columns['last_trading_day'] + JST_OFFSET).astype('datetime64[D]'))
+    return np.datetime_as_string(days, unit='D').tolist()
+
+
+def _calendar_key(client):
+    return client.key(config.gcp_ds_kind, config.gcp_ds_contract_calendar_key_id)
+
+
+# 取引中の限月の最終取引日を近い順に並べたリストを返します。まだ記録が無ければ None を返します。
+def find_last_trading_days():
+    client = clients.datastore_client()
+    calendar = client.get(_calendar_key(client))
+
+    if calendar is None:
+        return None
+
+    return list(calendar['last_trading_days'])
+
+
+# n 番目(0始まり)に近い限月の最終取引日を 'YYYY-MM-DD' で返します。無ければ None を返します。
+def find_nth_last_trading_day(n):
+    last_trading_days = find_last_trading_days()
+
+    if last_trading_days is None or n >= len(last_trading_days):
+        return None
+
+    return last_trading_days[n]
+
+
+# 取引中の限月の最終取引日の一覧が変わっていれば保存します。保存した場合は True を返します。
+# last_trading_days: 'YYYY-MM-DD' (JST) の文字列のリスト
+def update_if_changed(last_trading_days):
+    global _last_trading_days
+
+    last_trading_days = sorted(set(last_trading_days))
+
+    if last_trading_days == _last_trading_days:
+        return False
+
+    client = clients.datastore_client()
+
+    with client.transaction():
+        key = _calendar_key(client)
+        calendar = client.get(key)
+
+        if calendar is not None and list(calendar['last_trading_days']) == last_trading_days:
+            _last_trading_days = last_trading_days
+            return False
+
+        if calendar is None:
+            calendar = datastore.Entity(key)
+
+        calendar['last_trading_days'] = last_trading_days
+        client.put(calendar)
+
+    log.debug(f'contract calendar is updated: {last_trading_days}')
+    _last_trading_days = last_trading_days
+
+    return True
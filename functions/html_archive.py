@@ -0,0 +1,125 @@
+"""
+download_jpx がダウンロードしたJPXのページのHTMLを、スナップショットごとに Cloud Storage に保存しておくモジュールです。
+パーサーを直したときに、過去のHTMLから価格情報を作り直せるようにするためのものです。(tools/html_archive_tool.py)
+
+ページはどれもほとんど同じなので、サンプルのページから学習した zstd の辞書を共有して圧縮します。
+辞書は {html_archive_dict_prefix}/{辞書ID}.dict に置き、Config.html_archive_dict_id のものを圧縮に使います。
+zstd のフレームには辞書IDが入るので、展開するときはフレームの辞書IDの辞書を使います。(0 は辞書無し)
+
+保存先: gs://{html_archive_bucket_name}/{html_archive_prefix}/{YYYYMMDD}/{YYYYMMDDHHMMSS}_{限月の番号(1始まり)}.html.zst  (時刻はスナップショットの created_at (JST))
+"""
+
+import re
+
+import zstandard
+
+import clients
+
+from config import Config
+from my_logging import getLogger
+
+log = getLogger(__name__)
+config = Config()
+
+TIME_FORMAT = '%Y%m%d%H%M%S'
+
+# 保存したHTMLのファイル名のパターン
+REGEX_ARCHIVE_NAME = re.compile(r'(?:.*/)?(\d{14})_(\d+)\.html\.zst$')
+
+# 辞書ID -> 辞書。インスタンスがウォームな間(ツールではプロセスが生きている間)使い回す
+_dicts = {}
+
+# 圧縮に使う ZstdCompressor。Config.html_archive_dict_id の辞書を読み込んだもの
+_compressor = None
+
+# 辞書ID -> 展開に使う ZstdDecompressor
+_decompressors = {}
+
+
+# スナップショットの時刻と限月の番号から、保存先の名前を返します
+def archive_name(created_at, nth):
+    suffix = created_at.strftime(TIME_FORMAT)
+    return f'{config.html_archive_prefix}/{suffix[:8]}/{suffix}_{nth}.html.zst'
+
+
+# 保存先の名前から (時刻の文字列 YYYYMMDDHHMMSS, 限月の番号) を返します。保存したHTMLでなければ None を返します。
+def parse_archive_name(name):
+    m = REGEX_ARCHIVE_NAME.match(name)
+
+    if m is None:
+        return None
+
+    return m.group(1), int(m.group(2))
+
+
+def dict_name(dict_id):
+    return f'{config.html_archive_dict_prefix}/{dict_id}.dict'
+
+
+# 辞書IDの辞書を返します。0 ならば None (辞書無し)
+def load_dict(dict_id):
+    if dict_id == 0:
+        return None
+
+    if dict_id not in _dicts:
+        bucket = clients.storage_client().bucket(config.html_archive_bucket_name)
+        data = bucket.blob(dict_name(dict_id)).download_as_string()
+        _dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+
+    return _dicts[dict_id]
+
+
+# 手元にある辞書のデータを登録します。Cloud Storage から読まずに展開したいときに使います
+# 戻り値: 辞書ID
+def register_dict(data):
+    zstd_dict = zstandard.ZstdCompressionDict(data)
+    _dicts[zstd_dict.dict_id()] = zstd_dict
+    return zstd_dict.dict_id()
+
+
+# サンプルのHTMLのリストから辞書を学習して、Cloud Storage に置きます。
+# 戻り値: 辞書ID。Config.html_archive_dict_id に設定すると、以降の圧縮に使われます
+def train_and_upload_dict(samples, dict_size=112640):
+    zstd_dict = zstandard.train_dictionary(dict_size, samples)
+    dict_id = zstd_dict.dict_id()
+
+    bucket = clients.storage_client().bucket(config.html_archive_bucket_name)
+    bucket.blob(dict_name(dict_id)).upload_from_string(zstd_dict.as_bytes(), content_type='application/octet-stream')
+
+    _dicts[dict_id] = zstd_dict
+    log.info(f'zstd dictionary is uploaded: dict_id={dict_id}, samples={len(samples)}')
+
+    return dict_id
+
+
+def compress(html):
+    global _compressor
+
+    if _compressor is None:
+        _compressor = zstandard.ZstdCompressor(
+            level=config.html_archive_compression_level, dict_data=load_dict(config.html_archive_dict_id))
+
+    return _compressor.compress(html)
+
+
+# フレームの辞書IDの辞書で展開します
+def decompress(data):
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+
+    if dict_id not in _decompressors:
+        _decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=load_dict(dict_id))
+
+    return _decompressors[dict_id].decompress(data)
+
+
+# スナップショットの各限月のページを保存します。
+# html_list: 直近限月から順に並べたHTML(bytes)のリスト
+def archive_pages(created_at, html_list):
+    bucket = clients.storage_client().bucket(config.html_archive_bucket_name)
+
+    for nth, html in enumerate(html_list, start=1):
+        if isinstance(html, str):
+            html = html.encode('utf-8')
+
+        blob = bucket.blob(archive_name(created_at, nth))
+        blob.upload_from_string(compress(html), content_type='application/zstd')
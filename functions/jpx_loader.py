@@ -2,16 +2,23 @@
 日本取引所グループのウェブサイトから日経225オプションの価格をダウンロードするためのモジュールです。
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pytz import timezone
 from typing import List
+import hashlib
 import re
 import requests
 
+import lxml.html
+from lxml import etree
 from pyquery import PyQuery as pq
+from pyquery.text import extract_text, squash_html_whitespace
 
-from models import OptionPrice, OptionType, FuturePrice, SpotPrice
+from config import Config
+from models import AtmPrice, OptionPrice, OptionType, FuturePrice, SpotPrice
+from option_chain import OptionChain
 from my_logging import getLogger
 
 
@@ -20,9 +27,40 @@ from my_logging import getLogger
 class JpxOptionPriceInfo:
     spot_price: SpotPrice
     future_price: FuturePrice
-    call_option_list: List[OptionPrice]
-    put_option_list: List[OptionPrice]
+    option_chain: OptionChain
     created_at: datetime
+    # 解析したページのHTML。html_archive で保存するため
+    html: bytes = None
+
+    # 互換用。CALL の OptionPrice のリストを返します。
+    @property
+    def call_option_list(self) -> List[OptionPrice]:
+        return self.option_chain.calls.to_option_list()
+
+    # 互換用。PUT の OptionPrice のリストを返します。
+    @property
+    def put_option_list(self) -> List[OptionPrice]:
+        return self.option_chain.puts.to_option_list()
+
+    # ATMのPUTから AtmPrice を作ります。ATMが無ければ None を返します。
+    # created_at は option_chain のものを使います。
+    def atm_price(self) -> AtmPrice:
+        puts = self.option_chain.puts
+        is_atm = puts.masks['is_atm'] & puts.columns['is_atm']
+
+        if not is_atm.any():
+            return None
+
+        atm_put = puts.select(is_atm).to_option_list()[0]
+
+        return AtmPrice(
+            target_price=atm_put.target_price,
+            iv=atm_put.iv,
+            price=atm_put.price,
+            future_price=self.future_price.price,
+            last_trading_day=atm_put.last_trading_day,
+            created_at=atm_put.created_at,
+        )
 
 
 REGEX_PRICE = re.compile(r'([\d\.]+)\(\d{2}/\d{2} (\d{2}:\d{2})\)')
@@ -39,7 +77,16 @@ JPX_URL_NEARBY_1ST = 'https://svc.qri.jp/jpx/nkopm/'
 JPX_URL_NEARBY_2ND = 'https://svc.qri.jp/jpx/nkopm/1'
 JPX_URL_NEARBY_3RD = 'https://svc.qri.jp/jpx/nkopm/2'
 
+# HTMLパーサーエンジン
+PARSER_PYQUERY = 'pyquery'
+PARSER_LXML = 'lxml'
+
 log = getLogger(__name__)
+config = Config()
+
+# ウォームインスタンスが生きている間使い回すHTTPセッション。
+# JPXへのコネクションを keep-alive で再利用して、TCP/TLSの接続コストを毎回払わないようにする。
+http_session = requests.Session()
 
 
 def load_html_from_file(file_path):
@@ -61,7 +108,7 @@ def load_html_from_web(url):
         'Cache-Control': 'no-cache'
     }
 
-    response = requests.get(url, headers=headers)
+    response = http_session.get(url, headers=headers)
 
     html = response.content
 
@@ -89,7 +136,9 @@ def load_html_from_web(url):
 # 15: セータ
 # 16: ベガ
 # 17: 取引最終日
-def parse_option(option_info):
+#
+# OptionPrice のフィールド順に値を並べたタプルを返します。
+def parse_option_row(option_info):
     # option_infoを順番に走査するためのカーソル
     seq = iter(range(len(option_info)))
 
@@ -202,51 +251,245 @@ def parse_option(option_info):
     last_trading_day_str = option_info[next(seq)]
     last_trading_day = TZ_JST.localize(datetime.strptime(last_trading_day_str, "%Y/%m/%d"))
 
-    option = OptionPrice(
-        type=option_type,
-        target_price=target_price,
-        last_trading_day=last_trading_day,
-        created_at=created_at
+    return (
+        option_type,
+        target_price,
+        is_atm,
+        price,
+        price_time,
+        diff,
+        diff_rate,
+        iv,
+        bid,
+        bid_volume,
+        bid_iv,
+        ask,
+        ask_volume,
+        ask_iv,
+        volume,
+        positions,
+        quotation,
+        quotation_date,
+        delta,
+        gamma,
+        theta,
+        vega,
+        last_trading_day,
+        created_at,
     )
 
-    option.is_atm = is_atm
-    option.price = price
-    option.price_time = price_time
-    option.diff = diff
-    option.diff_rate = diff_rate
-    option.iv = iv
-    option.bid = bid
-    option.bid_volume = bid_volume
-    option.bid_iv = bid_iv
-    option.ask = ask
-    option.ask_volume = ask_volume
-    option.ask_iv = ask_iv
-    option.volume = volume
-    option.positions = positions
-    option.quotation = quotation
-    option.quotation_date = quotation_date
-    option.delta = delta
-    option.gamma = gamma
-    option.theta = theta
-    option.vega = vega
-
-    return option
+
+# オプションに関する情報を解析して OptionPrice を返します。
+# option_info の内容は parse_option_row() と同じ。
+def parse_option(option_info):
+    return OptionPrice(*parse_option_row(option_info))
 
 
-# JPX形式のHTMLを解析しします
-def parse_jpx_html(html):
+# JPXのHTMLから抜き出したテキスト情報を表すデータクラス。
+# パーサーエンジンごとの差異はここまでで吸収し、以降の解析は共通で行う。
+@dataclass
+class JpxHtmlText:
+    # 更新時刻
+    created_at: str
+    # 現物価格の行のセル
+    spot_price_cells: List[str]
+    # 先物価格の行のセル
+    future_price_cells: List[str]
+    # 精算日のヘッダ
+    quotation_date: str
+    # 取引最終日
+    last_trading_day: str
+    # 行使価格ごとの価格, iv etc
+    row_text_list: List[List[str]]
+    # 行使価格ごとのギリシャ指標
+    greeks_text_list: List[List[str]]
+
+
+# PyQuery で JPX形式のHTMLからテキスト情報を抽出します
+def extract_jpx_html_text_pyquery(html):
 
     q = pq(html, parser='html')
 
     # 更新時刻
     created_at_str = q.find('.update-time').find('dd').text()
-    created_at = TZ_JST.localize(datetime.strptime(created_at_str, "%Y/%m/%d %H:%M"))
 
     price_info = q.find('#priceInfo')
 
     # 現物価格情報
     spot_price_web = price_info.find('tr').filter(lambda idx, e: pq(e).find('td').eq(0).text().find('日経平均株価') > -1)
-    spot_price_str = spot_price_web.find('td').eq(1).text().replace(',', '')
+    spot_price_cells = list(spot_price_web.find('td').map(lambda idx, e: pq(e).text()))
+
+    # 先物価格情報
+    future_price_web = price_info.find('tr').filter(lambda idx, e: pq(e).find('td').eq(0).text().find('先物') > -1)
+    future_price_cells = list(future_price_web.find('td').map(lambda idx, e: pq(e).text()))
+
+    # 精算日(SQではない)
+    quotation_date_text = q.find('.price-info-header').find('tr').eq(1).find('th').eq(0).text()
+
+    # 取引最終日
+    last_trading_day_str = q.find('.date-table.last-tradingday').find('dd').text()
+
+    # オプション情報のHTMLからテキストで情報を抽出
+    option_price_info = q.find('.price-info-scroll')
+
+    # 価格, iv etc
+    row_text_list = []
+    option_price_info.find('.row-num').each(lambda idx, e: row_text_list.append(
+        list(pq(e).find('td').map(lambda idx2, e: pq(e).text().strip().replace(',', '')))))
+
+    # ギリシャ指標
+    greeks_text_list = []
+    option_price_info.find(".greek").each(lambda idx, e: greeks_text_list.append(
+        list(pq(e).find('table').find('td').map(lambda idx2, e: pq(e).text().replace(',', '')))))
+
+    return JpxHtmlText(created_at_str, spot_price_cells, future_price_cells, quotation_date_text,
+                       last_trading_day_str, row_text_list, greeks_text_list)
+
+
+# lxml パーサー用のコンパイル済みXPath
+XPATH_CLASSED = etree.XPath('//*[@class]')
+XPATH_PRICE_INFO = etree.XPath('//*[@id="priceInfo"]')
+
+
+# 要素のテキストを PyQuery の extract_text() と同じ規則で取り出します。
+# 子要素が無いセルや <br> だけを含むセルは同じ結果を軽量に組み立て、それ以外は extract_text() に任せます。
+def _lxml_cell_text(e):
+    if len(e) == 0:
+        return squash_html_whitespace(e.text or '').strip()
+
+    if not all(child.tag == 'br' for child in e):
+        return extract_text(e)
+
+    # <br> の間のテキストを改行でつなぐ。空のテキストは捨て、前後の <br> は除去される
+    parts = []
+    for i, segment in enumerate([e.text] + [child.tail for child in e]):
+        if i > 0:
+            parts.append(None)
+
+        segment = squash_html_whitespace(segment or '').strip()
+        if segment:
+            parts.append(segment)
+
+    while parts and parts[0] is None:
+        parts.pop(0)
+
+    while parts and parts[-1] is None:
+        parts.pop()
+
+    return ''.join('\n' if x is None else x for x in parts)
+
+
+# 要素リストのテキストを PyQuery の text() と同じ規則で取り出します
+def _lxml_text(elements):
+    return ' '.join(_lxml_cell_text(e) for e in elements)
+
+
+# リストの index 番目の要素だけを含むリストを返します。範囲外なら空リストを返します。
+def _lxml_eq(elements, index):
+    return elements[index:index + 1]
+
+
+# 要素リストそれぞれの子孫から tag の要素を文書順に集めます
+def _lxml_find(elements, tag):
+    return [child for e in elements for child in e.iter(tag) if child is not e]
+
+
+# lxml で JPX形式のHTMLからテキスト情報を抽出します。
+# 要素ごとに PyQuery オブジェクトを作らず、class属性を持つ要素を1回だけ走査して必要な要素を集めます。
+def extract_jpx_html_text_lxml(html):
+
+    root = lxml.html.fromstring(html)
+
+    # class名ごとの要素(文書順)と、価格情報テーブル内の価格, iv etc の行とギリシャ指標の行
+    classed = {}
+    option_rows = []
+
+    for e in XPATH_CLASSED(root):
+        classes = e.get('class').split()
+
+        for c in classes:
+            classed.setdefault(c, []).append(e)
+
+        if 'row-num' in classes or 'greek' in classes:
+            option_rows.append((e, classes))
+
+    # 更新時刻
+    created_at_str = _lxml_text(_lxml_find(classed.get('update-time', []), 'dd'))
+
+    # 現物価格情報, 先物価格情報
+    spot_price_cells = []
+    future_price_cells = []
+
+    for tr in _lxml_find(XPATH_PRICE_INFO(root), 'tr'):
+        tds = _lxml_find([tr], 'td')
+        label = _lxml_text(_lxml_eq(tds, 0))
+
+        if label.find('日経平均株価') > -1:
+            spot_price_cells.extend(_lxml_cell_text(td) for td in tds)
+
+        if label.find('先物') > -1:
+            future_price_cells.extend(_lxml_cell_text(td) for td in tds)
+
+    # 精算日(SQではない)
+    quotation_date_trs = _lxml_find(classed.get('price-info-header', []), 'tr')
+    quotation_date_ths = _lxml_find(_lxml_eq(quotation_date_trs, 1), 'th')
+    quotation_date_text = _lxml_text(_lxml_eq(quotation_date_ths, 0))
+
+    # 取引最終日
+    last_trading_day_set = set(classed.get('last-tradingday', []))
+    last_trading_days = [e for e in classed.get('date-table', []) if e in last_trading_day_set]
+    last_trading_day_str = _lxml_text(_lxml_find(last_trading_days, 'dd'))
+
+    # 価格, iv etc と ギリシャ指標
+    scrolls = set(classed.get('price-info-scroll', []))
+    row_text_list = []
+    greeks_text_list = []
+
+    for e, classes in option_rows:
+        if not any(ancestor in scrolls for ancestor in e.iterancestors()):
+            continue
+
+        if 'row-num' in classes:
+            row_text_list.append([_lxml_cell_text(td).strip().replace(',', '') for td in _lxml_find([e], 'td')])
+
+        if 'greek' in classes:
+            greeks_td = _lxml_find(_lxml_find([e], 'table'), 'td')
+            greeks_text_list.append([_lxml_cell_text(td).replace(',', '') for td in greeks_td])
+
+    return JpxHtmlText(created_at_str, spot_price_cells, future_price_cells, quotation_date_text,
+                       last_trading_day_str, row_text_list, greeks_text_list)
+
+
+# HTMLパーサーエンジン名と抽出関数の対応
+JPX_HTML_TEXT_EXTRACTORS = {
+    PARSER_PYQUERY: extract_jpx_html_text_pyquery,
+    PARSER_LXML: extract_jpx_html_text_lxml,
+}
+
+
+# セルのリストの index 番目のテキストを返します。範囲外なら空文字を返します。
+def _cell(cells, index):
+    return cells[index] if index < len(cells) else ''
+
+
+# JPX形式のHTMLを解析しします
+# parser: HTMLパーサーエンジン。PARSER_PYQUERY or PARSER_LXML。省略時は Config の設定に従います。
+def parse_jpx_html(html, parser=None):
+
+    if parser is None:
+        parser = config.jpx_html_parser
+
+    if parser not in JPX_HTML_TEXT_EXTRACTORS:
+        raise ValueError(f'unknown jpx html parser: {parser}')
+
+    text = JPX_HTML_TEXT_EXTRACTORS[parser](html)
+
+    # 更新時刻
+    created_at = TZ_JST.localize(datetime.strptime(text.created_at, "%Y/%m/%d %H:%M"))
+
+    # 現物価格情報
+    spot_price_cells = text.spot_price_cells
+    spot_price_str = _cell(spot_price_cells, 1).replace(',', '')
     m = REGEX_PRICE.search(spot_price_str)
     spot_price = None
     spot_price_time = None
@@ -264,13 +507,13 @@ def parse_jpx_html(html):
             # 未来日ということは日マタギなので１日戻しておく
             spot_price_time -= timedelta(days=1)
 
-    spot_price_diff_str = spot_price_web.find('td').eq(2).text()
+    spot_price_diff_str = _cell(spot_price_cells, 2)
     spot_price_diff = float(spot_price_diff_str) if spot_price_diff_str != '-' else None
 
-    spot_price_diff_rate_str = spot_price_web.find('td').eq(3).text().replace('%', '')
+    spot_price_diff_rate_str = _cell(spot_price_cells, 3).replace('%', '')
     spot_price_diff_rate = float(spot_price_diff_rate_str) if spot_price_diff_rate_str != '-' else None
 
-    spot_price_hv_str = spot_price_web.find('td').eq(4).text().replace('%', '')
+    spot_price_hv_str = _cell(spot_price_cells, 4).replace('%', '')
     spot_price_hv = float(spot_price_hv_str) if spot_price_hv_str != '-' else None
 
     spot_price_info = SpotPrice(
@@ -283,8 +526,8 @@ def parse_jpx_html(html):
     )
 
     # 先物価格情報
-    future_price_web = price_info.find('tr').filter(lambda idx, e: pq(e).find('td').eq(0).text().find('先物') > -1)
-    future_price_str = future_price_web.find('td').eq(1).text().replace(',', '')
+    future_price_cells = text.future_price_cells
+    future_price_str = _cell(future_price_cells, 1).replace(',', '')
 
     future_price = None
     future_price_time = None
@@ -302,17 +545,17 @@ def parse_jpx_html(html):
             # 未来日ということは日マタギなので１日戻しておく
             future_price_time -= timedelta(days=1)
 
-    future_price_diff_str = future_price_web.find('td').eq(2).text()
+    future_price_diff_str = _cell(future_price_cells, 2)
     future_price_diff = int(future_price_diff_str) if future_price_diff_str != '-' else None
 
-    future_price_diff_rate_str = future_price_web.find('td').eq(3).text().replace('%', '')
+    future_price_diff_rate_str = _cell(future_price_cells, 3).replace('%', '')
     future_price_diff_rate = float(future_price_diff_rate_str) if future_price_diff_rate_str != '-' else None
 
-    future_price_hv_str = future_price_web.find('td').eq(4).text().replace('%', '')
+    future_price_hv_str = _cell(future_price_cells, 4).replace('%', '')
     future_price_hv = float(future_price_hv_str) if future_price_hv_str != '-' else None
 
     # 先物の限月
-    m = REGEX_CONTRACT_MONTH.search(future_price_web.find('td').eq(0).text())
+    m = REGEX_CONTRACT_MONTH.search(_cell(future_price_cells, 0))
     future_contract_year = int(m.group(1)) + int(created_at.year - created_at.year % 1000)
     future_contract_month = int(m.group(2))
     future_contract_date = TZ_JST.localize(datetime(future_contract_year, future_contract_month, 1))
@@ -331,9 +574,9 @@ def parse_jpx_html(html):
     )
 
     # 精算日(SQではない)
-    quotation_date_text = q.find('.price-info-header').find('tr').eq(1).find('th').eq(0).text()
-    m = re.search(r'(\d+)/(\d+)', quotation_date_text)
-    qd_year = datetime.now().year
+    m = re.search(r'(\d+)/(\d+)', text.quotation_date)
+    # 年はページの更新時刻から取る。保存しておいたHTMLをパースし直す(tools/html_archive_tool.py)ときも正しい年になるように
+    qd_year = created_at.year
     qd_month = int(m.group(1))
     qd_day = int(m.group(2))
     qd = TZ_JST.localize(datetime(qd_year, qd_month, qd_day))
@@ -346,25 +589,16 @@ def parse_jpx_html(html):
     # print('quotation date: {}'.format(quotation_date))
 
     # 取引最終日
-    last_trading_day_str = q.find('.date-table.last-tradingday').find('dd').text()
+    last_trading_day_str = text.last_trading_day
 
     # print('last trading day: {}'.format(last_trading_day_str))
 
-    # オプション情報のHTMLからテキストで情報を抽出
-    option_price_info = q.find('.price-info-scroll')
-
-    # 価格, iv etc
-    row_text_list = []
-    option_price_info.find('.row-num').each(lambda idx, e: row_text_list.append(
-        list(pq(e).find('td').map(lambda idx2, e: pq(e).text().strip().replace(',', '')))))
-
-    # ギリシャ指標
-    greeks_text_list = []
-    option_price_info.find(".greek").each(lambda idx, e: greeks_text_list.append(
-        list(pq(e).find('table').find('td').map(lambda idx2, e: pq(e).text().replace(',', '')))))
+    row_text_list = text.row_text_list
+    greeks_text_list = text.greeks_text_list
 
-    call_option_list = []
-    put_option_list = []
+    # OptionChain に直接詰めるため OptionPrice は作らず、行のタプルを集める
+    call_rows = []
+    put_rows = []
 
     for i in range(len(row_text_list)):
         row = row_text_list[i]
@@ -380,8 +614,7 @@ def parse_jpx_html(html):
         call_info.extend(greeks[:4])
         call_info.append(last_trading_day_str)
 
-        call_option = parse_option(call_info)
-        call_option_list.append(call_option)
+        call_rows.append(parse_option_row(call_info))
 
         put_info = [created_at, OptionType.PUT, target_price, is_atm]
         put_info.extend(row[-8:])
@@ -389,14 +622,46 @@ def parse_jpx_html(html):
         put_info.extend(greeks[-4:])
         put_info.append(last_trading_day_str)
 
-        put_option = parse_option(put_info)
-        put_option_list.append(put_option)
+        put_rows.append(parse_option_row(put_info))
+
+    # CALL, PUT の順に連続して詰める
+    option_chain = OptionChain.from_rows(call_rows + put_rows)
 
-    result = JpxOptionPriceInfo(spot_price_info, future_price_info, call_option_list, put_option_list, created_at)
+    result = JpxOptionPriceInfo(spot_price_info, future_price_info, option_chain, created_at, html)
 
     return result
 
 
+# 現物価格・先物価格のテーブル(#priceInfo)の部分のHTMLを、パースせずに文字列の検索だけで切り出します。
+# 見つからなければ None を返します。
+def extract_price_info_fragment(html):
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+
+    start = html.find(b'id="priceInfo"')
+
+    if start < 0:
+        return None
+
+    end = html.find(b'</table>', start)
+
+    if end < 0:
+        return None
+
+    return html[start:end]
+
+
+# 現物価格・先物価格のテーブルの部分のハッシュを返します。前回から値が動いたかどうかの判定に使います。
+# テーブルが見つからない場合はHTML全体のハッシュを返します。(更新時刻が変わるので、毎回動いたと判定されます)
+def price_info_digest(html):
+    fragment = extract_price_info_fragment(html)
+
+    if fragment is None:
+        fragment = html.encode('utf-8') if isinstance(html, str) else html
+
+    return hashlib.sha1(fragment).hexdigest()
+
+
 # 直近 1限月の価格情報を取得します
 def load_jpx_nearby_month():
     html = load_html_from_web(JPX_URL_NEARBY_1ST)
@@ -413,3 +678,15 @@ def load_jpx_nearby_month_2nd():
 def load_jpx_nearby_month_3rd():
     html = load_html_from_web(JPX_URL_NEARBY_3RD)
     return parse_jpx_html(html)
+
+
+# 次限月と次次限月の価格情報を並行して取得します。
+# (2限月, 3限月) のタプルを返します。
+def load_jpx_nearby_month_2nd_and_3rd():
+    loaders = [load_jpx_nearby_month_2nd, load_jpx_nearby_month_3rd]
+
+    with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+        futures = [executor.submit(loader) for loader in loaders]
+        jpx2, jpx3 = [f.result() for f in futures]
+
+    return jpx2, jpx3
@@ -1,22 +1,22 @@
 import base64
 import gzip
 import re
+import time
 
 from dataclasses import asdict
 from datetime import datetime
 
 # 3rd party modules
-import pandas as pd
-
 from flask import make_response
-from google.cloud import bigquery
-from google.cloud import datastore
-from google.cloud import storage
 from pytz import timezone
 
 # my modules
-import config, jpx_loader, optionchan_dao as od
+# BigQuery, pandas, pyarrow, pyquery などの読み込みに時間がかかるものは、使うエントリポイントの中で読み込む。
+# エントリポイントごとに必要なものだけ読み込んで、コールドスタートを短くするため。
+# (tools/coldstart.py で計測できます)
+import clients, config, market_calendar, price_file
 from my_logging import getLogger
+from query_cache import QueryCache
 
 log = getLogger(__name__)
 config = config.Config()
@@ -28,40 +28,51 @@ with open('auth.txt', 'r') as f:
 TZ_JST = timezone('Asia/Tokyo')
 TZ_UTC = timezone('UTC')
 
+# 時間足の時間枠(秒)。timeframe の rollup_ohlc が作るもの
+TIME_FRAMES = ['300', '900', '3600', '86400']
+
 # 価格情報を格納するGCS上のファイル名のパターン
-REGEX_PRICE_FILE = re.compile(r'((?:spot|future|option)_price)_\d+.json.gz')
+REGEX_PRICE_FILE = re.compile(r'((?:spot|future|option|atm)_price)_\d+(?:\.json\.gz|\.parquet)')
+
+# 表示用のCSVのキャッシュ。インスタンスがウォームな間は使い回す。
+# キーは (エンドポイント, パラメータ, CSVを作ったデータのバージョン(created_at))
+query_cache = QueryCache(config.query_cache_max_size, config.query_cache_ttl_seconds)
+
+# 前回確認した直近限月のページの現物価格・先物価格のテーブルのハッシュ。
+# インスタンスがウォームな間は、これが変わっていなければページをパースせず、Cloud Datastore も読まない
+_last_price_info_digest = None
+
+# スマイルカーブ用のCSVの取引時刻の列
+SMILE_CSV_PRICE_TIME_COLUMNS = ['o1_call_price_time', 'o1_put_price_time', 'o2_call_price_time', 'o2_put_price_time']
+
+# スマイルカーブ用のCSVの列
+SMILE_CSV_COLUMNS = ['target_price',
+                     'o1_call_iv', 'o1_call_price_time', 'o1_put_iv', 'o1_put_price_time',
+                     'o2_call_iv', 'o2_call_price_time', 'o2_put_iv', 'o2_put_price_time']
 
 
 # entry point of Cloud Functions
 # trigger = http
 # スマイルカーブ用のデータをCSVで返す
 def smile_data(request):
+    import bq_query
+    import optionchan_dao as od
 
     if not check_auth(request):
         return 'Forbidden', 403
 
     future = od.find_latest_future_price()
-    df = od.find_option_price_by_created_at(future.created_at)
 
-    log.debug(f'number of matched options: {len(df)}')
+    if future is None:
+        # まだ一度も取り込んでいない
+        return 'Service Unavailable', 503
 
-    # ATMの行使価格を検索
-    o1_atm = df[df['o1_put_is_atm'] == True]['target_price'].iloc[0]
-
-    # 不要カラム削除
-    df = df.drop(['o1_put_is_atm', 'o2_put_is_atm'], axis=1)
-
-    # 取引時刻カラムの日付は native JST なのでタイムゾーンを付加してからUnixtimeに変換
-    def apply_tz(x):
-        return int(x.tz_localize(TZ_JST).timestamp()) if not pd.isnull(x) else x
-    df['o1_call_price_time'] = df['o1_call_price_time'].apply(apply_tz, )
-    df['o2_call_price_time'] = df['o2_call_price_time'].apply(apply_tz)
-    df['o1_put_price_time'] = df['o1_put_price_time'].apply(apply_tz)
-    df['o2_put_price_time'] = df['o2_put_price_time'].apply(apply_tz)
-
-    # CSV化
-    line1 = f'{int(future.created_at.timestamp())},{o1_atm}\n'
-    option_list_csv = line1 + df.to_csv(index=False, header=False)
+    try:
+        option_list_csv = load_smile_csv(future)
+    except bq_query.QueryBudgetExceededError as e:
+        # パラメータは無いので、データの量が想定を超えている。リクエストを変えても通らない
+        log.warning(str(e))
+        return 'Service Unavailable', 503
 
     res = make_response(option_list_csv, 200)
     res.headers['Content-type'] = 'text/csv; charset=utf-8'
@@ -72,30 +83,138 @@ def smile_data(request):
 # trigger = http
 # ATM IV推移用のデータをCSVで返す
 def atm_data(request):
+    import bq_query
+    import optionchan_dao as od
 
     if not check_auth(request):
         return 'Forbidden', 403
 
-    today = datetime.now(TZ_JST)
+    time_frame = request.args.get('tf', default='300')
 
-    df = od.find_recent_iv_and_price_of_atm_options(today)
-    log.debug(f'number of matched record: {len(df)}')
+    if time_frame not in TIME_FRAMES:
+        return 'Bad Request', 400
 
-    latest_created_at_str = str(df['time'].iloc[-1])
+    future = od.find_latest_future_price()
 
-    # CSV化
-    line1 = f'{latest_created_at_str}\n'
-    option_list_csv = line1 + df.to_csv(index=False, header=False)
+    # 時間足は BigQuery にロード済みの atm_price から作られるので、ロード済みの created_at をバージョンにする
+    version = find_loaded_created_at('atm_price', future)
+
+    try:
+        option_list_csv = load_csv_with_cache(('atm_data', (time_frame,)), version, lambda: create_atm_csv(time_frame))
+    except bq_query.QueryBudgetExceededError as e:
+        # tf は選べるものだけなので、データの量が想定を超えている
+        log.warning(str(e))
+        return 'Service Unavailable', 503
 
     res = make_response(option_list_csv, 200)
     res.headers['Content-type'] = 'text/csv; charset=utf-8'
     return res
 
 
+# キャッシュがあればそれを、無ければ create_csv() で作ったCSVを返します。
+# version: CSVを作るデータのバージョン(created_at)。キーに含める。None ならばキャッシュしない
+def load_csv_with_cache(key, version, create_csv):
+    if version is None:
+        return create_csv()
+
+    csv, is_hit = query_cache.get_or_load(key + (version,), create_csv)
+    log.debug(f'query cache {"hit" if is_hit else "miss"}: key={key}, created_at={version.isoformat()}')
+
+    return csv
+
+
+# BigQuery にロード済みの table_name の最後の created_at を返します。
+# 最新の先物価格より新しいものは返しません。ロードの記録が無ければ最新の先物価格の created_at を返します。
+# future: 最新の先物価格。まだ一度も取り込んでいなければ None
+def find_loaded_created_at(table_name, future):
+    import bq_loader
+
+    if future is None:
+        return None
+
+    loaded_created_at = bq_loader.find_loaded_created_at(table_name)
+
+    if loaded_created_at is None:
+        return future.created_at
+
+    return min(loaded_created_at, future.created_at)
+
+
+# スマイルカーブ用のCSVをロードします。
+# download_jpx が作っておいたものがあれば、最新の created_at のものとしてそれを返します。
+# 無ければ BigQuery にロード済みの created_at のスナップショットから作ったものを返します。
+# 先物価格の created_at は BigQuery へのロードより先に進むので、それで作ると古い行を新しい時刻のものとして返してしまうため
+def load_smile_csv(future):
+    import smile
+
+    key = ('smile_data', ())
+    smile_csv = query_cache.get(key + (future.created_at,))
+
+    if smile_csv is not None:
+        log.debug(f'query cache hit: key={key}, created_at={future.created_at.isoformat()}')
+        return smile_csv
+
+    smile_csv = smile.download_smile_csv(future.created_at)
+
+    if smile_csv is not None:
+        query_cache.put(key + (future.created_at,), smile_csv)
+        return smile_csv
+
+    created_at = find_loaded_created_at('option_price', future)
+    log.debug(f'smile csv is not found. querying..: created_at={created_at.isoformat()}')
+
+    return load_csv_with_cache(key, created_at, lambda: query_smile_csv(created_at))
+
+
+# created_at のスナップショットのスマイルカーブ用のCSVを BigQuery から作ります
+def query_smile_csv(created_at):
+    import pyarrow.compute as pc
+    import arrow_csv
+    import optionchan_dao as od
+
+    table = od.find_option_price_by_created_at(created_at)
+
+    log.debug(f'number of matched options: {table.num_rows}')
+
+    # ATMの行使価格を検索
+    o1_atm = table.filter(pc.equal(table['o1_put_is_atm'], True))['target_price'][0].as_py()
+
+    # 不要カラム削除
+    table = table.select(SMILE_CSV_COLUMNS)
+
+    # 取引時刻カラムの日付は native JST なのでタイムゾーンのオフセットを引いてからUnixtimeにする
+    def to_epoch(array):
+        return arrow_csv.datetime_to_epoch(array, arrow_csv.JST_OFFSET_SECONDS)
+    converters = {name: to_epoch for name in SMILE_CSV_PRICE_TIME_COLUMNS}
+
+    # CSV化
+    line1 = f'{int(created_at.timestamp())},{o1_atm}\n'
+    return line1 + ''.join(arrow_csv.iter_csv(table.to_batches(), converters))
+
+
+# ATM IV推移用のCSVを作ります
+def create_atm_csv(time_frame):
+    import arrow_csv
+    import optionchan_dao as od
+
+    today = datetime.now(TZ_JST)
+
+    table = od.find_recent_iv_and_price_of_atm_options(today, time_frame)
+    log.debug(f'number of matched record: {table.num_rows}')
+
+    latest_created_at_str = str(table['time'][table.num_rows - 1])
+
+    # CSV化
+    line1 = f'{latest_created_at_str}\n'
+    return line1 + ''.join(arrow_csv.iter_csv(table.to_batches()))
+
+
 # entry point of Cloud Functions
 # trigger = bucket
 # filename format: <tablename>_yyyymmddhhmmssSSS.json
 def load_jpx_into_bq(data, context):
+    import bq_loader
+
     event_type = context.event_type
 
     if event_type != 'google.storage.object.finalize':
@@ -117,7 +236,23 @@ def load_jpx_into_bq(data, context):
     table_name = m.groups()[0]
     log.debug('table_name: {}'.format(table_name))
 
-    json_on_gcs_into_bq(bucket, name, table_name)
+    if config.bq_load_batch_size <= 1:
+        # smile_data, atm_data がロード済みのデータのバージョンとして読むので、ロードが終わったときだけ進める
+        if json_on_gcs_into_bq(bucket, name, table_name):
+            bq_loader.update_watermark(table_name, name)
+        return
+
+    # 個数が揃ったバッチがあればロードする。時間枠が終わったバッチは flush_jpx_into_bq がロードする
+    bq_loader.flush_table(table_name)
+
+
+# entry point of Cloud Functions
+# trigger = pubsub
+# 数分おきに呼ばれて、時間枠が終わったバッチを BigQuery にロードする
+def flush_jpx_into_bq(data, context):
+    import bq_loader
+
+    bq_loader.flush_all_tables()
 
 
 # entry point of Cloud Functions
@@ -131,8 +266,43 @@ def download_jpx(data, context):
 
     log.debug('topice received: topic={}!'.format(topic))
 
+    # 取引セッション外ならば、JPXのページを取りに行く前に終わる
+    started = time.monotonic()
+    polls = market_calendar.polls_for(datetime.now(TZ_UTC))
+
+    if polls == 0:
+        log.debug('out of trading sessions. skipping..')
+        return
+
+    # 寄付き・引けの前後は1分の間に等間隔で複数回取り込む
+    for i in range(polls):
+        wait_seconds = started + 60 * i / polls - time.monotonic()
+
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+        ingest_jpx()
+
+
+# JPXから全限月の価格情報をDLして、前回から値が動いていれば Cloud Storage へアップロードします
+def ingest_jpx():
+    global _last_price_info_digest
+
+    import numpy as np
+    import contract_calendar, html_archive, jpx_loader, option_delta, option_pricing, smile
+    from option_chain import OptionChain
+
     # 1限月をDL
-    jpx1 = jpx_loader.load_jpx_nearby_month()
+    html = jpx_loader.load_html_from_web(jpx_loader.JPX_URL_NEARBY_1ST)
+
+    # 現物価格・先物価格のテーブルが前回確認したときのままならば、パースする前に処理スキップ
+    price_info_digest = jpx_loader.price_info_digest(html)
+
+    if config.jpx_price_info_precheck and price_info_digest == _last_price_info_digest:
+        log.debug('price info is not changed. skipping..')
+        return
+
+    jpx1 = jpx_loader.parse_jpx_html(html)
 
     created_at = jpx1.created_at
 
@@ -147,44 +317,105 @@ def download_jpx(data, context):
 
         log.debug('future_price is not changed. '
                   f'skipping..: price_time={log_price_time}')
+        _last_price_info_digest = price_info_digest
         return
 
-    # 2限月をDL
-    jpx2 = jpx_loader.load_jpx_nearby_month_2nd()
+    # 2限月と3限月を並行してDL
+    jpx2, jpx3 = jpx_loader.load_jpx_nearby_month_2nd_and_3rd()
 
     # created_at は1限月にDLしたものに統一する
-    # 1限月、２限月合わせてとある時刻のスナップショットとして扱うため
-    for op in jpx2.call_option_list:
-        op.created_at = created_at
+    # 全限月合わせてとある時刻のスナップショットとして扱うため
+    for jpx in (jpx2, jpx3):
+        jpx.option_chain.fill('created_at', created_at)
 
-    for op in jpx2.put_option_list:
-        op.created_at = created_at
+    # 前回から変わった行を判定するためのフィンガープリントは、JPXから取れた値だけで作る。
+    # 理論値で埋めた値は満期までの期間が縮むので毎分変わってしまうため
+    if config.delta_ingestion:
+        fingerprints = [option_delta.row_fingerprints(jpx.option_chain) for jpx in (jpx1, jpx2, jpx3)]
 
-    # JSON化
-    spot_price_json = jpx1.spot_price.to_json()
-    future_price_json = jpx1.future_price.to_json()
+    # IV, グリークスの欠損を理論値で埋める。各限月のページの先物価格を原資産とする
+    if config.fill_missing_iv_and_greeks:
+        for jpx in (jpx1, jpx2, jpx3):
+            option_pricing.fill_missing_iv_and_greeks(jpx.option_chain, jpx.future_price.price, config.risk_free_rate)
 
-    option_price_json = '\n'.join(map(lambda x: x.to_json(), jpx1.call_option_list))
-    option_price_json += '\n'
-    option_price_json += '\n'.join(map(lambda x: x.to_json(), jpx1.put_option_list))
-    option_price_json += '\n'
-    option_price_json += '\n'.join(map(lambda x: x.to_json(), jpx2.call_option_list))
-    option_price_json += '\n'
-    option_price_json += '\n'.join(map(lambda x: x.to_json(), jpx2.put_option_list))
+    option_chain = OptionChain.concat([jpx1.option_chain, jpx2.option_chain, jpx3.option_chain])
 
-    # Cloud Storageへアップロード
-    suffix = created_at.strftime('%Y%m%d%H%M%S')
+    # 新しい限月が出てきたら限月カレンダーを更新する
+    contract_calendar.update_if_changed(contract_calendar.last_trading_days_of(option_chain))
+
+    # 前回から変わった行だけを保存する
+    if config.delta_ingestion:
+        option_chain, is_keyframe, delta_state = option_delta.select_rows_to_store(
+            option_chain, created_at, option_delta.load_state(), np.concatenate(fingerprints))
+        log.debug(f'option rows to store: {len(option_chain)}, is_keyframe={is_keyframe}')
+
+    # 限月ごとのATMは、ATMの推移を読むときに option_price をスキャンしないで済むように別のテーブルにも入れる
+    atm_price_list = [atm_price for atm_price in (jpx.atm_price() for jpx in (jpx1, jpx2, jpx3))
+                      if atm_price is not None]
+
+    upload_price_files(created_at.strftime('%Y%m%d%H%M%S'),
+                       jpx1.spot_price, jpx1.future_price, option_chain, atm_price_list)
+
+    if config.delta_ingestion:
+        option_delta.save_state(delta_state)
+
+    # スマイルカーブ用のCSVは smile_data がそのまま返せるように作っておく。
+    # 無くても smile_data は BigQuery から作れるので、失敗しても価格情報の取り込みは止めない
+    try:
+        smile_csv = smile.create_smile_csv(created_at, jpx1.option_chain, jpx2.option_chain)
+        smile.upload_smile_csv(created_at, smile_csv)
+    except Exception as e:
+        log.error(f'failed to create smile csv: created_at={created_at.isoformat()}, error={e}')
+
+    # パーサーを直したときに作り直せるように、元のHTMLを保存しておく。
+    # 控えなので、失敗しても価格情報の取り込みは止めない
+    if config.html_archive_enabled:
+        try:
+            html_archive.archive_pages(created_at, [jpx.html for jpx in (jpx1, jpx2, jpx3)])
+        except Exception as e:
+            log.error(f'failed to archive html: created_at={created_at.isoformat()}, error={e}')
+
+    # 最後まで取り込めたときだけ記録する。途中で失敗したら次回にもう一度パースするように
+    _last_price_info_digest = price_info_digest
+
+
+# 価格情報を Config.price_file_format のフォーマットで Cloud Storage へアップロード
+def upload_price_files(suffix, spot_price, future_price, option_chain, atm_price_list):
+    import models
+
+    if config.price_file_format == price_file.FORMAT_PARQUET:
+        import price_parquet
+
+        # Parquet は列ごとに圧縮されているので、そのままアップロードする
+        upload_to_gcs_from_bytes(price_parquet.models_to_parquet('spot_price', [spot_price]),
+                                 f'spot_price_{suffix}.parquet')
+        upload_to_gcs_from_bytes(price_parquet.models_to_parquet('future_price', [future_price]),
+                                 f'future_price_{suffix}.parquet')
+        upload_to_gcs_from_bytes(price_parquet.option_chain_to_parquet(option_chain),
+                                 f'option_price_{suffix}.parquet')
+        upload_to_gcs_from_bytes(price_parquet.models_to_parquet('atm_price', atm_price_list),
+                                 f'atm_price_{suffix}.parquet')
+        return
 
+    # JSON化
+    spot_price_json = models.to_ndjson([spot_price])
+    future_price_json = models.to_ndjson([future_price])
+    option_price_json = option_chain.to_ndjson()
+    atm_price_json = models.to_ndjson(atm_price_list)
+
+    # Cloud Storageへアップロード
     upload_to_gcs_from_string(spot_price_json, 'spot_price_{}.json'.format(suffix))
     upload_to_gcs_from_string(future_price_json, 'future_price_{}.json'.format(suffix))
     upload_to_gcs_from_string(option_price_json, 'option_price_{}.json'.format(suffix))
+    upload_to_gcs_from_string(atm_price_json, 'atm_price_{}.json'.format(suffix))
 
 
 # Cloud Storage へアップロード
 # コンテンツはgzip圧縮して、.gz を末尾に付加したファイル名でアップロードします。
+# バケットはメタデータを取得せずに参照だけ作る。アップロードごとにAPIを呼ばないように
 def upload_to_gcs_from_string(data, filename):
-    client = storage.Client()
-    bucket = client.get_bucket(config.gcp_cs_bucket_name)
+    client = clients.storage_client()
+    bucket = client.bucket(config.gcp_cs_bucket_name)
 
     gzipped_data = gzip.compress(data.encode('utf-8'))
     file_blob = bucket.blob('{}.gz'.format(filename))
@@ -192,11 +423,22 @@ def upload_to_gcs_from_string(data, filename):
     file_blob.upload_from_string(gzipped_data, content_type='application/json')
 
 
+# Cloud Storage へバイト列をそのままアップロード
+def upload_to_gcs_from_bytes(data, filename, content_type='application/octet-stream'):
+    client = clients.storage_client()
+    bucket = client.bucket(config.gcp_cs_bucket_name)
+
+    file_blob = bucket.blob(filename)
+    file_blob.upload_from_string(data, content_type=content_type)
+
+
 # 先物の最新取引時刻が前回のものより新しければ保存します。
 # 新しかった場合は True を返します。
 # future_price は aware を渡して。
 def update_prev_future_price_if_changed(future_price):
-    client = datastore.Client()
+    from google.cloud import datastore
+
+    client = clients.datastore_client()
 
     with client.transaction():
         key = client.key(config.gcp_ds_kind, config.gcp_ds_key_id)
@@ -222,11 +464,17 @@ def update_prev_future_price_if_changed(future_price):
     return True
 
 
+# GCS上の価格情報ファイルを BigQuery にロードします。
+# 戻り値: ロードが終わったかどうか。bq_load_wait_timeout_seconds 以内に終わらなければ False
 def json_on_gcs_into_bq(bucket_name, file_name, table_name):
+    import concurrent.futures
+
+    from google.cloud import bigquery
+    import bq_query
 
     uri = 'gs://%s/%s' % (bucket_name, file_name)
 
-    client = bigquery.Client()
+    client = clients.bigquery_client()
 
     table_fqn = '{}.{}.{}'.format(config.gcp_project_id, config.gcp_bq_dataset_name, table_name)
 
@@ -236,7 +484,7 @@ def json_on_gcs_into_bq(bucket_name, file_name, table_name):
     job_config = bigquery.LoadJobConfig()
     job_config.autodetect = False
     job_config.create_disposition = 'CREATE_NEVER'
-    job_config.source_format = 'NEWLINE_DELIMITED_JSON'
+    job_config.source_format = price_file.source_format_of(file_name)
 
     try:
         load_job = client.load_table_from_uri(uri, table_fqn, job_config=job_config)
@@ -245,6 +493,17 @@ def json_on_gcs_into_bq(bucket_name, file_name, table_name):
         log.error('Failed to create load job: {}'.format(e))
         raise e
 
+    # ロードが終わるのを待つ。ロード済みの位置(bq_loader の watermark)を、行が読めるようになってから進めるため。
+    # 1ファイルのロードは数秒で終わるが、関数のタイムアウトで落ちないように bq_load_wait_timeout_seconds で待つのをやめる
+    try:
+        bq_query.wait_job(load_job, 'load_jpx_into_bq', timeout=config.bq_load_wait_timeout_seconds)
+    except concurrent.futures.TimeoutError:
+        # ジョブはそのまま続く。ロード済みの位置は次のファイルのロードが終わったときに進む
+        log.warning(f'load job is still running. gave up waiting: job_id={load_job.job_id}, file={file_name}')
+        return False
+
+    return True
+
 
 def check_auth(request):
     auth_header = request.headers.get("Authorization")
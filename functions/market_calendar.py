@@ -0,0 +1,117 @@
+"""
+JPX のデリバティブ取引のセッション(日中・夜間)のカレンダーから、download_jpx を実行するかどうかを決めるモジュールです。
+download_jpx は毎分呼ばれますが、セッション外(夜間セッション終了後の早朝、土日、年末年始、休業日)は
+JPXのページを取りに行く前に終わらせます。判定は現在時刻と Config だけで行い、ネットワークには出ません。
+
+夜間セッションは営業日の夕方に始まって翌朝に終わり、翌営業日の取引として扱われます。
+そのため金曜日の夜間セッションは土曜日の朝まで続きます。大納会の日は夜間セッションがありません。
+セッションの始まり・終わりの前後(寄付き・引け)は1回の呼び出しで複数回取り込みます。SQ日は寄付き後も長めに増やします。
+"""
+
+from datetime import datetime, timedelta, time
+
+from pytz import timezone
+
+from config import Config
+
+config = Config()
+
+TZ_JST = timezone('Asia/Tokyo')
+
+# 年末年始の休業日 (月, 日)
+YEAR_END_HOLIDAYS = [(12, 31), (1, 1), (1, 2), (1, 3)]
+
+
+def _parse_time(hhmm):
+    hour, minute = hhmm.split(':')
+    return time(int(hour), int(minute))
+
+
+# 営業日かどうか。date は JST の日付
+def is_business_day(date):
+    if date.weekday() >= 5:
+        return False
+
+    if (date.month, date.day) in YEAR_END_HOLIDAYS:
+        return False
+
+    return date.isoformat() not in config.market_closed_dates
+
+
+# date の次の営業日を返します
+def next_business_day(date):
+    date = date + timedelta(days=1)
+
+    while not is_business_day(date):
+        date = date + timedelta(days=1)
+
+    return date
+
+
+# SQ日(毎月第2金曜日)かどうか。SQ日が休業日の場合のずれは考慮しない
+def is_sq_day(date):
+    return date.weekday() == 4 and 8 <= date.day <= 14
+
+
+# date(JST)の夕方に始まるものも含めて、date に始まるセッションの (始まり, 終わり) のリストを返します。
+# 時刻は aware な datetime
+def sessions_starting_on(date):
+    if not is_business_day(date):
+        return []
+
+    day_open, day_close = (_parse_time(t) for t in config.market_day_session)
+    night_open, night_close = (_parse_time(t) for t in config.market_night_session)
+
+    sessions = [(TZ_JST.localize(datetime.combine(date, day_open)), TZ_JST.localize(datetime.combine(date, day_close)))]
+
+    # 大納会の日は夜間セッションが無い
+    if next_business_day(date).year == date.year:
+        sessions.append((TZ_JST.localize(datetime.combine(date, night_open)),
+                         TZ_JST.localize(datetime.combine(date + timedelta(days=1), night_close))))
+
+    return sessions
+
+
+# now を含むセッションの (始まり, 終わり) を返します。
+# セッションの前後 market_session_margin_before_minutes, market_session_margin_after_minutes 分もセッションに含めます。
+# 板寄せ前の気配と、遅れて反映される引けの値を取り込むため。セッション外ならば None を返します。
+def find_session(now):
+    now = now.astimezone(TZ_JST)
+    margin_before = timedelta(minutes=config.market_session_margin_before_minutes)
+    margin_after = timedelta(minutes=config.market_session_margin_after_minutes)
+
+    # 前日の夕方に始まった夜間セッションの途中かもしれないので、前日からみる
+    for date in (now.date() - timedelta(days=1), now.date()):
+        for start, end in sessions_starting_on(date):
+            if start - margin_before <= now <= end + margin_after:
+                return start, end
+
+    return None
+
+
+# 今回の呼び出しで取り込む回数を返します。0 ならば取り込みません。
+# now: 呼び出された時刻(aware)。毎分呼ばれる前提
+def polls_for(now):
+    if not config.market_schedule_enabled:
+        return 1
+
+    session = find_session(now)
+
+    if session is None:
+        return 0
+
+    start, end = session
+    boost = timedelta(minutes=config.ingest_boost_minutes)
+    open_boost = boost
+
+    # SQ日の日中セッションは、寄付きでSQ値が決まって限月が切り替わるので、寄付き後も長めに回数を増やす
+    if is_sq_day(start.date()) and start.time() == _parse_time(config.market_day_session[0]):
+        open_boost = timedelta(minutes=config.ingest_sq_boost_minutes)
+
+    # 寄付き・引けの前後は回数を増やす
+    if start - boost <= now <= start + open_boost or abs(now - end) <= boost:
+        return config.ingest_boost_polls_per_minute
+
+    # それ以外は ingest_interval_minutes 分おき
+    minutes = int((now - start).total_seconds()) // 60
+    return 1 if minutes % config.ingest_interval_minutes == 0 else 0
@@ -1,3 +1,6 @@
+import dataclasses
+import json
+
 from enum import Enum
 from dataclasses import dataclass, field
 
@@ -143,3 +146,68 @@ class OptionPrice:
     vega: float = None
     last_trading_day: datetime = field(default=None, metadata=date_field_metadata)
     created_at: datetime = field(default=None, metadata=timestamp_field_metadata)
+
+
+# 限月ごとのATMの価格。スナップショットごとに限月の数だけ作る。
+# ATMのIVや価格の推移を読むときに option_price の全行使価格をスキャンしないで済むようにするため。
+@dataclass_json
+@dataclass
+class AtmPrice:
+    target_price: int = None
+    iv: float = None
+    price: int = None
+    future_price: float = None
+    last_trading_day: datetime = field(default=None, metadata=date_field_metadata)
+    created_at: datetime = field(default=None, metadata=timestamp_field_metadata)
+
+
+# クラスごとの一括シリアライズ用フィールドプラン。(フィールド名, エンコーダ) のリスト。
+# dataclasses_json の metadata からエンコーダを1回だけ取り出してキャッシュしておく。
+_field_plans = {}
+
+
+def _field_plan(cls):
+    plan = _field_plans.get(cls)
+
+    if plan is None:
+        plan = [(f.name, f.metadata.get('dataclasses_json', {}).get('encoder')) for f in dataclasses.fields(cls)]
+        _field_plans[cls] = plan
+
+    return plan
+
+
+# SpotPrice, FuturePrice, OptionPrice, AtmPrice のリストを改行区切りJSON(NDJSON)に一括でシリアライズします。
+# 各行は to_json() と同じ文字列になります。
+# 1スナップショット内では created_at や last_trading_day などの日時は同じ値が並ぶので、
+# エンコード結果を値ごとにキャッシュして astimezone や isoformat の呼び出しを省きます。
+def to_ndjson(objs):
+    # (クラス, フィールド名) -> {値: エンコード結果}
+    encoded_cache = {}
+    lines = []
+
+    for obj in objs:
+        cls = type(obj)
+        values = obj.__dict__
+        row = {}
+
+        for name, encoder in _field_plan(cls):
+            value = values[name]
+
+            if encoder is not None:
+                cache = encoded_cache.get((cls, name))
+                if cache is None:
+                    cache = encoded_cache[(cls, name)] = {}
+
+                # 同時刻でもタイムゾーンが違えば isoformat の結果が変わるので tzinfo もキーに含める
+                key = (value, getattr(value, 'tzinfo', None))
+
+                if key in cache:
+                    value = cache[key]
+                else:
+                    value = cache[key] = encoder(value)
+
+            row[name] = value
+
+        lines.append(json.dumps(row))
+
+    return '\n'.join(lines)
@@ -0,0 +1,233 @@
+"""
+1スナップショット分のオプション価格を列指向で保持するためのモジュールです。
+OptionPrice のインスタンスを行使価格ごとに作る代わりに、フィールドごとに1本の NumPy 配列を持ちます。
+"""
+
+import dataclasses
+import json
+
+from datetime import datetime
+
+import numpy as np
+
+from models import OptionPrice, OptionType, TZ_JST, \
+    timestamp_field_metadata, datetime_field_metadata, date_field_metadata, option_type_field_metadata
+
+# 列の種類
+KIND_INT = 'int'
+KIND_FLOAT = 'float'
+KIND_BOOL = 'bool'
+KIND_OPTION_TYPE = 'option_type'
+KIND_TIMESTAMP = 'timestamp'
+KIND_DATETIME = 'datetime'
+KIND_DATE = 'date'
+
+# 列の種類ごとの NumPy の型
+KIND_DTYPES = {
+    KIND_INT: np.int64,
+    KIND_FLOAT: np.float64,
+    KIND_BOOL: np.bool_,
+    KIND_OPTION_TYPE: np.int8,
+    KIND_TIMESTAMP: 'datetime64[s]',
+    KIND_DATETIME: 'datetime64[s]',
+    KIND_DATE: 'datetime64[s]',
+}
+
+# 日時の列。UTCのエポック秒として datetime64[s] で保持する
+DATETIME_KINDS = (KIND_TIMESTAMP, KIND_DATETIME, KIND_DATE)
+
+# BigQueryのDATETIME型, DATE型はJSTに決め打ちで変換する(models の encoder と同じ)
+JST_OFFSET = np.timedelta64(9, 'h')
+
+
+# OptionPrice のフィールド定義から列の種類を決めます
+def _column_kind(f):
+    # dataclasses が metadata を読み取り専用のプロキシで包むので、中身の辞書で比較する
+    metadata = f.metadata.get('dataclasses_json')
+
+    if metadata is option_type_field_metadata['dataclasses_json']:
+        return KIND_OPTION_TYPE
+    if metadata is timestamp_field_metadata['dataclasses_json']:
+        return KIND_TIMESTAMP
+    if metadata is datetime_field_metadata['dataclasses_json']:
+        return KIND_DATETIME
+    if metadata is date_field_metadata['dataclasses_json']:
+        return KIND_DATE
+    if f.type is bool:
+        return KIND_BOOL
+    if f.type is int:
+        return KIND_INT
+    if f.type is float:
+        return KIND_FLOAT
+
+    raise TypeError(f'unsupported field: {f.name}: {f.type}')
+
+
+# 列の定義。(フィールド名, 列の種類) を OptionPrice のフィールド順に並べたもの
+OPTION_CHAIN_COLUMNS = [(f.name, _column_kind(f)) for f in dataclasses.fields(OptionPrice)]
+OPTION_CHAIN_COLUMN_NAMES = [name for name, _ in OPTION_CHAIN_COLUMNS]
+OPTION_CHAIN_COLUMN_KINDS = dict(OPTION_CHAIN_COLUMNS)
+
+
+# 値を列に格納する形に変換します
+def _to_column_value(value, kind):
+    if kind == KIND_OPTION_TYPE:
+        return value.value
+    if kind in DATETIME_KINDS:
+        return int(value.timestamp())
+    return value
+
+
+# 列に格納された値を OptionPrice のフィールドの値に戻します
+def _from_column_value(value, kind):
+    if kind == KIND_OPTION_TYPE:
+        return OptionType(value)
+    if kind in DATETIME_KINDS:
+        return datetime.fromtimestamp(value.astype(np.int64).item(), TZ_JST)
+    return value.item()
+
+
+# 1スナップショット分のオプション価格を列指向で保持するクラス。
+# columns: フィールド名 -> 値の配列。欠損している箇所の値は不定(0 or NaT)。
+# masks: フィールド名 -> 値が存在するかどうかの bool 配列。
+# 日時はUTCのエポック秒で保持し、OptionPrice に戻すときはJSTの aware な datetime にします。
+class OptionChain:
+
+    def __init__(self, columns, masks):
+        self.columns = columns
+        self.masks = masks
+
+    def __len__(self):
+        return len(self.columns['target_price'])
+
+    def __eq__(self, other):
+        if not isinstance(other, OptionChain) or len(self) != len(other):
+            return False
+
+        for name in OPTION_CHAIN_COLUMN_NAMES:
+            mask = self.masks[name]
+            if not np.array_equal(mask, other.masks[name]):
+                return False
+            if not np.array_equal(self.columns[name][mask], other.columns[name][mask]):
+                return False
+
+        return True
+
+    def __repr__(self):
+        return f'OptionChain(size={len(self)})'
+
+    # 行のリストから OptionChain を作ります。
+    # rows: OptionPrice のフィールド順に値を並べたタプルのリスト。欠損値は None。
+    @classmethod
+    def from_rows(cls, rows):
+        columns = {}
+        masks = {}
+
+        for i, (name, kind) in enumerate(OPTION_CHAIN_COLUMNS):
+            values = [row[i] for row in rows]
+            mask = np.array([v is not None for v in values], dtype=np.bool_)
+            data = [_to_column_value(v, kind) if v is not None else 0 for v in values]
+
+            columns[name] = np.array(data, dtype=np.int64).astype(KIND_DTYPES[kind]) \
+                if kind in DATETIME_KINDS else np.array(data, dtype=KIND_DTYPES[kind])
+            masks[name] = mask
+
+        return cls(columns, masks)
+
+    # OptionPrice のリストから OptionChain を作ります
+    @classmethod
+    def from_option_list(cls, option_list):
+        return cls.from_rows([dataclasses.astuple(op) for op in option_list])
+
+    # 複数の OptionChain を順番に連結した OptionChain を作ります
+    @classmethod
+    def concat(cls, chains):
+        columns = {name: np.concatenate([c.columns[name] for c in chains]) for name in OPTION_CHAIN_COLUMN_NAMES}
+        masks = {name: np.concatenate([c.masks[name] for c in chains]) for name in OPTION_CHAIN_COLUMN_NAMES}
+        return cls(columns, masks)
+
+    # OptionPrice のリストに変換します
+    def to_option_list(self):
+        lists = []
+
+        for name, kind in OPTION_CHAIN_COLUMNS:
+            column = self.columns[name]
+            mask = self.masks[name]
+            lists.append([_from_column_value(v, kind) if m else None for v, m in zip(column, mask)])
+
+        return [OptionPrice(*values) for values in zip(*lists)]
+
+    # 行を選択した OptionChain を返します。
+    # index がスライスならば各列はビューになり、bool配列ならばコピーになります。
+    def select(self, index):
+        columns = {name: column[index] for name, column in self.columns.items()}
+        masks = {name: mask[index] for name, mask in self.masks.items()}
+        return OptionChain(columns, masks)
+
+    # 指定したオプション種別の行を選択します。
+    # パーサーはCALL, PUTの順に連続して詰めるので、連続している場合はスライス(=ビュー)で返します。
+    def _select_type(self, option_type):
+        indices = np.flatnonzero(self.columns['type'] == option_type.value)
+
+        if len(indices) == 0 or indices[-1] - indices[0] + 1 == len(indices):
+            start = indices[0] if len(indices) > 0 else 0
+            return self.select(slice(start, start + len(indices)))
+
+        return self.select(self.columns['type'] == option_type.value)
+
+    @property
+    def calls(self):
+        return self._select_type(OptionType.CALL)
+
+    @property
+    def puts(self):
+        return self._select_type(OptionType.PUT)
+
+    # 数値の列を float の配列で返します。欠損値は fill で埋めます。
+    def values(self, name, fill=np.nan):
+        return np.where(self.masks[name], self.columns[name], fill).astype(np.float64)
+
+    # 列全体に同じ値を設定します。値は OptionPrice のフィールドと同じ型で渡してください。
+    def fill(self, name, value):
+        kind = OPTION_CHAIN_COLUMN_KINDS[name]
+
+        if value is None:
+            self.masks[name][:] = False
+            return
+
+        self.columns[name][:] = np.array(_to_column_value(value, kind)).astype(self.columns[name].dtype)
+        self.masks[name][:] = True
+
+    # 欠損している箇所だけを values で埋めます。values が NaN の箇所は欠損のまま残します。
+    def fill_missing(self, name, values):
+        target = ~self.masks[name] & np.isfinite(values)
+        self.columns[name][target] = values[target]
+        self.masks[name][target] = True
+
+    # 改行区切りJSON(NDJSON)にシリアライズします。
+    # 各行は OptionPrice.to_json() と同じ文字列になります。日時の文字列化は列ごとにまとめて行います。
+    def to_ndjson(self):
+        lists = []
+
+        for name, kind in OPTION_CHAIN_COLUMNS:
+            column = self.columns[name]
+
+            if kind == KIND_TIMESTAMP:
+                # タイムゾーン付きのisoフォーマット(JST)
+                values = [s + '+09:00' for s in np.datetime_as_string(column + JST_OFFSET, unit='s').tolist()]
+            elif kind == KIND_DATETIME:
+                values = np.datetime_as_string(column + JST_OFFSET, unit='s').tolist()
+            elif kind == KIND_DATE:
+                values = np.datetime_as_string(column + JST_OFFSET, unit='D').tolist()
+            else:
+                values = column.tolist()
+
+            mask = self.masks[name]
+            if not mask.all():
+                values = [v if m else None for v, m in zip(values, mask.tolist())]
+
+            lists.append(values)
+
+        names = OPTION_CHAIN_COLUMN_NAMES
+
+        return '\n'.join(json.dumps(dict(zip(names, row))) for row in zip(*lists))
@@ -0,0 +1,154 @@
+"""
+オプション価格を前回のスナップショットから変わった行だけ保存するためのモジュールです。
+
+行ごとに全カラム(created_at 以外)から作ったフィンガープリントを Cloud Datastore に保存しておき、
+次のスナップショットではフィンガープリントが変わった行と新しく増えた行だけを残します。
+ATMの行はスナップショットを復元しなくても読めるように毎回残します。
+時間枠(option_price_keyframe_interval_seconds)ごとの最初のスナップショットは全行を保存するキーフレームにします。
+
+ある時刻のスナップショットは、その時刻が属する時間枠の始まりからその時刻までの行のうち、
+(last_trading_day, type, target_price) ごとに最新のものを取れば復元できます。
+(optionchan_dao.snapshot_option_price_query)
+"""
+
+import numpy as np
+
+from google.cloud import datastore
+from pytz import timezone
+
+import clients
+
+from config import Config
+from my_logging import getLogger
+from option_chain import OPTION_CHAIN_COLUMN_NAMES
+
+log = getLogger(__name__)
+config = Config()
+
+TZ_UTC = timezone('UTC')
+
+# フィンガープリントに含めないカラム
+EXCLUDED_COLUMNS = ['created_at']
+
+# 欠損値のときにフィンガープリントに混ぜる値
+MISSING_VALUE = np.uint64(0x9e3779b97f4a7c15)
+
+# FNV-1a の定数
+FNV_OFFSET_BASIS = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+# 前回保存したスナップショットの状態。
+# keys, fingerprints は行キーの昇順に並べる。keyframe_at はキーフレームの created_at
+class DeltaState:
+
+    def __init__(self, created_at, keyframe_at, keys, fingerprints):
+        self.created_at = created_at
+        self.keyframe_at = keyframe_at
+        self.keys = keys
+        self.fingerprints = fingerprints
+
+
+# 行キーを作ります。(last_trading_day, type, target_price) を1つの整数にまとめたもの
+def row_keys(option_chain):
+    days = option_chain.columns['last_trading_day'].astype('datetime64[D]').astype(np.int64)
+    option_type = option_chain.columns['type'].astype(np.int64)
+    target_price = option_chain.columns['target_price'].astype(np.int64)
+    return (days << 24) | (option_type << 20) | target_price
+
+
+# 列の値を、フィンガープリントに混ぜるための uint64 にします
+def _column_bits(column):
+    if column.dtype == np.float64:
+        return column.view(np.uint64)
+    return column.astype(np.int64).view(np.uint64)
+
+
+# 行ごとのフィンガープリントを作ります
+def row_fingerprints(option_chain):
+    fingerprints = np.full(len(option_chain), FNV_OFFSET_BASIS, dtype=np.uint64)
+
+    with np.errstate(over='ignore'):
+        for name in OPTION_CHAIN_COLUMN_NAMES:
+            if name in EXCLUDED_COLUMNS:
+                continue
+
+            bits = np.where(option_chain.masks[name], _column_bits(option_chain.columns[name]), MISSING_VALUE)
+            fingerprints = (fingerprints ^ bits) * FNV_PRIME
+
+    return fingerprints
+
+
+# キーフレームの時間枠の始まり(epoch秒)を返します
+def keyframe_window_start(created_at):
+    interval = config.option_price_keyframe_interval_seconds
+    return int(created_at.timestamp()) // interval * interval
+
+
+# 保存する行を選びます。
+# fingerprints: 行ごとのフィンガープリント。省略すると option_chain から作ります。
+#   IV, グリークスを理論値で埋める場合は、埋める前の OptionChain から作ったものを渡してください。
+#   理論値は満期までの期間が縮むので毎分変わってしまうため。
+# 戻り値: (保存する行の OptionChain, キーフレームかどうか, 保存後に save_state() に渡す DeltaState)
+def select_rows_to_store(option_chain, created_at, prev_state, fingerprints=None):
+    keys = row_keys(option_chain)
+
+    if fingerprints is None:
+        fingerprints = row_fingerprints(option_chain)
+
+    order = np.argsort(keys, kind='stable')
+    state = DeltaState(created_at, created_at, keys[order], fingerprints[order])
+
+    is_keyframe = prev_state is None or len(prev_state.keys) == 0 \
+        or int(prev_state.keyframe_at.timestamp()) < keyframe_window_start(created_at)
+
+    if is_keyframe:
+        return option_chain, True, state
+
+    state.keyframe_at = prev_state.keyframe_at
+
+    # 前回のスナップショットで同じキーの行を探す
+    pos = np.minimum(np.searchsorted(prev_state.keys, keys), len(prev_state.keys) - 1)
+    is_unchanged = (prev_state.keys[pos] == keys) & (prev_state.fingerprints[pos] == fingerprints)
+
+    is_atm = option_chain.masks['is_atm'] & option_chain.columns['is_atm']
+    selected = ~is_unchanged | is_atm
+
+    log.debug(f'delta rows: {int(selected.sum())}/{len(option_chain)}')
+
+    return option_chain.select(selected), False, state
+
+
+def _state_key(client):
+    return client.key(config.gcp_ds_kind, config.gcp_ds_delta_state_key_id)
+
+
+# 前回保存したスナップショットの状態を Cloud Datastore から読み込みます。無ければ None を返します。
+def load_state():
+    client = clients.datastore_client()
+    entity = client.get(_state_key(client))
+
+    if entity is None:
+        return None
+
+    return DeltaState(
+        entity['created_at'],
+        entity['keyframe_at'],
+        np.frombuffer(entity['keys'], dtype=np.int64),
+        np.frombuffer(entity['fingerprints'], dtype=np.uint64),
+    )
+
+
+# スナップショットの状態を Cloud Datastore に保存します。
+# ファイルのアップロードが終わってから呼ぶこと。途中で失敗した場合は次回に前回との差分を取り直せるように。
+def save_state(state):
+    client = clients.datastore_client()
+
+    entity = datastore.Entity(_state_key(client), exclude_from_indexes=('keys', 'fingerprints'))
+    entity.update({
+        'created_at': state.created_at.astimezone(TZ_UTC),
+        'keyframe_at': state.keyframe_at.astimezone(TZ_UTC),
+        'keys': state.keys.tobytes(),
+        'fingerprints': state.fingerprints.tobytes(),
+    })
+    client.put(entity)
@@ -0,0 +1,179 @@
+"""
+日経225オプションの理論価格、インプライド・ボラティリティ、グリークスを計算するモジュールです。
+先物価格を原資産とするヨーロピアン・オプションとして Black-76 モデルで計算します。
+行使価格ごとにループせず、チェーン全体を NumPy の配列でまとめて計算します。
+"""
+
+import numpy as np
+
+from models import OptionType
+
+# 1年の秒数。満期までの期間は暦日ベースで年換算する
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+# 満期までの期間の下限(1分)。満期直前に0除算しないようにするため
+MIN_TIME_TO_EXPIRY = 60 / SECONDS_PER_YEAR
+
+# SQは最終取引日の翌営業日の寄付きで決まるので、最終取引日(JSTの0時)から33時間後を満期とみなす
+EXPIRY_OFFSET = np.timedelta64(33, 'h')
+
+# インプライド・ボラティリティの探索範囲
+VOL_MIN = 1e-4
+VOL_MAX = 5.0
+VOL_INITIAL = 0.3
+
+SQRT_2 = np.sqrt(2.0)
+SQRT_2PI = np.sqrt(2.0 * np.pi)
+
+
+# 相補誤差関数。Numerical Recipes の erfcc (全域で相対誤差 1.2e-7 未満) を配列用にしたもの。
+# scipy に依存しないために自前で持つ。
+def _erfc(x):
+    z = np.abs(x)
+    t = 1.0 / (1.0 + 0.5 * z)
+    ans = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (
+        -0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (
+            -0.82215223 + t * 0.17087277)))))))))
+    return np.where(x >= 0, ans, 2.0 - ans)
+
+
+# 標準正規分布の累積分布関数
+def norm_cdf(x):
+    return 0.5 * _erfc(-x / SQRT_2)
+
+
+# 標準正規分布の確率密度関数
+def norm_pdf(x):
+    return np.exp(-0.5 * x * x) / SQRT_2PI
+
+
+def _d1_d2(forward, strike, t, sigma):
+    sigma_sqrt_t = sigma * np.sqrt(t)
+    d1 = (np.log(forward / strike) + 0.5 * sigma * sigma * t) / sigma_sqrt_t
+    return d1, d1 - sigma_sqrt_t
+
+
+# Black-76 の理論価格。
+# forward: 先物価格, strike: 行使価格, t: 満期までの期間(年), sigma: ボラティリティ(0.2 = 20%),
+# is_call: CALL なら True, r: 無リスク金利
+def black76_price(forward, strike, t, sigma, is_call, r=0.0):
+    d1, d2 = _d1_d2(forward, strike, t, sigma)
+    discount = np.exp(-r * t)
+    call = discount * (forward * norm_cdf(d1) - strike * norm_cdf(d2))
+    put = discount * (strike * norm_cdf(-d2) - forward * norm_cdf(-d1))
+    return np.where(is_call, call, put)
+
+
+# Black-76 のグリークス。(delta, gamma, theta, vega) のタプルを返します。
+# JPXの表示に合わせて theta は1日あたり、vega はボラティリティ1%あたりの値にします。
+def black76_greeks(forward, strike, t, sigma, is_call, r=0.0):
+    d1, d2 = _d1_d2(forward, strike, t, sigma)
+    discount = np.exp(-r * t)
+    sqrt_t = np.sqrt(t)
+    pdf_d1 = norm_pdf(d1)
+
+    delta = np.where(is_call, discount * norm_cdf(d1), -discount * norm_cdf(-d1))
+    gamma = discount * pdf_d1 / (forward * sigma * sqrt_t)
+    vega = forward * discount * pdf_d1 * sqrt_t
+
+    price = black76_price(forward, strike, t, sigma, is_call, r)
+    theta = -forward * discount * pdf_d1 * sigma / (2.0 * sqrt_t) + r * price
+
+    return delta, gamma, theta / 365.0, vega / 100.0
+
+
+# プレミアムからインプライド・ボラティリティ(0.2 = 20%)を計算します。
+# 全要素を同時に、ブラケット付きのニュートン法(範囲外に出る場合は二分法)で解きます。
+# 裁定条件を満たさないなど解が無い要素は NaN になります。
+def implied_volatility(price, forward, strike, t, is_call, r=0.0, tol=1e-6, max_iter=100):
+    price, forward, strike, t, is_call = np.broadcast_arrays(
+        np.asarray(price, dtype=np.float64), np.asarray(forward, dtype=np.float64),
+        np.asarray(strike, dtype=np.float64), np.asarray(t, dtype=np.float64), np.asarray(is_call, dtype=np.bool_))
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        discount = np.exp(-r * t)
+        intrinsic = discount * np.where(is_call, np.maximum(forward - strike, 0.0), np.maximum(strike - forward, 0.0))
+        upper = discount * np.where(is_call, forward, strike)
+
+        valid = np.isfinite(price) & (forward > 0) & (strike > 0) & (t > 0) & (price > intrinsic) & (price < upper)
+
+        # ITM はプレミアムの大半が本質的価値で数値的に不安定なので、
+        # プット・コール・パリティで反対側の OTM の価格に直してから解く
+        is_itm = np.where(is_call, forward > strike, strike > forward)
+        price = np.where(is_itm, price - intrinsic, price)
+        is_call = np.where(is_itm, ~is_call, is_call)
+
+        # 解が無い要素は計算対象から外すため、ダミーの値に置き換えておく
+        price = np.where(valid, price, 1.0)
+        forward = np.where(valid, forward, 1.0)
+        strike = np.where(valid, strike, 1.0)
+        t = np.where(valid, t, 1.0)
+
+        lo = np.full(price.shape, VOL_MIN)
+        hi = np.full(price.shape, VOL_MAX)
+        sigma = np.full(price.shape, VOL_INITIAL)
+        active = valid.copy()
+
+        for _ in range(max_iter):
+            if not active.any():
+                break
+
+            diff = black76_price(forward, strike, t, sigma, is_call, r) - price
+            vega = forward * discount * norm_pdf(_d1_d2(forward, strike, t, sigma)[0]) * np.sqrt(t)
+
+            active &= np.abs(diff) > tol
+
+            # 理論価格が高すぎればボラティリティの上限を、低すぎれば下限を狭める
+            hi = np.where(active & (diff > 0), sigma, hi)
+            lo = np.where(active & (diff < 0), sigma, lo)
+
+            newton = sigma - diff / vega
+            in_bracket = np.isfinite(newton) & (newton > lo) & (newton < hi)
+            next_sigma = np.where(in_bracket, newton, 0.5 * (lo + hi))
+
+            sigma = np.where(active, next_sigma, sigma)
+
+    return np.where(valid, sigma, np.nan)
+
+
+# OptionChain の各行の満期までの期間(年)を計算します
+def time_to_expiry(option_chain):
+    expiry = option_chain.columns['last_trading_day'] + EXPIRY_OFFSET
+    seconds = (expiry - option_chain.columns['created_at']).astype('timedelta64[s]').astype(np.float64)
+    return np.maximum(seconds / SECONDS_PER_YEAR, MIN_TIME_TO_EXPIRY)
+
+
+# OptionChain の IV とグリークスの欠損を理論値で埋めます。
+# JPXの値が取れている箇所はそのまま残します。
+# future_price: 原資産とする先物価格, r: 無リスク金利
+def fill_missing_iv_and_greeks(option_chain, future_price, r=0.0):
+    if future_price is None or len(option_chain) == 0:
+        return option_chain
+
+    forward = float(future_price)
+    strike = option_chain.columns['target_price'].astype(np.float64)
+    t = time_to_expiry(option_chain)
+    is_call = option_chain.columns['type'] == OptionType.CALL.value
+
+    bid = option_chain.values('bid')
+    ask = option_chain.values('ask')
+
+    # IV は気配の仲値から、仲値が無ければ現在値から求める
+    mid = np.where(np.isfinite(bid) & np.isfinite(ask), (bid + ask) / 2.0, option_chain.values('price'))
+
+    option_chain.fill_missing('iv', implied_volatility(mid, forward, strike, t, is_call, r) * 100.0)
+    option_chain.fill_missing('bid_iv', implied_volatility(bid, forward, strike, t, is_call, r) * 100.0)
+    option_chain.fill_missing('ask_iv', implied_volatility(ask, forward, strike, t, is_call, r) * 100.0)
+
+    # グリークスは(JPXのものも含めた) IV から計算する
+    sigma = option_chain.values('iv') / 100.0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta, gamma, theta, vega = black76_greeks(forward, strike, t, sigma, is_call, r)
+
+    option_chain.fill_missing('delta', delta)
+    option_chain.fill_missing('gamma', gamma)
+    option_chain.fill_missing('theta', theta)
+    option_chain.fill_missing('vega', vega)
+
+    return option_chain
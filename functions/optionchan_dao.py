@@ -1,11 +1,7 @@
-import pandas as pd
-
-from google.cloud import bigquery
-from google.cloud import datastore
 from datetime import datetime, timedelta
 from pytz import timezone
 
-import models
+import clients, contract_calendar, models
 from my_logging import getLogger
 from config import Config
 
@@ -15,10 +11,17 @@ config = Config()
 TZ_JST = timezone('Asia/Tokyo')
 TZ_UTC = timezone('UTC')
 
+# 最小の時間足の時間枠(秒)
+BASE_TIME_FRAME = 300
+
+
+# BigQuery のライブラリは読み込みに時間がかかるので、クエリを作る関数の中で読み込む。
+# smile_data が取り込み時に作っておいたCSVを返すだけのときは BigQuery を使わないため。
+
 
 # これだけは Cloud Datastore からデータとってくるやつ。
 def find_latest_future_price():
-    client = datastore.Client()
+    client = clients.datastore_client()
 
     with client.transaction():
         key = client.key(config.gcp_ds_kind, config.gcp_ds_key_id)
@@ -32,87 +35,191 @@ def find_latest_future_price():
     return future_price
 
 
+# created_at 時点のオプション価格のスナップショットを返すサブクエリを作ります。
+# download_jpx が変わった行だけを保存している(Config.delta_ingestion)場合も、全行が揃ったものを返します。
+# キーフレームの時間枠の始まりから created_at までの行のうち、行ごとに最新のものを取ります。
+# 満期を過ぎた限月は含めません。全行を保存していた期間のデータにもそのまま使えます。
+# 戻り値: (サブクエリ, クエリパラメータのリスト)
+def snapshot_option_price_query(created_at):
+    from google.cloud import bigquery
+
+    table = f'{config.gcp_bq_dataset_name}.option_price'
+    interval = config.option_price_keyframe_interval_seconds
+    created_at_epoch = int(created_at.timestamp())
+
+    query = (f'''
+        SELECT * EXCEPT(row_num) FROM (
+            SELECT *,
+                ROW_NUMBER() OVER (PARTITION BY last_trading_day, type, target_price ORDER BY created_at DESC) AS row_num
+            FROM `{table}`
+            WHERE created_at >= @snapshot_from
+                AND created_at <= @snapshot_to
+                AND last_trading_day >= @snapshot_date
+        )
+        WHERE row_num = 1''')
+
+    query_parameters = [
+        _timestamp_parameter('snapshot_from', bucket_start(created_at_epoch, interval)),
+        _timestamp_parameter('snapshot_to', created_at_epoch),
+        bigquery.ScalarQueryParameter('snapshot_date', 'DATE', created_at.astimezone(TZ_JST).date()),
+    ]
+
+    return query, query_parameters
+
+
 #
 # 最新先物価格のcreated_atと同時刻のcreated_atを持つオプション価格のリストを取得します。
-# 返ってくるカラム
+# o1 は直近限月、o2 は次限月(3限月目以降は含まない)。
+# 返ってくるカラム(pyarrow.Table)
 # target_price                   int64
-# o1_call_iv                   float64
-# o1_call_price_time    datetime64[ns]
-# o1_put_iv                    float64
-# o1_put_price_time     datetime64[ns]
-# o1_put_is_atm                 object
-# o2_call_iv                   float64
-# o2_call_price_time    datetime64[ns]
-# o2_put_iv                    float64
-# o2_put_price_time     datetime64[ns]
-# o2_put_is_atm                 object
+# o1_call_iv                    double
+# o1_call_price_time     timestamp[us]
+# o1_put_iv                     double
+# o1_put_price_time      timestamp[us]
+# o1_put_is_atm                   bool
+# o2_call_iv                    double
+# o2_call_price_time     timestamp[us]
+# o2_put_iv                     double
+# o2_put_price_time      timestamp[us]
+# o2_put_is_atm                   bool
 def find_option_price_by_created_at(created_at):
+    from google.cloud import bigquery
 
-    client = bigquery.Client()
-    created_at_str = datetime.isoformat(created_at)
-    table = f'{config.gcp_bq_dataset_name}.option_price'
+    snapshot, query_parameters = snapshot_option_price_query(created_at)
+
+    # 直近限月と次限月の最終取引日は限月カレンダーから引く
+    last_trading_days = contract_calendar.find_last_trading_days() or []
+    query_parameters += [
+        bigquery.ScalarQueryParameter('l_min', 'DATE', last_trading_days[0] if len(last_trading_days) > 0 else None),
+        bigquery.ScalarQueryParameter('l_2nd', 'DATE', last_trading_days[1] if len(last_trading_days) > 1 else None),
+    ]
 
     query = (f'''
-        WITH t AS(
-            SELECT max(last_trading_day) l_max,  min(last_trading_day)  l_min
-            FROM {table} WHERE created_at = "{created_at_str}"
+        WITH s AS ({snapshot}
         )
         SELECT target_price,
-            MAX(CASE WHEN last_trading_day = (SELECT l_min FROM t) AND type = 1 THEN iv END) AS o1_call_iv,
-            MAX(CASE WHEN last_trading_day = (SELECT l_min FROM t) AND type = 1 THEN price_time END) AS o1_call_price_time,
-            MAX(CASE WHEN last_trading_day = (SELECT l_min FROM t) AND type = 2 THEN iv END) AS o1_put_iv,
-            MAX(CASE WHEN last_trading_day = (SELECT l_min FROM t) AND type = 2 THEN price_time END) AS o1_put_price_time,
-            MAX(CASE WHEN last_trading_day = (SELECT l_min FROM t) AND type = 2 THEN is_atm END) AS o1_put_is_atm,
-            MAX(CASE WHEN last_trading_day = (SELECT l_max FROM t) AND type = 1 THEN iv END) AS o2_call_iv,
-            MAX(CASE WHEN last_trading_day = (SELECT l_max FROM t) AND type = 1 THEN price_time END) AS o2_call_price_time,
-            MAX(CASE WHEN last_trading_day = (SELECT l_max FROM t) AND type = 2 THEN iv END) AS o2_put_iv,
-            MAX(CASE WHEN last_trading_day = (SELECT l_max FROM t) AND type = 2 THEN price_time END) AS o2_put_price_time,
-            MAX(CASE WHEN last_trading_day = (SELECT l_max FROM t) AND type = 2 THEN is_atm END) AS o2_put_is_atm
-        FROM {table} WHERE created_at = "{created_at_str}" GROUP BY target_price ORDER BY target_price'''
+            MAX(CASE WHEN last_trading_day = @l_min AND type = 1 THEN iv END) AS o1_call_iv,
+            MAX(CASE WHEN last_trading_day = @l_min AND type = 1 THEN price_time END) AS o1_call_price_time,
+            MAX(CASE WHEN last_trading_day = @l_min AND type = 2 THEN iv END) AS o1_put_iv,
+            MAX(CASE WHEN last_trading_day = @l_min AND type = 2 THEN price_time END) AS o1_put_price_time,
+            MAX(CASE WHEN last_trading_day = @l_min AND type = 2 THEN is_atm END) AS o1_put_is_atm,
+            MAX(CASE WHEN last_trading_day = @l_2nd AND type = 1 THEN iv END) AS o2_call_iv,
+            MAX(CASE WHEN last_trading_day = @l_2nd AND type = 1 THEN price_time END) AS o2_call_price_time,
+            MAX(CASE WHEN last_trading_day = @l_2nd AND type = 2 THEN iv END) AS o2_put_iv,
+            MAX(CASE WHEN last_trading_day = @l_2nd AND type = 2 THEN price_time END) AS o2_put_price_time,
+            MAX(CASE WHEN last_trading_day = @l_2nd AND type = 2 THEN is_atm END) AS o2_put_is_atm
+        FROM s
+        WHERE last_trading_day IN (@l_min, @l_2nd)
+        GROUP BY target_price ORDER BY target_price'''
     )
 
-    query_job = client.query(query)
-    rows = query_job.result()
-
-    df = rows.to_dataframe()
-
-    return df
+    return __do_bq_query(query, query_parameters, 'smile_data')
 
 
 # target_date: この日の前７日間のデータを返す. aware なものを渡してください。
-def find_recent_iv_and_price_of_atm_options(target_date):
-
-    last_trading_day_from = target_date.astimezone(TZ_JST).strftime('%Y-%m-%d')
-    created_at_from = (target_date - timedelta(days=7)).isoformat()
-    table = f'{config.gcp_bq_dataset_name}.option_price'
+# time_frame: 時間足の時間枠(秒)。timeframe の rollup_ohlc が集計した時間足の終値を返します。
+# 値は足の終値(足の中の最後の値)です。rollup_ohlc を使う前は5分ごとの平均値だったので、動きが少し変わります。
+# まだ集計されていない進行中の足(とその1つ前の足)は、atm_iv_data と同じく最小の時間足から作ります。
+# 5分足以外は rollup_ohlc が確定した足しか集計しないため。
+def find_recent_iv_and_price_of_atm_options(target_date, time_frame=300):
+    from google.cloud import bigquery
+
+    time_frame = int(time_frame)
+
+    # 直近限月の最終取引日は限月カレンダーから引く
+    l_min = contract_calendar.find_nth_last_trading_day(0)
+    # BigQuery のキャッシュが効くように、期間の始まりは最小の時間足の区切りに揃える
+    now = bucket_start(int(target_date.timestamp()), BASE_TIME_FRAME)
+    started_at_from = bucket_start(int((target_date - timedelta(days=7)).timestamp()), BASE_TIME_FRAME)
+    # 進行中の足と、その1つ前の足(確定済みの足の集計が済んでいない場合のため)
+    in_progress_from = bucket_start(now, time_frame) - time_frame
+    table_iv = f'{config.gcp_bq_dataset_name}.atm_iv'
+    table_price = f'{config.gcp_bq_dataset_name}.atm_option_price'
+    table_target_price = f'{config.gcp_bq_dataset_name}.atm_target_price'
+
+    # 3つの時間足のテーブルに共通の条件
+    condition = ('''
+            last_trading_day = @l_min AND time_frame = @time_frame AND started_at > @started_at_from''')
+    # 進行中の足を作る最小の時間足の条件
+    base_condition = ('''
+            last_trading_day = @l_min AND time_frame = @base_time_frame
+            AND started_at >= @in_progress_from AND started_at > @started_at_from''')
 
     query = (f'''
-    WITH t1 AS (
-        SELECT min(last_trading_day) AS l_min FROM `{table}`
-        WHERE last_trading_day >= "{last_trading_day_from}"
-    ),
-    t2 AS (
+    WITH t AS (
+        SELECT 'target_price' AS measure, started_at, close FROM `{table_target_price}` WHERE {condition}
+        UNION ALL
+        SELECT 'iv' AS measure, started_at, close FROM `{table_iv}` WHERE {condition}
+        UNION ALL
+        SELECT 'price' AS measure, started_at, close FROM `{table_price}` WHERE {condition}
+    ), base AS (
+        SELECT 'target_price' AS measure, started_at, close FROM `{table_target_price}` WHERE {base_condition}
+        UNION ALL
+        SELECT 'iv' AS measure, started_at, close FROM `{table_iv}` WHERE {base_condition}
+        UNION ALL
+        SELECT 'price' AS measure, started_at, close FROM `{table_price}` WHERE {base_condition}
+    ), last_finished AS (
+        SELECT measure, MAX(started_at) AS started_at FROM t GROUP BY measure
+    ), in_progress AS (
+        -- まだ集計されていない足(=集計済みの最後の足より後)の終値を最小の時間足から作る
         SELECT
-            target_price, iv, price, TIMESTAMP_SECONDS(CAST(TRUNC(UNIX_SECONDS(created_at)/300) AS INT64) * 300) AS time 
-        FROM
-            `{table}`
-        WHERE
-            created_at > "{created_at_from}" AND last_trading_day=(SELECT l_min FROM t1) AND is_atm = TRUE
+            b.measure,
+            b.bucket AS started_at,
+            (array_agg(b.close IGNORE NULLS ORDER BY b.started_at DESC))[SAFE_OFFSET(0)] AS close
+        FROM (
+            SELECT *, TIMESTAMP_SECONDS(DIV(UNIX_SECONDS(started_at), @time_frame) * @time_frame) AS bucket FROM base
+        ) b
+        LEFT JOIN last_finished l ON b.measure = l.measure
+        WHERE b.bucket > IFNULL(l.started_at, TIMESTAMP_SECONDS(0))
+        GROUP BY b.measure, b.bucket
+    ), u AS (
+        SELECT measure, started_at, close FROM t
+        UNION ALL
+        SELECT measure, started_at, close FROM in_progress
     )
     SELECT
-        UNIX_SECONDS(time) AS time, ROUND(AVG(target_price), 1) AS target_price, 
-        ROUND(AVG(iv), 1) AS iv, ROUND(AVG(price), 1) AS price
-    FROM t2 GROUP BY time ORDER BY time
+        UNIX_SECONDS(started_at) AS time,
+        ROUND(MAX(IF(measure = 'target_price', close, NULL)), 1) AS target_price,
+        ROUND(MAX(IF(measure = 'iv', close, NULL)), 1) AS iv,
+        ROUND(MAX(IF(measure = 'price', close, NULL)), 1) AS price
+    FROM u GROUP BY started_at ORDER BY started_at
     ''')
 
-    result = __do_bq_query(query)
+    query_parameters = [
+        bigquery.ScalarQueryParameter('l_min', 'DATE', l_min),
+        bigquery.ScalarQueryParameter('time_frame', 'INT64', time_frame),
+        bigquery.ScalarQueryParameter('base_time_frame', 'INT64', BASE_TIME_FRAME),
+        _timestamp_parameter('started_at_from', started_at_from),
+        _timestamp_parameter('in_progress_from', in_progress_from),
+    ]
+
+    result = __do_bq_query(query, query_parameters, 'atm_data')
     return result
 
 
-# 文字列でqueryを受け取って、pandas.DataFrameを返す
-def __do_bq_query(query):
-    client = bigquery.Client()
-    query_job = client.query(query)
+# epoch秒を時間枠の開始時刻に切り捨てます
+def bucket_start(epoch, time_frame):
+    return epoch // time_frame * time_frame
+
+
+# epoch秒から TIMESTAMP のクエリパラメータを作ります
+def _timestamp_parameter(name, epoch):
+    from google.cloud import bigquery
+    return bigquery.ScalarQueryParameter(name, 'TIMESTAMP', datetime.fromtimestamp(epoch, TZ_UTC))
+
+
+# 文字列でqueryを受け取って、pyarrow.Table を返す。
+# 値は埋め込まずに query_parameters (名前付きのクエリパラメータ)で渡すこと。
+# クエリの文字列が毎回同じになって BigQuery のキャッシュが効くようにするため。
+# label: 呼び出し元のエンドポイント名。ログに出すのと、Config.bq_query_max_bytes の上限を引くのに使う
+def __do_bq_query(query, query_parameters=(), label=None):
+    from google.cloud import bigquery
+    import bq_query
+
+    job_config = bigquery.QueryJobConfig(query_parameters=list(query_parameters))
+    max_bytes = config.bq_query_max_bytes.get(label) if config.bq_query_budget_enabled else None
+
+    query_job = bq_query.run_query(query, label, job_config, max_bytes)
     rows = query_job.result()
 
-    return rows.to_dataframe()
+    return rows.to_arrow()
@@ -0,0 +1,48 @@
+"""
+GCSに置く価格情報ファイルのフォーマットを扱うモジュールです。
+gzip した改行区切りJSON(NDJSON)の代わりに、BigQuery のスキーマ(schema/*.json)どおりの型を持つ Parquet で書き出せます。
+(Parquet の書き出しは price_parquet)
+ロード時はファイル名の拡張子からフォーマットを判定します。
+"""
+
+import json
+import os
+
+from functools import lru_cache
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_PARQUET = 'parquet'
+
+# 拡張子ごとの BigQuery の source_format
+SOURCE_FORMATS = {
+    '.json.gz': 'NEWLINE_DELIMITED_JSON',
+    '.parquet': 'PARQUET',
+}
+
+# スキーマのJSONを探すディレクトリ。デプロイ時は functions/schema にコピーしておく
+SCHEMA_DIRS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schema'),
+]
+
+
+# ファイル名の拡張子から BigQuery の source_format を返します。未知の拡張子ならば None を返します。
+def source_format_of(name):
+    for extension, source_format in SOURCE_FORMATS.items():
+        if name.endswith(extension):
+            return source_format
+
+    return None
+
+
+# テーブルの BigQuery のスキーマ(schema/<table_name>.json の中身)を返します
+@lru_cache(maxsize=None)
+def load_bq_schema(table_name):
+    for schema_dir in SCHEMA_DIRS:
+        path = os.path.join(schema_dir, f'{table_name}.json')
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+
+    raise FileNotFoundError(f'schema is not found: table_name={table_name}')
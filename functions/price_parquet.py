@@ -0,0 +1,91 @@
+"""
+価格情報を BigQuery のスキーマ(schema/*.json)どおりの型を持つ Parquet にするモジュールです。
+pyarrow を使うので、Config.price_file_format が parquet のときだけ読み込んでください。
+"""
+
+import io
+
+from functools import lru_cache
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pytz import timezone
+
+from option_chain import OptionChain, DATETIME_KINDS, JST_OFFSET, OPTION_CHAIN_COLUMN_KINDS
+from price_file import load_bq_schema
+
+TZ_JST = timezone('Asia/Tokyo')
+
+# BigQuery の型と Arrow の型の対応。
+# DATETIME はタイムゾーン無しの timestamp(=Parquet の isAdjustedToUTC=false)にすると DATETIME としてロードされる
+BQ_TYPE_TO_ARROW_TYPE = {
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'BOOLEAN': pa.bool_(),
+    'TIMESTAMP': pa.timestamp('s', tz='UTC'),
+    'DATETIME': pa.timestamp('s'),
+    'DATE': pa.date32(),
+}
+
+
+# テーブルの BigQuery のスキーマに対応する Arrow のスキーマを返します
+@lru_cache(maxsize=None)
+def arrow_schema(table_name):
+    return pa.schema([
+        pa.field(f['name'], BQ_TYPE_TO_ARROW_TYPE[f['type']], nullable=f.get('mode') != 'REQUIRED')
+        for f in load_bq_schema(table_name)
+    ])
+
+
+# 1ファイル数百行しかないので、フッターが大きくなる列の統計情報は書かない
+def _to_parquet(table):
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression='zstd', write_statistics=False)
+    return buf.getvalue()
+
+
+# OptionChain の列を Arrow の配列に変換します
+def _option_chain_array(option_chain, name, arrow_type):
+    column = option_chain.columns[name]
+    mask = ~option_chain.masks[name]
+    kind = OPTION_CHAIN_COLUMN_KINDS[name]
+
+    if kind in DATETIME_KINDS and (pa.types.is_date32(arrow_type) or arrow_type.tz is None):
+        # DATETIME, DATE は JST の壁時計の時刻にする(models の encoder と同じ)
+        column = column + JST_OFFSET
+
+    if pa.types.is_date32(arrow_type):
+        column = column.astype('datetime64[D]')
+    elif pa.types.is_timestamp(arrow_type):
+        column = column.astype('datetime64[s]').astype(np.int64)
+    else:
+        column = column.astype(arrow_type.to_pandas_dtype())
+
+    return pa.array(column, type=arrow_type, mask=mask) if mask.any() else pa.array(column, type=arrow_type)
+
+
+# OptionChain を option_price テーブルのスキーマの Parquet にします
+def option_chain_to_parquet(option_chain: OptionChain):
+    schema = arrow_schema('option_price')
+    arrays = [_option_chain_array(option_chain, f.name, f.type) for f in schema]
+    return _to_parquet(pa.Table.from_arrays(arrays, schema=schema))
+
+
+# models のインスタンスの値を Arrow の値に変換します
+def _arrow_value(value, arrow_type):
+    if value is None:
+        return None
+    if pa.types.is_date32(arrow_type):
+        return value.astimezone(TZ_JST).date()
+    if pa.types.is_timestamp(arrow_type) and arrow_type.tz is None:
+        return value.astimezone(TZ_JST).replace(tzinfo=None)
+    return value
+
+
+# models のインスタンスのリストを table_name のスキーマの Parquet にします
+def models_to_parquet(table_name, objs):
+    schema = arrow_schema(table_name)
+    arrays = [pa.array([_arrow_value(getattr(obj, f.name), f.type) for obj in objs], type=f.type) for f in schema]
+    return _to_parquet(pa.Table.from_arrays(arrays, schema=schema))
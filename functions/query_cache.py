@@ -0,0 +1,90 @@
+"""
+Cloud Functions のインスタンス内でクエリ結果を使い回すためのキャッシュです。
+グローバルスコープに置いておけば、インスタンスがウォームな間は次のリクエストでも生き残ります。
+キーにデータのバージョン(BigQuery にロード済みのスナップショットの created_at など)を含めることで、データのロードがあれば自然に別のキーになります。
+"""
+
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+
+# サイズと有効期限付きの LRU キャッシュ。
+# max_size: 保持するエントリ数の上限。超えたら最も長く使われていないものから捨てる
+# ttl: エントリの有効期限(秒)
+class QueryCache:
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # キャッシュされた値を返します。無いか期限切れの場合は None を返します。
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # キャッシュされた値を返します。無ければ loader() の戻り値をキャッシュしてから返します。
+    # loader() が None を返した場合はキャッシュしません。
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+
+        if value is not None:
+            return value, True
+
+        value = loader()
+
+        if value is not None:
+            self.put(key, value)
+
+        return value, False
+
+    # chunks(文字列の断片)をそのまま返すジェネレータです。
+    # 最後まで返し終えたときに、つなげた長さが max_bytes 以下ならばつなげたものをキャッシュします。
+    # 超えた場合は断片を溜めるのをやめて、キャッシュしません。
+    def tee_chunks(self, key, chunks, max_bytes):
+        buffered = []
+        size = 0
+
+        for chunk in chunks:
+            if buffered is not None:
+                size += len(chunk)
+
+                if size <= max_bytes:
+                    buffered.append(chunk)
+                else:
+                    buffered = None
+
+            yield chunk
+
+        if buffered is not None:
+            self.put(key, ''.join(buffered))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,107 @@
+"""
+スマイルカーブ用のCSVを、取り込み時にメモリ上の OptionChain から作るモジュールです。
+smile_data が BigQuery で option_price をピボットして作るものと同じCSVになります。
+数値の書式も揃うように、どちらも arrow_csv でCSVにします。
+"""
+
+import numpy as np
+
+from pytz import timezone
+
+import clients
+
+from config import Config
+
+config = Config()
+
+TZ_JST = timezone('Asia/Tokyo')
+
+# CSVのフォーマットのバージョン。フォーマットを変えたら上げること
+SMILE_FORMAT_VERSION = 2
+
+# GCS上のファイル名のパターン
+SMILE_FILE_NAME = 'smile/v{version}/smile_data_{suffix}.csv'
+
+
+# 行使価格 -> 値 の列を、target_prices の順に並べた pyarrow.Array にします。
+# 欠損している行使価格は null にします(BigQuery でピボットしたときと同じ)
+def _column(option_chain, name, target_prices, arrow_type):
+    import pyarrow as pa
+
+    mask = option_chain.masks[name]
+    values = option_chain.columns[name][mask]
+
+    if np.issubdtype(values.dtype, np.datetime64):
+        # 取引時刻は Unixtime にする
+        values = values.astype(np.int64)
+
+    index = np.searchsorted(target_prices, option_chain.columns['target_price'][mask])
+    column = np.zeros(len(target_prices), dtype=arrow_type.to_pandas_dtype())
+    column[index] = values
+
+    is_null = np.ones(len(target_prices), dtype=np.bool_)
+    is_null[index] = False
+
+    if np.issubdtype(column.dtype, np.floating):
+        is_null |= np.isnan(column)
+
+    return pa.array(column, type=arrow_type, mask=is_null)
+
+
+# スマイルカーブ用のCSVを作ります。
+# created_at: スナップショットの時刻
+# option_chain_1: 直近限月の OptionChain, option_chain_2: 次限月の OptionChain
+# 数値の書式が smile_data のクエリ結果と揃うように、同じ arrow_csv でCSVにする。
+# pyarrow は取り込み時にしか使わないので、ここで読み込む。smile_data がCSVを返すだけのときに読み込まないように
+def create_smile_csv(created_at, option_chain_1, option_chain_2):
+    import pyarrow as pa
+    import arrow_csv
+
+    target_prices = np.union1d(
+        option_chain_1.columns['target_price'], option_chain_2.columns['target_price']).astype(np.int64)
+    names = ['target_price']
+    arrays = [pa.array(target_prices, type=pa.int64())]
+
+    for prefix, option_chain in (('o1', option_chain_1), ('o2', option_chain_2)):
+        for option_type, chain in (('call', option_chain.calls), ('put', option_chain.puts)):
+            names += [f'{prefix}_{option_type}_iv', f'{prefix}_{option_type}_price_time']
+            arrays += [_column(chain, 'iv', target_prices, pa.float64()),
+                       _column(chain, 'price_time', target_prices, pa.int64())]
+
+    # ATMの行使価格。直近限月のPUTで判定する
+    puts_1 = option_chain_1.puts
+    is_atm = puts_1.masks['is_atm'] & puts_1.columns['is_atm']
+    o1_atm = int(puts_1.columns['target_price'][is_atm][0])
+
+    line1 = f'{int(created_at.timestamp())},{o1_atm}\n'
+    return line1 + arrow_csv.to_csv(pa.Table.from_arrays(arrays, names=names))
+
+
+# スマイルカーブ用のCSVを置くGCS上のファイル名を返します。
+# 時刻は JST にしてから文字列にする。アップロード時は JST、読み出し時は Cloud Datastore から返る UTC の created_at が渡されるため
+def smile_file_name(created_at):
+    suffix = created_at.astimezone(TZ_JST).strftime('%Y%m%d%H%M%S')
+    return SMILE_FILE_NAME.format(version=SMILE_FORMAT_VERSION, suffix=suffix)
+
+
+# スマイルカーブ用のCSVをGCSにアップロードします。
+# 数KBしかないので圧縮はしない
+def upload_smile_csv(created_at, smile_csv):
+    client = clients.storage_client()
+    bucket = client.bucket(config.gcp_cs_smile_bucket_name)
+
+    blob = bucket.blob(smile_file_name(created_at))
+    blob.upload_from_string(smile_csv, content_type='text/csv; charset=utf-8')
+
+
+# スマイルカーブ用のCSVをGCSからダウンロードします。無ければ None を返します。
+def download_smile_csv(created_at):
+    client = clients.storage_client()
+    bucket = client.bucket(config.gcp_cs_smile_bucket_name)
+
+    blob = bucket.get_blob(smile_file_name(created_at))
+
+    if blob is None:
+        return None
+
+    return blob.download_as_string().decode('utf-8')
@@ -0,0 +1,78 @@
+"""
+OptionPrice のリストを NDJSON にシリアライズする速度を、
+to_json() を1件ずつ呼ぶ従来の方法と models.to_ndjson(), OptionChain.to_ndjson() で比較するベンチマークです。
+両者の出力が一致することも確認します。
+
+usage: python tools/bench_ndjson.py [<html file>]
+       html file を省略した場合はダミーのオプション価格を生成して使います。
+"""
+
+import os
+import sys
+import time
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import jpx_loader
+import models
+from option_chain import OptionChain
+
+
+# ダミーのオプション価格のリストを生成します。4限月分(1,2限月のCALL/PUT)程度の件数にする
+def create_dummy_option_list(num_strikes=100):
+    created_at = models.TZ_JST.localize(datetime(2019, 5, 17, 15, 16))
+    price_time = models.TZ_JST.localize(datetime(2019, 5, 17, 15, 15))
+    last_trading_day = models.TZ_JST.localize(datetime(2019, 6, 13))
+    quotation_date = models.TZ_JST.localize(datetime(2019, 5, 16))
+
+    option_list = []
+
+    for month in range(2):
+        for option_type in models.OptionType:
+            for i in range(num_strikes):
+                option_list.append(models.OptionPrice(
+                    type=option_type, target_price=15000 + i * 125, is_atm=(i == num_strikes // 2),
+                    price=i + 1, price_time=price_time if i % 3 else None, diff=-i, diff_rate=-0.5,
+                    iv=18.5, bid=i, bid_volume=10, bid_iv=17.2, ask=i + 2, ask_volume=3, ask_iv=19.1,
+                    volume=1234, positions=5678, quotation=i, quotation_date=quotation_date,
+                    delta=0.51, gamma=0.0003, theta=-5.2, vega=12.3,
+                    last_trading_day=last_trading_day, created_at=created_at))
+
+    return option_list
+
+
+def bench(name, func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'{name}: {elapsed * 1000:.2f}ms')
+    return result, elapsed
+
+
+def main():
+    if len(sys.argv) > 1:
+        jpx = jpx_loader.parse_jpx_html(jpx_loader.load_html_from_file(sys.argv[1]))
+        option_list = jpx.call_option_list + jpx.put_option_list
+    else:
+        option_list = create_dummy_option_list()
+
+    repeat = int(os.environ.get('REPEAT', '20'))
+    print(f'number of options: {len(option_list)}')
+
+    json_old, elapsed_old = bench('to_json', lambda: '\n'.join(map(lambda x: x.to_json(), option_list)), repeat)
+    json_new, elapsed_new = bench('to_ndjson', lambda: models.to_ndjson(option_list), repeat)
+
+    option_chain = OptionChain.from_option_list(option_list)
+    json_chain, elapsed_chain = bench('OptionChain.to_ndjson', option_chain.to_ndjson, repeat)
+
+    print(f'to_ndjson identical: {json_old == json_new}, speedup: {elapsed_old / elapsed_new:.1f}x')
+    print(f'OptionChain.to_ndjson identical: {json_old == json_chain}, speedup: {elapsed_old / elapsed_chain:.1f}x')
+
+    sys.exit(0 if json_old == json_new == json_chain else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+3限月分のオプションチェーン全体のインプライド・ボラティリティとグリークスの計算速度を、
+option_pricing のベクトル化版と、行使価格ごとにループするスカラー版で比較するベンチマークです。
+
+usage: python tools/bench_option_pricing.py
+"""
+
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import option_pricing
+
+
+# 3限月 x CALL/PUT x 行使価格 のダミーのチェーンを作ります。
+# (プレミアム, 先物価格, 行使価格, 満期までの期間, CALLかどうか) の配列を返します。
+def create_dummy_surface(forward=21000.0):
+    strikes = np.arange(15000, 27001, 125, dtype=np.float64)
+    prices, forwards, strike_list, ts, is_calls = [], [], [], [], []
+
+    for days in (27, 55, 90):
+        t = np.full(strikes.shape, days / 365)
+        sigma = 0.15 + 0.1 * np.abs(np.log(strikes / forward))
+
+        for is_call in (True, False):
+            # 実際の気配値と同じく1円単位に丸める
+            price = np.round(option_pricing.black76_price(forward, strikes, t, sigma, is_call))
+            prices.append(price)
+            forwards.append(np.full(strikes.shape, forward))
+            strike_list.append(strikes)
+            ts.append(t)
+            is_calls.append(np.full(strikes.shape, is_call))
+
+    return (np.concatenate(prices), np.concatenate(forwards), np.concatenate(strike_list),
+            np.concatenate(ts), np.concatenate(is_calls))
+
+
+def scalar_price(forward, strike, t, sigma, is_call):
+    sigma_sqrt_t = sigma * math.sqrt(t)
+    d1 = (math.log(forward / strike) + 0.5 * sigma * sigma * t) / sigma_sqrt_t
+    d2 = d1 - sigma_sqrt_t
+    cdf = lambda x: 0.5 * math.erfc(-x / math.sqrt(2))
+    if is_call:
+        return forward * cdf(d1) - strike * cdf(d2)
+    return strike * cdf(-d2) - forward * cdf(-d1)
+
+
+def scalar_vega(forward, strike, t, sigma):
+    d1 = (math.log(forward / strike) + 0.5 * sigma * sigma * t) / (sigma * math.sqrt(t))
+    return forward * math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi) * math.sqrt(t)
+
+
+# option_pricing.black76_greeks と同じ単位の (delta, gamma, theta, vega) を1件ずつ計算するスカラー版。r = 0
+def scalar_greeks(forward, strike, t, sigma, is_call):
+    if not math.isfinite(sigma):
+        return math.nan, math.nan, math.nan, math.nan
+
+    sqrt_t = math.sqrt(t)
+    d1 = (math.log(forward / strike) + 0.5 * sigma * sigma * t) / (sigma * sqrt_t)
+    pdf_d1 = math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi)
+    cdf = lambda x: 0.5 * math.erfc(-x / math.sqrt(2))
+
+    delta = cdf(d1) if is_call else -cdf(-d1)
+    gamma = pdf_d1 / (forward * sigma * sqrt_t)
+    theta = -forward * pdf_d1 * sigma / (2.0 * sqrt_t)
+    vega = forward * pdf_d1 * sqrt_t
+
+    return delta, gamma, theta / 365.0, vega / 100.0
+
+
+# 1件分の IV とグリークスを計算します。ベクトル化版と同じ仕事をさせるため
+def scalar_iv_and_greeks(price, forward, strike, t, is_call):
+    sigma = scalar_implied_volatility(price, forward, strike, t, is_call)
+    return (sigma,) + scalar_greeks(forward, strike, t, sigma, is_call)
+
+
+# 1件ずつブラケット付きニュートン法で解くスカラー版
+def scalar_implied_volatility(price, forward, strike, t, is_call, tol=1e-6, max_iter=100):
+    intrinsic = max(forward - strike, 0.0) if is_call else max(strike - forward, 0.0)
+    upper = forward if is_call else strike
+
+    if not (intrinsic < price < upper):
+        return math.nan
+
+    lo, hi, sigma = option_pricing.VOL_MIN, option_pricing.VOL_MAX, option_pricing.VOL_INITIAL
+
+    for _ in range(max_iter):
+        diff = scalar_price(forward, strike, t, sigma, is_call) - price
+        if abs(diff) <= tol:
+            break
+
+        if diff > 0:
+            hi = sigma
+        else:
+            lo = sigma
+
+        vega = scalar_vega(forward, strike, t, sigma)
+        newton = sigma - diff / vega if vega > 0 else math.nan
+        sigma = newton if lo < newton < hi else 0.5 * (lo + hi)
+
+    return sigma
+
+
+def main():
+    price, forward, strike, t, is_call = create_dummy_surface()
+    repeat = int(os.environ.get('REPEAT', '10'))
+    print(f'number of options: {len(price)}')
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        iv_vector = option_pricing.implied_volatility(price, forward, strike, t, is_call)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            greeks_vector = np.stack(option_pricing.black76_greeks(forward, strike, t, iv_vector, is_call), axis=1)
+    elapsed_vector = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results_scalar = np.array([scalar_iv_and_greeks(*args) for args in zip(price, forward, strike, t, is_call)])
+    elapsed_scalar = (time.perf_counter() - start) / repeat
+
+    iv_scalar = results_scalar[:, 0]
+
+    both = np.isfinite(iv_vector) & np.isfinite(iv_scalar)
+    max_diff = np.max(np.abs(iv_vector[both] - iv_scalar[both])) if both.any() else 0.0
+    max_greeks_diff = np.max(np.abs(greeks_vector[both] - results_scalar[both, 1:])) if both.any() else 0.0
+
+    print(f'vectorized (iv + greeks): {elapsed_vector * 1000:.2f}ms')
+    print(f'scalar loop (iv + greeks): {elapsed_scalar * 1000:.2f}ms')
+    print(f'speedup: {elapsed_scalar / elapsed_vector:.1f}x, solved: {np.isfinite(iv_vector).sum()}, '
+          f'max iv diff: {max_diff:.2e}, max greeks diff: {max_greeks_diff:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Cloud Functions のエントリポイントごとのコールドスタートを計測するスクリプトです。
+
+functions ディレクトリで実行します。functions_py のエントリポイントも計測できます。
+エントリポイントごとに新しいプロセスを起動して、main の import にかかった時間と、
+読み込まれた重いモジュールを表示します。--invoke を付けると、続けてエントリポイントを1回呼び出して
+最初のリクエストにかかった時間も計測します。(GCPの認証情報と functions/auth.txt が必要です)
+
+    python tools/coldstart.py
+    python tools/coldstart.py --invoke --repeat 5 smile_data atm_data
+
+download_jpx は呼び出すとJPXからダウンロードしてデータを書き込むので、名前を指定したときだけ呼び出します。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FUNCTIONS_DIRS = {
+    'smile_data': 'functions',
+    'atm_data': 'functions',
+    'load_jpx_into_bq': 'functions',
+    'flush_jpx_into_bq': 'functions',
+    'download_jpx': 'functions',
+    'atm_iv_data': 'functions_py/atm_iv',
+    'rollup_ohlc': 'functions_py/timeframe',
+}
+
+# 名前を指定しなかったときに計測するエントリポイント。download_jpx は書き込みがあるので含めない
+DEFAULT_ENTRY_POINTS = ['smile_data', 'atm_data', 'load_jpx_into_bq', 'flush_jpx_into_bq', 'atm_iv_data', 'rollup_ohlc']
+
+# 読み込まれたかどうかを表示するモジュール
+HEAVY_MODULES = ['google.cloud.bigquery', 'google.cloud.storage', 'google.cloud.datastore',
+                 'pandas', 'pyarrow', 'numpy', 'pyquery', 'dataclasses_json']
+
+# 子プロセスで実行するコード。結果はJSONで標準出力の最後の行に出す
+CHILD_CODE = '''
+import json, sys, time
+
+entry_point, invoke, heavy_modules = sys.argv[1], sys.argv[2] == '1', sys.argv[3].split(',')
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+first_call_ms = None
+
+if invoke:
+    from types import SimpleNamespace
+
+    if entry_point in ('smile_data', 'atm_data', 'atm_iv_data'):
+        from flask import Flask
+        with open('auth.txt', 'r') as f:
+            token = f.readline().rstrip('\\r\\n')
+        with Flask(__name__).test_request_context(headers={'Authorization': f'Bearer {token}'}):
+            from flask import request
+            getattr(main, entry_point)(request)
+    elif entry_point == 'load_jpx_into_bq':
+        # 価格情報ファイルではないファイル名なので、ファイル名の判定までで終わる
+        main.load_jpx_into_bq({'bucket': '', 'name': 'coldstart', 'timeCreated': ''},
+                              SimpleNamespace(event_type='google.storage.object.finalize'))
+    else:
+        getattr(main, entry_point)({}, SimpleNamespace(event_type='google.pubsub.topic.publish'))
+
+    first_call_ms = (time.perf_counter() - imported) * 1000
+
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_call_ms': first_call_ms,
+    'heavy_modules': [m for m in heavy_modules if m in sys.modules],
+}))
+'''
+
+
+def run_once(root, entry_point, invoke):
+    cwd = os.path.join(root, FUNCTIONS_DIRS[entry_point])
+    proc = subprocess.run([sys.executable, '-c', CHILD_CODE, entry_point, '1' if invoke else '0', ','.join(HEAVY_MODULES)],
+                          cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    if proc.returncode != 0:
+        raise RuntimeError(f'{entry_point} failed:\n{proc.stderr}')
+
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cloud Functions のエントリポイントごとのコールドスタートを計測します')
+    parser.add_argument('entry_points', nargs='*', help=f'計測するエントリポイント。省略すると {" ".join(DEFAULT_ENTRY_POINTS)}')
+    parser.add_argument('--invoke', action='store_true', help='エントリポイントを1回呼び出して、最初のリクエストの時間も計測する')
+    parser.add_argument('--repeat', type=int, default=3, help='エントリポイントごとの計測回数。中央値を表示する')
+    args = parser.parse_args()
+
+    entry_points = args.entry_points or DEFAULT_ENTRY_POINTS
+    unknown = [e for e in entry_points if e not in FUNCTIONS_DIRS]
+
+    if unknown:
+        parser.error(f'unknown entry points: {unknown}')
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+    print(f'{"entry_point":<20}{"import_ms":>12}{"first_call_ms":>16}  heavy_modules')
+
+    for entry_point in entry_points:
+        results = [run_once(root, entry_point, args.invoke) for _ in range(args.repeat)]
+
+        import_ms = statistics.median(r['import_ms'] for r in results)
+        first_call_ms = statistics.median(r['first_call_ms'] for r in results) if args.invoke else None
+        first_call_str = f'{first_call_ms:.1f}' if first_call_ms is not None else '-'
+
+        print(f'{entry_point:<20}{import_ms:>12.1f}{first_call_str:>16}  {",".join(results[-1]["heavy_modules"])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+保存済みのJPXのHTMLを PyQuery版 と lxml版 の両方のパーサーで解析し、
+結果が一致することを確認するツールです。解析時間も合わせて表示します。
+
+usage: python tools/compare_jpx_parsers.py <html file> [<html file> ...]
+"""
+
+import os
+import sys
+import time
+
+from dataclasses import asdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import jpx_loader
+
+
+# 1ファイル分を両方のパーサーで解析して比較します。一致すれば True を返します。
+def compare(file_path, repeat):
+    html = jpx_loader.load_html_from_file(file_path)
+
+    results = {}
+    elapsed = {}
+
+    for parser in (jpx_loader.PARSER_PYQUERY, jpx_loader.PARSER_LXML):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            results[parser] = jpx_loader.parse_jpx_html(html, parser=parser)
+        elapsed[parser] = (time.perf_counter() - start) / repeat
+
+    is_same = asdict(results[jpx_loader.PARSER_PYQUERY]) == asdict(results[jpx_loader.PARSER_LXML])
+
+    print(f'{file_path}: {"OK" if is_same else "NG"}, '
+          f'pyquery={elapsed[jpx_loader.PARSER_PYQUERY] * 1000:.1f}ms, '
+          f'lxml={elapsed[jpx_loader.PARSER_LXML] * 1000:.1f}ms')
+
+    return is_same
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+
+    repeat = int(os.environ.get('REPEAT', '10'))
+    ng_count = sum(0 if compare(file_path, repeat) else 1 for file_path in sys.argv[1:])
+
+    sys.exit(1 if ng_count > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
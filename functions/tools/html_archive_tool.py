@@ -0,0 +1,285 @@
+"""
+html_archive で保存したJPXのページのHTMLを扱うツールです。functions ディレクトリで実行します。(GCPの認証情報が必要です)
+
+train-dict: 保存したHTMLから zstd の辞書を学習して Cloud Storage に置きます。
+            表示された辞書IDを Config.html_archive_dict_id に設定してデプロイすると、以降の圧縮に使われます。
+
+    python tools/html_archive_tool.py train-dict --date 2026-10-16
+
+reparse: 保存したHTMLを今のパーサーでパースし直して、BigQuery にロードし直せる価格情報ファイルを作ります。
+         1時間分のスナップショットを1つの仕事として、プロセスを並べてパースします。
+         出力: {out}/{テーブル名}_{YYYYMMDDHH}.json.gz (--format parquet ならば .parquet)
+
+    python tools/html_archive_tool.py reparse --src gs://optionchan-html/html/v1 --from 2026-01-01 --to 2026-06-30 --out /tmp/reparse
+    python tools/html_archive_tool.py reparse --src /tmp/html/v1 --dict-dir /tmp/html/dict --from 2026-01-01 --to 2026-06-30 --out /tmp/reparse
+
+--src には保存先のプレフィックス(gs://バケット/{html_archive_prefix})か、gsutil rsync でコピーしたローカルのディレクトリを指定します。
+"""
+
+import argparse
+import gzip
+import os
+import random
+import sys
+import time
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import clients
+import html_archive
+import jpx_loader
+import models
+import option_pricing
+import price_file
+
+from config import Config
+from my_logging import getLogger
+from option_chain import OptionChain
+
+log = getLogger(__name__)
+config = Config()
+
+PAGES_PER_SNAPSHOT = 3
+
+
+def parse_date(s):
+    return datetime.strptime(s, '%Y-%m-%d').date()
+
+
+def is_gcs(src):
+    return src.startswith('gs://')
+
+
+# gs://バケット/プレフィックス を (バケット, プレフィックス) に分けます
+def split_gcs_path(src):
+    bucket_name, _, prefix = src[len('gs://'):].partition('/')
+    return bucket_name, prefix.rstrip('/')
+
+
+# src の date_from から date_to までの日の、保存したHTMLの名前のリストを返します
+def list_archives(src, date_from, date_to):
+    names = []
+    date = date_from
+
+    while date <= date_to:
+        day = date.strftime('%Y%m%d')
+
+        if is_gcs(src):
+            bucket_name, prefix = split_gcs_path(src)
+            blobs = clients.storage_client().list_blobs(bucket_name, prefix=f'{prefix}/{day}/')
+            names.extend(f'gs://{bucket_name}/{blob.name}' for blob in blobs)
+        else:
+            day_dir = os.path.join(src, day)
+            if os.path.isdir(day_dir):
+                names.extend(os.path.join(day_dir, name) for name in sorted(os.listdir(day_dir)))
+
+        date = date + timedelta(days=1)
+
+    return [name for name in names if html_archive.parse_archive_name(name) is not None]
+
+
+def read_archive(name):
+    if is_gcs(name):
+        bucket_name, blob_name = split_gcs_path(name)
+        return clients.storage_client().bucket(bucket_name).blob(blob_name).download_as_string()
+
+    with open(name, 'rb') as f:
+        return f.read()
+
+
+# ローカルのディレクトリにある辞書(*.dict)を全て登録します
+def register_local_dicts(dict_dir):
+    if dict_dir is None:
+        return
+
+    for name in os.listdir(dict_dir):
+        if name.endswith('.dict'):
+            with open(os.path.join(dict_dir, name), 'rb') as f:
+                html_archive.register_dict(f.read())
+
+
+# ワーカープロセスの初期化。
+# 親プロセスで作ったクライアントのコネクションを子プロセスで使わないように捨てて、ローカルの辞書を登録します
+def init_worker(dict_dir):
+    clients.clear()
+    register_local_dicts(dict_dir)
+
+
+# 1つのスナップショットのページをパースします。
+# pages: 限月の番号 -> HTML(bytes)
+# 戻り値: (JpxOptionPriceInfo のリスト(直近限月から順), OptionChain)
+def parse_snapshot(pages):
+    jpx_list = [jpx_loader.parse_jpx_html(pages[nth]) for nth in range(1, PAGES_PER_SNAPSHOT + 1)]
+
+    # created_at は1限月のものに統一する。ingest_jpx と同じ
+    created_at = jpx_list[0].created_at
+
+    for jpx in jpx_list[1:]:
+        jpx.option_chain.fill('created_at', created_at)
+
+    if config.fill_missing_iv_and_greeks:
+        for jpx in jpx_list:
+            option_pricing.fill_missing_iv_and_greeks(jpx.option_chain, jpx.future_price.price, config.risk_free_rate)
+
+    return jpx_list, OptionChain.concat([jpx.option_chain for jpx in jpx_list])
+
+
+def write_price_files(out_dir, suffix, spot_price_list, future_price_list, option_chain, atm_price_list, file_format):
+    if file_format == price_file.FORMAT_PARQUET:
+        import price_parquet
+
+        contents = {
+            'spot_price': price_parquet.models_to_parquet('spot_price', spot_price_list),
+            'future_price': price_parquet.models_to_parquet('future_price', future_price_list),
+            'option_price': price_parquet.option_chain_to_parquet(option_chain),
+            'atm_price': price_parquet.models_to_parquet('atm_price', atm_price_list),
+        }
+        ext = 'parquet'
+    else:
+        contents = {
+            'spot_price': models.to_ndjson(spot_price_list),
+            'future_price': models.to_ndjson(future_price_list),
+            'option_price': option_chain.to_ndjson(),
+            'atm_price': models.to_ndjson(atm_price_list),
+        }
+        contents = {table: gzip.compress(data.encode('utf-8')) for table, data in contents.items()}
+        ext = 'json.gz'
+
+    for table, data in contents.items():
+        with open(os.path.join(out_dir, f'{table}_{suffix}.{ext}'), 'wb') as f:
+            f.write(data)
+
+
+# 1時間分のHTMLをパースし直して、価格情報ファイルを書き出します。ワーカープロセスで実行されます。
+# 戻り値: (YYYYMMDDHH, パースしたスナップショット数, 飛ばしたスナップショット数)
+def reparse_hour(hour, names, out_dir, file_format):
+    snapshots = defaultdict(dict)
+
+    for name in names:
+        snapshot_time, nth = html_archive.parse_archive_name(name)
+        snapshots[snapshot_time][nth] = html_archive.decompress(read_archive(name))
+
+    spot_price_list = []
+    future_price_list = []
+    option_chains = []
+    atm_price_list = []
+    skipped = 0
+
+    for snapshot_time in sorted(snapshots):
+        pages = snapshots[snapshot_time]
+
+        if any(nth not in pages for nth in range(1, PAGES_PER_SNAPSHOT + 1)):
+            log.warning(f'snapshot has missing pages. skipping..: {snapshot_time}, pages={sorted(pages)}')
+            skipped += 1
+            continue
+
+        try:
+            jpx_list, option_chain = parse_snapshot(pages)
+        except Exception:
+            log.exception(f'failed to parse snapshot. skipping..: {snapshot_time}')
+            skipped += 1
+            continue
+
+        spot_price_list.append(jpx_list[0].spot_price)
+        future_price_list.append(jpx_list[0].future_price)
+        option_chains.append(option_chain)
+        atm_price_list.extend(atm_price for atm_price in (jpx.atm_price() for jpx in jpx_list) if atm_price is not None)
+
+    if option_chains:
+        write_price_files(out_dir, hour, spot_price_list, future_price_list, OptionChain.concat(option_chains),
+                          atm_price_list, file_format)
+
+    return hour, len(option_chains), skipped
+
+
+def reparse(args):
+    started = time.time()
+    os.makedirs(args.out, exist_ok=True)
+
+    # 1時間ごとにまとめる
+    hours = defaultdict(list)
+
+    for name in list_archives(args.src, args.date_from, args.date_to):
+        snapshot_time, _ = html_archive.parse_archive_name(name)
+        hours[snapshot_time[:10]].append(name)
+
+    log.info(f'reparse: src={args.src}, hours={len(hours)}, files={sum(len(v) for v in hours.values())}')
+
+    total_snapshots = 0
+    total_skipped = 0
+    failed_hours = []
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.dict_dir,)) as executor:
+        futures = {executor.submit(reparse_hour, hour, names, args.out, args.format): hour
+                   for hour, names in sorted(hours.items())}
+
+        for future in as_completed(futures):
+            try:
+                hour, snapshots, skipped = future.result()
+            except Exception:
+                log.exception(f'failed to reparse: {futures[future]}')
+                failed_hours.append(futures[future])
+                continue
+
+            total_snapshots += snapshots
+            total_skipped += skipped
+            log.debug(f'reparsed: {hour}, snapshots={snapshots}, skipped={skipped}')
+
+    log.info(f'reparse finished: snapshots={total_snapshots}, skipped={total_skipped}, '
+             f'failed_hours={sorted(failed_hours)}, elapsed={time.time() - started:.1f}s')
+
+    return 1 if failed_hours else 0
+
+
+def train_dict(args):
+    src = args.src or f'gs://{config.html_archive_bucket_name}/{config.html_archive_prefix}'
+    names = list_archives(src, args.date, args.date)
+
+    if not names:
+        log.error(f'no archived html: {src}, {args.date}')
+        return 1
+
+    register_local_dicts(args.dict_dir)
+    samples = [html_archive.decompress(read_archive(name))
+               for name in random.sample(names, min(args.samples, len(names)))]
+
+    dict_id = html_archive.train_and_upload_dict(samples, args.dict_size)
+    print(f'dict_id={dict_id}  (set Config.html_archive_dict_id and deploy download_jpx)')
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='html_archive で保存したJPXのページのHTMLを扱います')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_train = subparsers.add_parser('train-dict', help='保存したHTMLから zstd の辞書を学習して Cloud Storage に置く')
+    parser_train.add_argument('--date', type=parse_date, required=True, help='サンプルにする日(YYYY-MM-DD)')
+    parser_train.add_argument('--src', help='保存先のプレフィックスかローカルのディレクトリ。省略すると Config の保存先')
+    parser_train.add_argument('--dict-dir', help='展開に使う辞書(*.dict)があるローカルのディレクトリ')
+    parser_train.add_argument('--samples', type=int, default=1000, help='サンプルにするページの数')
+    parser_train.add_argument('--dict-size', type=int, default=112640, help='辞書の大きさ(bytes)')
+    parser_train.set_defaults(func=train_dict)
+
+    parser_reparse = subparsers.add_parser('reparse', help='保存したHTMLをパースし直して価格情報ファイルを作る')
+    parser_reparse.add_argument('--src', required=True, help='保存先のプレフィックス(gs://...)かローカルのディレクトリ')
+    parser_reparse.add_argument('--from', dest='date_from', type=parse_date, required=True, help='最初の日(YYYY-MM-DD)')
+    parser_reparse.add_argument('--to', dest='date_to', type=parse_date, required=True, help='最後の日(YYYY-MM-DD)')
+    parser_reparse.add_argument('--out', required=True, help='価格情報ファイルを書き出すディレクトリ')
+    parser_reparse.add_argument('--format', choices=[price_file.FORMAT_NDJSON, price_file.FORMAT_PARQUET],
+                                default=price_file.FORMAT_NDJSON, help='価格情報ファイルのフォーマット')
+    parser_reparse.add_argument('--workers', type=int, default=os.cpu_count(), help='パースするプロセスの数')
+    parser_reparse.add_argument('--dict-dir', help='展開に使う辞書(*.dict)があるローカルのディレクトリ')
+    parser_reparse.set_defaults(func=reparse)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+BigQuery のクエリ結果を pandas.DataFrame を経由せずに Arrow のまま CSV にするモジュールです。
+結果はページ単位の RecordBatch で受け取り、列ごとにまとめて変換してから、バッチごとの CSV の断片にします。
+一度にメモリに載るのは1ページ分だけなので、結果の行数によらずメモリの使用量が抑えられます。
+"""
+
+import io
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+# JST の UTC からのオフセット(秒)
+JST_OFFSET_SECONDS = 9 * 3600
+
+# 文字列の列も数値と日時しか入らないので、引用符では囲まない
+CSV_WRITE_OPTIONS = pa_csv.WriteOptions(include_header=False, quoting_style='none')
+
+
+# クエリ結果(RowIterator)を Arrow の RecordBatch で1ページずつ返します
+def iter_record_batches(rows):
+    yield from rows.to_arrow_iterable()
+
+
+# タイムゾーン無しの日時(DATETIME)の列を Unixtime(秒)の列にします。
+# offset_seconds: 日時のタイムゾーンの UTC からのオフセット(秒)
+def datetime_to_epoch(array, offset_seconds=0):
+    seconds = pc.cast(pc.cast(array, pa.timestamp('s'), safe=False), pa.int64())
+    return pc.subtract(seconds, offset_seconds)
+
+
+# タイムスタンプ(TIMESTAMP)の列を '2020-01-01 00:00:00+00:00' 形式の文字列の列にします
+def timestamp_to_string(array):
+    utc = pc.cast(array, pa.timestamp('s'), safe=False)
+    return pc.strftime(utc, format='%Y-%m-%d %H:%M:%S+00:00')
+
+
+# 列を変換した RecordBatch を返します。
+# converters: 列名 -> 列を変換する関数
+def convert_columns(batch, converters):
+    arrays = [converters[name](column) if name in converters else column
+              for name, column in zip(batch.schema.names, batch.columns)]
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+# RecordBatch(または Table) をヘッダ無しの CSV の文字列にします。欠損値は空になります
+def to_csv(batch):
+    buf = io.BytesIO()
+    pa_csv.write_csv(batch, buf, CSV_WRITE_OPTIONS)
+    return buf.getvalue().decode('utf-8')
+
+
+# RecordBatch ごとに列を変換して、CSV の断片を返すジェネレータです
+def iter_csv(batches, converters=None):
+    for batch in batches:
+        if converters:
+            batch = convert_columns(batch, converters)
+
+        if batch.num_rows > 0:
+            yield to_csv(batch)
@@ -5,3 +5,20 @@ from dataclasses import dataclass
 class Config:
     gcp_project_id: str = 'optionchan-222710'
     gcp_bq_dataset_name: str = 'optionchan'
+    gcp_ds_kind: str = 'optionchan'
+    gcp_ds_key_id: str = 'prev_future_price'
+    gcp_ds_contract_calendar_key_id: str = 'contract_calendar'
+    # functions の bq_loader が記録する、BigQuery にロード済みの最後のファイル名のキーの接頭辞
+    gcp_ds_bq_load_watermark_key_prefix: str = 'bq_load_watermark_'
+    # CSVのキャッシュのエントリ数の上限
+    query_cache_max_size: int = 32
+    # CSVのキャッシュの有効期限(秒)。取り込みが止まっていても、これより古いものは返さない
+    query_cache_ttl_seconds: int = 300
+    # キャッシュするCSVの大きさの上限(バイト)。これより大きいものはキャッシュせずに返すだけにする
+    query_cache_max_entry_bytes: int = 1024 * 1024
+    # クエリ結果を1度に読み出す行数。メモリに載るのはこの行数分だけ
+    bq_result_page_size: int = 5000
+    # BigQuery のクエリを実行する前に dry run で処理するバイト数を見積もり、上限を超えるものは実行しないかどうか
+    bq_query_budget_enabled: bool = True
+    # 処理するバイト数の上限
+    bq_query_max_bytes: int = 100 * 1024 * 1024
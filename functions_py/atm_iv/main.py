@@ -1,9 +1,15 @@
-from flask import make_response
+import re
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from flask import Response
 from google.cloud import bigquery
 
 # my modules
-import config
+import arrow_csv, bq_query, clients, config
 from my_logging import getLogger
+from query_cache import QueryCache
 
 log = getLogger(__name__)
 config = config.Config()
@@ -11,6 +17,28 @@ config = config.Config()
 with open('auth.txt', 'r') as f:
     cf_token = f.readline().rstrip('\r\n')
 
+# 時間足の時間枠(秒)。timeframe の rollup_ohlc が作るもの
+TIME_FRAMES = ['300', '900', '3600', '86400']
+
+# 最小の時間足の時間枠(秒)。進行中の足はこれから集計する
+BASE_TIME_FRAME = 300
+
+ONE_DAY = 86400
+
+TZ_JST = timezone(timedelta(hours=9))
+
+# 価格情報ファイルの名前に含まれる created_at (JST)
+REGEX_PRICE_FILE_TIME = re.compile(r'[a-z_]+_(\d{14})')
+
+# CSVのキャッシュ。インスタンスがウォームな間は使い回す。
+# キーは (d, n, tf, BigQuery にロード済みのスナップショットの created_at)
+query_cache = QueryCache(config.query_cache_max_size, config.query_cache_ttl_seconds)
+
+# CSVにするときの列の変換
+CSV_CONVERTERS = {
+    'started_at': arrow_csv.timestamp_to_string,
+}
+
 
 # entry point of Cloud Functions
 # trigger = http
@@ -20,52 +48,94 @@ def atm_iv_data(request):
 
     num_days = request.args.get('d', default='7')
     n_th_contract_month = request.args.get('n', default='0')
+    time_frame = request.args.get('tf', default='3600')
+
+    if time_frame not in TIME_FRAMES or not n_th_contract_month.isdigit() or not num_days.isdigit():
+        return 'Bad Request', 400
+
+    created_at = find_loaded_created_at()
+    key = (num_days, n_th_contract_month, time_frame, created_at)
+
+    if created_at is not None:
+        atm_iv_csv = query_cache.get(key)
+        log.debug(f'query cache {"hit" if atm_iv_csv is not None else "miss"}: key={key}')
 
-    df = query_atm_iv(num_days, n_th_contract_month)
+        if atm_iv_csv is not None:
+            return make_csv_response(atm_iv_csv)
 
-    # CSV化
-    atm_iv_csv = df.to_csv(index=False, header=False)
+    try:
+        rows = query_atm_iv(num_days, n_th_contract_month, time_frame)
+    except bq_query.QueryBudgetExceededError as e:
+        # d が大きすぎるなど。リクエストは正しいが、今は応えられない
+        log.warning(str(e))
+        return 'Service Unavailable', 503
 
-    res = make_response(atm_iv_csv, 200)
-    res.headers['Content-type'] = 'text/csv; charset=utf-8'
-    return res
+    # 結果はページごとにCSVにして、そのまま返していく。d が大きくても全体をメモリに載せないように
+    chunks = arrow_csv.iter_csv(arrow_csv.iter_record_batches(rows), CSV_CONVERTERS)
 
+    if created_at is not None:
+        chunks = query_cache.tee_chunks(key, chunks, config.query_cache_max_entry_bytes)
 
-def query_atm_iv(num_days, n_th_contract_month=0):
+    return make_csv_response(chunks)
+
+
+# CSVのレスポンスを作ります。csv は文字列か、CSVの断片を返すジェネレータ
+def make_csv_response(csv):
+    return Response(csv, 200, content_type='text/csv; charset=utf-8')
+
+
+# time_frame: 時間足の時間枠(秒)。TIME_FRAMES のいずれか
+# now: 現在時刻(epoch秒)。省略すると現在時刻
+# 値は全てクエリパラメータで渡し、時刻は最小の時間足の区切りに揃えるので、
+# 同じ時間足の間は同じクエリになって BigQuery のキャッシュが効く。
+# 戻り値: 結果の RowIterator。arrow_csv.iter_record_batches でページごとに読み出してください
+def query_atm_iv(num_days, n_th_contract_month=0, time_frame=3600, now=None):
     table_iv = f'{config.gcp_bq_dataset_name}.atm_iv'
-    table_option_price = f'{config.gcp_bq_dataset_name}.option_price'
+
+    num_days = int(num_days)
+    time_frame = int(time_frame)
+    now = bucket_start(int(time.time()) if now is None else now, BASE_TIME_FRAME)
+
+    # n番目の限月の最終取引日は限月カレンダーから引く
+    last_trading_day = find_nth_last_trading_day(int(n_th_contract_month))
+
+    # num_days 日前の0時(UTC)から
+    started_at_from = bucket_start(now - num_days * ONE_DAY, ONE_DAY)
+    # 進行中の足と、その1つ前の足(確定済みの足の集計が済んでいない場合のため)
+    in_progress_from = bucket_start(now, time_frame) - time_frame
 
     query = (f'''
-        WITH t1 AS (
-            SELECT
-                (ARRAY_AGG(DISTINCT(last_trading_day) IGNORE NULLS ORDER BY last_trading_day ASC))[OFFSET({n_th_contract_month})] AS last_trading_day
-            FROM
-                {table_iv}
-            WHERE
-                started_at > TIMESTAMP_TRUNC(TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL -10 DAY), DAY)
-                AND last_trading_day >=  CURRENT_DATE('Asia/Tokyo')
-        ), t2 AS (
+        WITH t2 AS (
             SELECT
                 open,high,low,close, started_at
             FROM
-                {table_iv}
+                `{table_iv}`
             WHERE
-                last_trading_day=(SELECT t1.last_trading_day FROM t1)
-                AND started_at >= TIMESTAMP_TRUNC(TIMESTAMP_ADD(CURRENT_TIMESTAMP() , INTERVAL -{num_days} DAY), DAY)
+                last_trading_day = @last_trading_day
+                AND time_frame = @time_frame
+                AND started_at >= @started_at_from
         ), t3 AS (
-            -- まだ時間足集計が保存されていない分(=UTCでの当日分)の時間足を集計する
-            SELECT  
-                (array_agg(iv IGNORE NULLS ORDER BY created_at ASC))[OFFSET(0)] open,
-                MAX(iv) high,
-                MIN(iv) low,
-                (array_agg(iv IGNORE NULLS ORDER BY created_at DESC))[OFFSET(0)] close,
-                TIMESTAMP_SECONDS(CAST(TRUNC(UNIX_SECONDS(created_at)/3600) AS INT64) * 3600) AS started_at
-            FROM
-                {table_option_price}
+            -- まだ確定していない足(=集計済みの最後の足より後)を最小の時間足から集計する
+            SELECT
+                (array_agg(open IGNORE NULLS ORDER BY started_at ASC))[SAFE_OFFSET(0)] open,
+                MAX(high) high,
+                MIN(low) low,
+                (array_agg(close IGNORE NULLS ORDER BY started_at DESC))[SAFE_OFFSET(0)] close,
+                bucket AS started_at
+            FROM (
+                SELECT
+                    *, TIMESTAMP_SECONDS(DIV(UNIX_SECONDS(started_at), @time_frame) * @time_frame) AS bucket
+                FROM
+                    `{table_iv}`
+                WHERE
+                    last_trading_day = @last_trading_day
+                    AND time_frame = @base_time_frame
+                    AND started_at >= @in_progress_from
+                    AND started_at >= @started_at_from
+            )
             WHERE
-                created_at >= TIMESTAMP_TRUNC(CURRENT_TIMESTAMP(), DAY)
-                AND is_atm=True AND type=2 AND last_trading_day=(SELECT t1.last_trading_day FROM t1)
-            GROUP BY started_at
+                bucket > IFNULL((SELECT MAX(started_at) FROM t2), TIMESTAMP_SECONDS(0))
+            GROUP BY bucket
         )
         SELECT
             open, high, low, close, started_at
@@ -81,12 +151,75 @@ def query_atm_iv(num_days, n_th_contract_month=0):
         ORDER BY started_at
     ''')
 
-    client = bigquery.Client()
-    query_job = client.query(query)
-    rows = query_job.result()
-    df = rows.to_dataframe()
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('last_trading_day', 'DATE', last_trading_day),
+        bigquery.ScalarQueryParameter('time_frame', 'INT64', time_frame),
+        bigquery.ScalarQueryParameter('base_time_frame', 'INT64', BASE_TIME_FRAME),
+        bigquery.ScalarQueryParameter('started_at_from', 'TIMESTAMP', datetime.fromtimestamp(started_at_from, timezone.utc)),
+        bigquery.ScalarQueryParameter('in_progress_from', 'TIMESTAMP', datetime.fromtimestamp(in_progress_from, timezone.utc)),
+    ])
+
+    max_bytes = config.bq_query_max_bytes if config.bq_query_budget_enabled else None
+    query_job = bq_query.run_query(query, 'atm_iv_data', job_config, max_bytes)
+
+    return query_job.result(page_size=config.bq_result_page_size)
+
+
+# epoch秒を時間枠の開始時刻に切り捨てます
+def bucket_start(epoch, time_frame):
+    return epoch // time_frame * time_frame
+
+
+# download_jpx が Cloud Datastore に記録した最新スナップショットの created_at を返します。
+# 一度も記録されていなければ None を返します。
+def find_latest_created_at():
+    client = clients.datastore_client()
+
+    key = client.key(config.gcp_ds_kind, config.gcp_ds_key_id)
+    prev_future_price = client.get(key)
+
+    if prev_future_price is None:
+        return None
+
+    return prev_future_price['created_at']
+
+
+# BigQuery にロード済みの atm_price の最後の created_at を返します。最新スナップショットより新しいものは返しません。
+# 時間足はロード済みの atm_price から作られるので、これをデータのバージョンとしてキャッシュのキーにする。
+# 最新スナップショットの created_at はロードより先に進むので、それをキーにすると古いCSVが新しいものとしてキャッシュされるため。
+# ロードの記録が無ければ最新スナップショットの created_at を、一度も取り込んでいなければ None を返します。
+def find_loaded_created_at():
+    latest_created_at = find_latest_created_at()
+
+    if latest_created_at is None:
+        return None
+
+    client = clients.datastore_client()
+
+    key = client.key(config.gcp_ds_kind, f'{config.gcp_ds_bq_load_watermark_key_prefix}atm_price')
+    watermark = client.get(key)
+
+    if watermark is None:
+        return latest_created_at
+
+    m = REGEX_PRICE_FILE_TIME.match(watermark['last_loaded_name'])
+    loaded_created_at = datetime.strptime(m.group(1), '%Y%m%d%H%M%S').replace(tzinfo=TZ_JST)
+
+    return min(loaded_created_at, latest_created_at)
+
+
+# download_jpx が Cloud Datastore に記録した限月カレンダーから、
+# n 番目(0始まり)に近い限月の最終取引日を 'YYYY-MM-DD' で返します。無ければ None を返します。
+def find_nth_last_trading_day(n):
+    client = clients.datastore_client()
+
+    key = client.key(config.gcp_ds_kind, config.gcp_ds_contract_calendar_key_id)
+    calendar = client.get(key)
+
+    if calendar is None or n >= len(calendar['last_trading_days']):
+        return None
 
-    return df
+    return calendar['last_trading_days'][n]
 
 
 def check_auth(request):
@@ -1,4 +1,5 @@
 from logging import StreamHandler, Formatter, DEBUG, INFO
+import json
 import logging
 
 
@@ -12,3 +13,34 @@ def getLogger(name):
     log.addHandler(handler)
 
     return log
+
+
+# 1行1JSONで出力するフォーマッタ。
+# Cloud Logging は1行全体がJSONのログを jsonPayload として取り込むので、フィールドで検索や集計ができる。
+# フィールドは log.info('message', extra={'fields': {...}}) のように渡す。
+class JsonFormatter(Formatter):
+
+    def format(self, record):
+        payload = {
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        payload.update(getattr(record, 'fields', {}))
+
+        return json.dumps(payload, default=str)
+
+
+# 構造化ログ用のロガーを返します。getLogger のものとは別のロガーで、JSONだけを出力します。
+def getStructuredLogger(name):
+    log = logging.getLogger(f'{name}.structured')
+
+    if not log.handlers:
+        handler = StreamHandler()
+        handler.setLevel(DEBUG)
+        handler.setFormatter(JsonFormatter())
+        log.setLevel(DEBUG)
+        log.addHandler(handler)
+        log.propagate = False
+
+    return log
@@ -0,0 +1,97 @@
+"""
+BigQuery のジョブを実行して、処理したバイト数や課金バイト数、スロット時間、キャッシュヒット、所要時間を
+構造化ログ(my_logging.getStructuredLogger)に出力するモジュールです。
+上限のバイト数を渡すと先に dry run で見積もり、超えるクエリは実行せずに QueryBudgetExceededError にします。
+"""
+
+import time
+
+import clients
+
+from my_logging import getStructuredLogger
+
+slog = getStructuredLogger(__name__)
+
+
+# dry run で見積もったバイト数が上限を超えた
+class QueryBudgetExceededError(Exception):
+
+    def __init__(self, label, estimated_bytes, max_bytes):
+        super().__init__(f'query budget exceeded: label={label}, estimated_bytes={estimated_bytes}, max_bytes={max_bytes}')
+        self.label = label
+        self.estimated_bytes = estimated_bytes
+        self.max_bytes = max_bytes
+
+
+# ジョブの統計情報をログに出力します。
+# label: どこから実行したジョブかを表す名前(エンドポイント名など)
+def log_job(job, label, duration_ms, **fields):
+    stats = {
+        'label': label,
+        'job_id': job.job_id,
+        'job_type': job.job_type,
+        'duration_ms': duration_ms,
+    }
+
+    if job.job_type == 'query':
+        stats.update({
+            'total_bytes_processed': job.total_bytes_processed,
+            'total_bytes_billed': job.total_bytes_billed,
+            'slot_millis': job.slot_millis,
+            'cache_hit': job.cache_hit,
+        })
+    elif job.job_type == 'load':
+        stats.update({
+            'input_files': job.input_files,
+            'input_file_bytes': job.input_file_bytes,
+            'output_rows': job.output_rows,
+        })
+
+    stats.update(fields)
+    slog.info('bigquery job finished', extra={'fields': stats})
+
+
+# クエリを dry run して、処理するバイト数の見積もりを返します。
+# BigQuery のライブラリはここで読み込む。QueryBudgetExceededError を捕まえるだけのエントリポイントで読み込まないように
+def estimate_bytes(client, query, job_config=None):
+    from google.cloud import bigquery
+
+    dry_run_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr()) \
+        if job_config is not None else bigquery.QueryJobConfig()
+    dry_run_config.dry_run = True
+    dry_run_config.use_query_cache = False
+
+    return client.query(query, job_config=dry_run_config).total_bytes_processed
+
+
+# クエリを実行して、完了した QueryJob を返します。結果は job.result() で取り出してください。
+# max_bytes: 処理するバイト数の上限。None ならば見積もりはしません
+def run_query(query, label, job_config=None, max_bytes=None, client=None):
+    client = client or clients.bigquery_client()
+    fields = {}
+
+    if max_bytes is not None:
+        estimated_bytes = estimate_bytes(client, query, job_config)
+        fields['estimated_bytes'] = estimated_bytes
+
+        if estimated_bytes > max_bytes:
+            slog.warning('bigquery query refused', extra={'fields': {
+                'label': label, 'estimated_bytes': estimated_bytes, 'max_bytes': max_bytes}})
+            raise QueryBudgetExceededError(label, estimated_bytes, max_bytes)
+
+    started = time.monotonic()
+    job = client.query(query, job_config=job_config)
+    job.result()
+
+    log_job(job, label, int((time.monotonic() - started) * 1000), **fields)
+    return job
+
+
+# 実行済みのジョブの完了を待って、統計情報をログに出力します。ロードジョブなど run_query を通さないジョブ用
+# timeout: 待つ秒数。過ぎたら concurrent.futures.TimeoutError になる(ジョブは止まらない)。None ならば終わるまで待つ
+def wait_job(job, label, started=None, timeout=None):
+    started = started or time.monotonic()
+    job.result(timeout=timeout)
+
+    log_job(job, label, int((time.monotonic() - started) * 1000))
+    return job
@@ -0,0 +1,60 @@
+"""
+BigQuery, Cloud Storage, Cloud Datastore のクライアントを、プロセス内で1つずつ使い回すためのモジュールです。
+クライアントは最初に使われたときに作り、インスタンスがウォームな間は次のリクエストでも同じものを使います。
+ライブラリの import も最初に使われたときまで遅らせるので、使わないエントリポイントのコールドスタートが軽くなります。
+"""
+
+from threading import Lock
+
+_clients = {}
+_lock = Lock()
+
+
+# name のクライアントを返します。まだ無ければ create() で作ります
+def _get_or_create(name, create):
+    client = _clients.get(name)
+
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(name)
+
+        if client is None:
+            client = create()
+            _clients[name] = client
+
+    return client
+
+
+def _create_bigquery_client():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+
+def _create_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+def _create_datastore_client():
+    from google.cloud import datastore
+    return datastore.Client()
+
+
+def bigquery_client():
+    return _get_or_create('bigquery', _create_bigquery_client)
+
+
+def storage_client():
+    return _get_or_create('storage', _create_storage_client)
+
+
+def datastore_client():
+    return _get_or_create('datastore', _create_datastore_client)
+
+
+# 作ったクライアントを全て捨てます。ベンチマークでコールドスタートを再現するときに使います
+def clear():
+    with _lock:
+        _clients.clear()
@@ -5,3 +5,16 @@ from dataclasses import dataclass
 class Config:
     gcp_project_id: str = 'optionchan-222710'
     gcp_bq_dataset_name: str = 'optionchan'
+    # rollup_ohlc で最小の時間足を集計し直す期間(秒)。取り込みの遅れを吸収できる長さにする。
+    # functions の bq_load_batch_size を 2 以上にする場合は、bq_load_batch_window_seconds + bq_load_batch_grace_seconds
+    # + flush_jpx_into_bq の間隔(300秒) より長くすること
+    ohlc_rollup_lookback_seconds: int = 900
+    # rollup_ohlc が呼ばれる間隔(秒)。Cloud Scheduler の設定と合わせること
+    ohlc_rollup_interval_seconds: int = 300
+    # insert_ohlc で作り直す日数。前日に呼ばれ損ねた分も補完できるように2日以上にする
+    ohlc_insert_days: int = 2
+    # 期間を日ごとに作り直すときに、同時に実行するジョブの数の上限
+    ohlc_backfill_max_workers: int = 8
+    # 他の DML とぶつかって失敗したときにやり直す回数と間隔(秒。回数に比例して延ばす)
+    ohlc_backfill_max_retries: int = 3
+    ohlc_backfill_retry_interval_seconds: int = 10
@@ -1,109 +1,272 @@
-from google.cloud import bigquery
+import argparse
+import base64
+import json
+import time
 
-import config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import bq_query, config
 from my_logging import getLogger
 
 log = getLogger(__name__)
 config = config.Config()
 
+# 時間足を集計する atm_price のカラムと、集計結果を格納するテーブルの対応。
+# atm_price のスキャンは集計するカラムの数によらず1回で済むので、
+# 時間足を増やす場合は atm_price にカラムを足してここに追加するだけでよい。
+OHLC_MEASURES = [
+    ('iv', 'atm_iv'),
+    ('price', 'atm_option_price'),
+    ('target_price', 'atm_target_price'),
+]
 
-def insert_ohlc_iv():
-    from_table = f'{config.gcp_bq_dataset_name}.option_price'
-    to_table = f'{config.gcp_bq_dataset_name}.atm_iv'
+# 最小の時間足の時間枠(秒)。これだけは atm_price から直接集計する
+BASE_TIME_FRAME = 300
 
-    query = (f'''
-        CREATE TEMP FUNCTION DT() AS (CURRENT_TIMESTAMP());
+# 上位の時間足の時間枠(秒)と、集計元にする1つ下の時間足の時間枠の対応。小さい順に並べること。
+# 日足の区切りはUTCの0時(=JSTの9時、日中立会の開始)になる
+ROLLUP_TIME_FRAMES = [
+    (900, 300),
+    (3600, 900),
+    (86400, 3600),
+]
 
-        INSERT `{to_table}` (open, high, low, close, last_trading_day, time_frame, started_at) 
-        
-        WITH t1 as (
-            SELECT  
-                (array_agg(iv IGNORE NULLS ORDER BY created_at ASC))[OFFSET(0)] open,
-                MAX(iv) high,
-                MIN(iv) low,
-                (array_agg(iv IGNORE NULLS ORDER BY created_at DESC))[OFFSET(0)] close,
-                last_trading_day,
-                3600 time_frame,
-                TIMESTAMP_SECONDS(CAST(TRUNC(UNIX_SECONDS(created_at)/3600) AS INT64) * 3600) AS started_at
-            FROM `{from_table}`
-            WHERE is_atm=True AND type=2 AND created_at >= TIMESTAMP_TRUNC(TIMESTAMP_ADD(DT(), INTERVAL -1 DAY), DAY) AND created_at < TIMESTAMP_TRUNC(DT(), DAY)
-            GROUP BY last_trading_day, started_at
-        )        
-        SELECT * FROM t1;
-    ''')
-
-    client = bigquery.Client()
-    query_job = client.query(query)
-    query_job.result()
-
-
-def insert_ohlc_option_price():
-    from_table = f'{config.gcp_bq_dataset_name}.option_price'
-    to_table = f'{config.gcp_bq_dataset_name}.atm_option_price'
-
-    query = (f'''
-        CREATE TEMP FUNCTION DT() AS (CURRENT_TIMESTAMP());
-
-        INSERT `{to_table}` (open, high, low, close, last_trading_day, time_frame, started_at) 
-
-        WITH t1 as (
-            SELECT  
-                (array_agg(price IGNORE NULLS ORDER BY created_at ASC))[OFFSET(0)] open,
-                MAX(price) high,
-                MIN(price) low,
-                (array_agg(price IGNORE NULLS ORDER BY created_at DESC))[OFFSET(0)] close,
-                last_trading_day,
-                3600 time_frame,
-                TIMESTAMP_SECONDS(CAST(TRUNC(UNIX_SECONDS(created_at)/3600) AS INT64) * 3600) AS started_at
-            FROM `{from_table}`
-            WHERE is_atm=True AND type=2 AND created_at >= TIMESTAMP_TRUNC(TIMESTAMP_ADD(DT(), INTERVAL -1 DAY), DAY) AND created_at < TIMESTAMP_TRUNC(DT(), DAY)
-            GROUP BY last_trading_day, started_at
-        )        
-        SELECT * FROM t1;
-    ''')
-
-    client = bigquery.Client()
-    query_job = client.query(query)
-    query_job.result()
-
-
-def insert_ohlc_target_price():
-    from_table = f'{config.gcp_bq_dataset_name}.option_price'
-    to_table = f'{config.gcp_bq_dataset_name}.atm_target_price'
-
-    query = (f'''
-        CREATE TEMP FUNCTION DT() AS (CURRENT_TIMESTAMP());
-
-        INSERT `{to_table}` (open, high, low, close, last_trading_day, time_frame, started_at) 
-
-        WITH t1 as (
-            SELECT  
-                (array_agg(target_price IGNORE NULLS ORDER BY created_at ASC))[OFFSET(0)] open,
-                MAX(target_price) high,
-                MIN(target_price) low,
-                (array_agg(target_price IGNORE NULLS ORDER BY created_at DESC))[OFFSET(0)] close,
+ONE_DAY = 86400
+
+
+# epoch秒を時間枠の開始時刻に切り捨てます
+def bucket_start(epoch, time_frame):
+    return epoch // time_frame * time_frame
+
+
+# 集計結果を時間足のテーブルへ MERGE する文を組み立てます。
+# (last_trading_day, time_frame, started_at) が同じ足は上書きするので、同じ期間を何度集計しても重複しない。
+# source_query: open, high, low, close, last_trading_day, time_frame, started_at を返すクエリ
+# 期間: [started_at_from, started_at_to) (epoch秒)。
+# 更新先もこの期間のパーティションに絞るので、期間が重ならない MERGE は並行して実行できる
+def build_merge_ohlc_statement(to_table, source_query, started_at_from, started_at_to):
+    return (f'''
+        MERGE `{config.gcp_bq_dataset_name}.{to_table}` t
+        USING ({source_query}) s
+        ON t.last_trading_day = s.last_trading_day AND t.time_frame = s.time_frame AND t.started_at = s.started_at
+            AND t.started_at >= TIMESTAMP_SECONDS({started_at_from}) AND t.started_at < TIMESTAMP_SECONDS({started_at_to})
+        WHEN MATCHED THEN
+            UPDATE SET open = s.open, high = s.high, low = s.low, close = s.close
+        WHEN NOT MATCHED THEN
+            INSERT (open, high, low, close, last_trading_day, time_frame, started_at)
+            VALUES (s.open, s.high, s.low, s.close, s.last_trading_day, s.time_frame, s.started_at);
+''')
+
+
+# atm_price から最小の時間足を集計する文を組み立てます。
+# atm_price は download_jpx がスナップショットごとに限月ごとのATMのPUTを1行ずつ入れたもの。
+# 全カラムを1回のスキャンで一時テーブルに集計し、そこからそれぞれのテーブルへ MERGE します。
+# 期間: [created_at_from, created_at_to) (epoch秒)
+def build_base_ohlc_statements(created_at_from, created_at_to, measures=OHLC_MEASURES, time_frame=BASE_TIME_FRAME):
+    from_table = f'{config.gcp_bq_dataset_name}.atm_price'
+
+    aggregations = ','.join(f'''
+                (array_agg({column} IGNORE NULLS ORDER BY created_at ASC))[SAFE_OFFSET(0)] {column}_open,
+                MAX({column}) {column}_high,
+                MIN({column}) {column}_low,
+                (array_agg({column} IGNORE NULLS ORDER BY created_at DESC))[SAFE_OFFSET(0)] {column}_close'''
+                            for column, _ in measures)
+
+    statements = [f'''
+        CREATE TEMP TABLE ohlc AS
+        SELECT{aggregations},
+            last_trading_day,
+            TIMESTAMP_SECONDS(CAST(TRUNC(UNIX_SECONDS(created_at)/{time_frame}) AS INT64) * {time_frame}) AS started_at
+        FROM `{from_table}`
+        WHERE created_at >= TIMESTAMP_SECONDS({created_at_from}) AND created_at < TIMESTAMP_SECONDS({created_at_to})
+        GROUP BY last_trading_day, started_at;
+''']
+
+    for column, to_table in measures:
+        source_query = (f'''
+            SELECT {column}_open open, {column}_high high, {column}_low low, {column}_close close,
+                last_trading_day, {time_frame} time_frame, started_at
+            FROM ohlc''')
+        statements.append(build_merge_ohlc_statement(
+            to_table, source_query,
+            bucket_start(created_at_from, time_frame), bucket_start(created_at_to - 1, time_frame) + time_frame))
+
+    return statements
+
+
+# 1つ下の時間足から上位の時間足を集計する文を組み立てます。atm_price はスキャンしません。
+# 期間: [started_at_from, started_at_to) (epoch秒。時間枠の区切りに揃えること)
+def build_rollup_ohlc_statements(time_frame, source_time_frame, started_at_from, started_at_to,
+                                 measures=OHLC_MEASURES):
+    statements = []
+
+    for _, table in measures:
+        source_query = (f'''
+            SELECT
+                (array_agg(open IGNORE NULLS ORDER BY started_at ASC))[SAFE_OFFSET(0)] open,
+                MAX(high) high,
+                MIN(low) low,
+                (array_agg(close IGNORE NULLS ORDER BY started_at DESC))[SAFE_OFFSET(0)] close,
                 last_trading_day,
-                3600 time_frame,
-                TIMESTAMP_SECONDS(CAST(TRUNC(UNIX_SECONDS(created_at)/3600) AS INT64) * 3600) AS started_at
-            FROM `{from_table}`
-            WHERE is_atm=True AND type=2 AND created_at >= TIMESTAMP_TRUNC(TIMESTAMP_ADD(DT(), INTERVAL -1 DAY), DAY) AND created_at < TIMESTAMP_TRUNC(DT(), DAY)
-            GROUP BY last_trading_day, started_at
-        )        
-        SELECT * FROM t1;
-    ''')
+                {time_frame} time_frame,
+                bucket AS started_at
+            FROM (
+                SELECT *, TIMESTAMP_SECONDS(CAST(TRUNC(UNIX_SECONDS(started_at)/{time_frame}) AS INT64) * {time_frame}) AS bucket
+                FROM `{config.gcp_bq_dataset_name}.{table}`
+                WHERE time_frame = {source_time_frame}
+                    AND started_at >= TIMESTAMP_SECONDS({started_at_from}) AND started_at < TIMESTAMP_SECONDS({started_at_to})
+            )
+            GROUP BY last_trading_day, bucket''')
+        statements.append(build_merge_ohlc_statement(table, source_query, started_at_from, started_at_to))
+
+    return statements
+
+
+# label: ログに出す名前
+def run_script(statements, label):
+    query = ''.join(statements)
+    bq_query.run_query(query, label)
+
+
+# 期間 [from_epoch, to_epoch) の全時間足を作り直します。
+# 最小の時間足を atm_price から集計した後、上位の時間足を順に1つ下の時間足から集計します。
+# label: ログに出す名前
+def rebuild_ohlc(from_epoch, to_epoch, measures=OHLC_MEASURES, label='insert_ohlc'):
+    statements = build_base_ohlc_statements(from_epoch, to_epoch, measures)
+
+    for time_frame, source_time_frame in ROLLUP_TIME_FRAMES:
+        statements += build_rollup_ohlc_statements(
+            time_frame, source_time_frame,
+            bucket_start(from_epoch, time_frame), bucket_start(to_epoch, time_frame), measures)
+
+    log.debug(f'rebuild ohlc: from={from_epoch}, to={to_epoch}')
+    run_script(statements, label)
+
+
+# 期間 [from_epoch, to_epoch) を日(UTC)ごとに区切った [(日の始まり, 次の日の始まり), ...] を返します
+def split_into_days(from_epoch, to_epoch):
+    return [(day, day + ONE_DAY) for day in range(bucket_start(from_epoch, ONE_DAY), to_epoch, ONE_DAY)]
+
+
+# 同じテーブルへの DML が同時に実行されて失敗したかどうか
+def is_concurrent_update_error(e):
+    return 'concurrent update' in str(e)
+
+
+# 1日分の全時間足を作り直します。他の DML とぶつかって失敗した場合は、間をおいてやり直します
+def rebuild_ohlc_of_day(day_from, day_to, measures=OHLC_MEASURES):
+    for attempt in range(config.ohlc_backfill_max_retries + 1):
+        try:
+            rebuild_ohlc(day_from, day_to, measures, 'backfill_ohlc')
+            return
+        except Exception as e:
+            if not is_concurrent_update_error(e) or attempt >= config.ohlc_backfill_max_retries:
+                raise
 
-    client = bigquery.Client()
-    query_job = client.query(query)
-    query_job.result()
+            log.warning(f'concurrent update. retrying..: day={day_from}, attempt={attempt + 1}')
+            time.sleep(config.ohlc_backfill_retry_interval_seconds * (attempt + 1))
+
+
+# 期間 [from_epoch, to_epoch) の全時間足を、日(UTC)ごとに別のジョブで並行して作り直します。
+# 日足の区切りもUTCの0時なので、日ごとのジョブが集計する足とパーティションは重ならない。
+# MERGE なので、途中で失敗した日だけやり直しても、全期間をやり直してもよい。
+# max_workers: 同時に実行するジョブの数の上限
+# 戻り値: 失敗した日の始まり(epoch秒)のリスト
+def backfill_ohlc(from_epoch, to_epoch, max_workers=None, measures=OHLC_MEASURES):
+    days = split_into_days(from_epoch, to_epoch)
+    failed_days = []
+
+    log.info(f'backfill ohlc: from={from_epoch}, to={to_epoch}, days={len(days)}')
+
+    with ThreadPoolExecutor(max_workers=max_workers or config.ohlc_backfill_max_workers) as executor:
+        futures = {executor.submit(rebuild_ohlc_of_day, day_from, day_to, measures): day_from
+                   for day_from, day_to in days}
+
+        for future in as_completed(futures):
+            day_from = futures[future]
+
+            try:
+                future.result()
+                log.debug(f'backfilled: day={day_from}')
+            except Exception as e:
+                log.error(f'failed to backfill: day={day_from}, error={e}')
+                failed_days.append(day_from)
+
+    return sorted(failed_days)
+
+
+# 直近の時間足を更新します。
+# 最小の時間足は進行中の足も含めて lookback 秒前から集計し直します。
+# 上位の時間足は、前回の実行以降に区切りを迎えたものだけを確定した足として集計します。
+# 進行中の上位の時間足は、読み出し側で最小の時間足から集計します。
+def update_recent_ohlc(now_epoch, measures=OHLC_MEASURES):
+    lookback = config.ohlc_rollup_lookback_seconds
+    interval = config.ohlc_rollup_interval_seconds
+
+    statements = build_base_ohlc_statements(bucket_start(now_epoch - lookback, BASE_TIME_FRAME), now_epoch, measures)
+
+    for time_frame, source_time_frame in ROLLUP_TIME_FRAMES:
+        current_started_at = bucket_start(now_epoch, time_frame)
+
+        if current_started_at <= now_epoch - interval:
+            # 前回の実行以降に区切りを迎えていない
+            continue
+
+        statements += build_rollup_ohlc_statements(
+            time_frame, source_time_frame, current_started_at - time_frame, current_started_at, measures)
+
+    run_script(statements, 'rollup_ohlc')
 
 
 # entry point of Cloud Functions
 # trigger = pubsub
+# 数分おきに呼ばれて、直近の時間足を更新する
+def rollup_ohlc(data, context):
+    update_recent_ohlc(int(time.time()))
+
+
+# entry point of Cloud Functions
+# trigger = pubsub
+# 1日1回呼ばれて、直近 ohlc_insert_days 日(UTC)分の全時間足を作り直す。
+# rollup_ohlc が取りこぼした分の補完も兼ねる。前日に呼ばれ損ねても次の日に補完される
 def insert_ohlc(data, context):
-    insert_ohlc_iv()
-    insert_ohlc_option_price()
-    insert_ohlc_target_price()
+    today = bucket_start(int(time.time()), ONE_DAY)
+    failed_days = backfill_ohlc(today - config.ohlc_insert_days * ONE_DAY, today)
+
+    if failed_days:
+        raise RuntimeError(f'failed to insert ohlc: days={failed_days}')
+
+
+# 'YYYY-MM-DD' (UTC) を epoch秒にします
+def parse_date(date_str):
+    return int(datetime.strptime(date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+
+
+# entry point of Cloud Functions
+# trigger = pubsub
+# メッセージ {"from": "YYYY-MM-DD", "to": "YYYY-MM-DD"} の期間 [from, to) の全時間足を作り直す。
+# 集計のロジックやスキーマを変えたときに使う
+def backfill_ohlc_topic(data, context):
+    message = json.loads(base64.b64decode(data['data']).decode('utf-8'))
+    failed_days = backfill_ohlc(parse_date(message['from']), parse_date(message['to']), message.get('workers'))
+
+    if failed_days:
+        raise RuntimeError(f'failed to backfill ohlc: days={failed_days}')
 
 
 if __name__ == '__main__':
-    insert_ohlc()
+    parser = argparse.ArgumentParser(description='期間 [from, to) の全時間足を日ごとに並行して作り直します')
+    parser.add_argument('--from', dest='date_from', help='YYYY-MM-DD (UTC)。省略すると insert_ohlc と同じ')
+    parser.add_argument('--to', dest='date_to', help='YYYY-MM-DD (UTC)。この日は含まない')
+    parser.add_argument('--workers', type=int, help='同時に実行するジョブの数の上限')
+    args = parser.parse_args()
+
+    if (args.date_from is None) != (args.date_to is None):
+        parser.error('--from and --to must be given together')
+
+    if args.date_from is None:
+        insert_ohlc(None, None)
+    else:
+        failed = backfill_ohlc(parse_date(args.date_from), parse_date(args.date_to), args.workers)
+        print(f'failed days: {[datetime.fromtimestamp(d, timezone.utc).date().isoformat() for d in failed]}')